@@ -8,6 +8,10 @@ import htype
 import images
 import criu_api
 import iters
+import policy
+import xem_rpc
+import compression
+import exporter
 
 
 def parse_client_args():
@@ -20,12 +24,68 @@ def parse_client_args():
 		help="Type of hat to haul, e.g. vz, lxc, or docker")
 	parser.add_argument("id", help="ID of what to haul")
 	parser.add_argument("--to", help="IP where to haul")
-	parser.add_argument("--fdrpc", type=int, required=True, help="File descriptor of rpc socket")
-	parser.add_argument("--fdmem", type=int, required=True, help="File descriptor of memory socket")
+	parser.add_argument("--fdrpc", type=int, help="File descriptor of rpc socket")
+	parser.add_argument("--fdmem", type=int, help="File descriptor of memory socket")
 	parser.add_argument("--fdfs", help="Module specific definition of fs channel")
+	parser.add_argument("--fdmux", help="Comma separated file descriptors of multiplexed connections")
+	parser.add_argument("--fdimg", help="Comma separated file descriptors of extra images sockets")
+	parser.add_argument("--img-streams", type=int, default=0,
+		help="Number of extra multiplexed channels for parallel images transfer")
+	parser.add_argument("--dst-id", help="ID at destination")
+	parser.add_argument("--resume", metavar="ID",
+		help="Resume migration session interrupted by transport failure")
+	_add_migration_args(parser)
+
+	# Add haulers specific arguments
+	if len(sys.argv) > 1 and sys.argv[1] in htype.get_haul_names():
+		htype.add_hauler_args(sys.argv[1], parser)
+
+	args = parser.parse_args()
+	_check_connection_args(parser, args)
+	if args.stream_images and not (args.fdimg or args.img_streams):
+		parser.error("--stream-images requires --fdimg or --img-streams")
+	return args
+
+
+def parse_batch_args():
+	"""Parse p.haul-batch command line arguments"""
+
+	parser = argparse.ArgumentParser("Process HAULer batch")
+	parser.set_defaults(pre_dump=iters.PRE_DUMP_AUTO_DETECT)
+
+	parser.add_argument("hauls", nargs="+", metavar="type:id[:fdfs]",
+		help="What to haul, fdfs refers to fs channel indexes of haul's session")
+	parser.add_argument("--to", help="IP where to haul")
+	parser.add_argument("--fdmux", required=True,
+		help="Comma separated file descriptors of multiplexed connections")
+	parser.add_argument("--img-streams", type=int, default=0,
+		help="Number of extra multiplexed channels of every haul for parallel images transfer")
+	parser.add_argument("--max-parallel", type=int, default=0,
+		help="Maximum number of hauls migrating at once, picked by scheduler if 0")
+	parser.add_argument("--bandwidth", type=float,
+		default=compression.def_link_bandwidth / 1048576.,
+		help="Link bandwidth in Mb/s used to predict migration costs")
+	_add_migration_args(parser)
+
+	# Add specific arguments of haulers in the batch
+	for hauler_name in htype.get_haul_names():
+		if [arg for arg in sys.argv[1:] if arg.startswith(hauler_name + ":")]:
+			htype.add_hauler_args(hauler_name, parser)
+
+	args = parser.parse_args()
+	args.fdrpc = args.fdmem = args.fdimg = None
+	args.resume = None
+	args.bandwidth = args.bandwidth * 1048576
+	if args.stream_images and not args.img_streams:
+		parser.error("--stream-images requires --img-streams")
+	return args
+
+
+def _add_migration_args(parser):
+	"""Add arguments common for single and batch migrations"""
+
 	parser.add_argument("--mode", choices=iters.MIGRATION_MODES,
 		default=iters.MIGRATION_MODE_LIVE, help="Mode of migration")
-	parser.add_argument("--dst-id", help="ID at destination")
 	parser.add_argument("-v", default=criu_api.def_verb, type=int, dest="verbose", help="Verbosity level")
 	parser.add_argument("--keep-images", default=False, action='store_true', help="Keep images after migration")
 	parser.add_argument("--dst-rpid", default=None, help="Write pidfile on restore")
@@ -44,12 +104,37 @@ def parse_client_args():
 		const=iters.PRE_DUMP_DISABLE, help='Force disable pre-dumps')
 	parser.add_argument('--pre-dump', dest='pre_dump', action='store_const',
 		const=iters.PRE_DUMP_ENABLE, help='Force enable pre-dumps')
-
-	# Add haulers specific arguments
-	if len(sys.argv) > 1 and sys.argv[1] in htype.get_haul_names():
-		htype.add_hauler_args(sys.argv[1], parser)
-
-	return parser.parse_args()
+	parser.add_argument("--rpc-slow-threshold", type=float, default=None,
+		help="Log RPC calls taking longer than specified seconds")
+	parser.add_argument("--compress", choices=compression.CODECS,
+		default=compression.CODEC_NONE,
+		help="Compress images, auto picks codec and level from link bandwidth and idle CPUs")
+	parser.add_argument("--compress-level", type=int, default=0,
+		help="Compression level, codec default if 0")
+	parser.add_argument("--stream-images", default=False, action='store_true',
+		help="Send images to target while final dump is still running, needs extra images sockets")
+	parser.add_argument("--img-dedup", default=False, action='store_true',
+		help="Don't send images target keeps in its store from earlier migrations")
+	parser.add_argument("--max-downtime", type=float, default=None,
+		help="Keep pre-dumping until predicted downtime, from final dump freeze till restore on target, is below specified seconds")
+	parser.add_argument("--downtime-action", choices=policy.DOWNTIME_ACTIONS,
+		default=policy.DOWNTIME_ACTION_ABORT,
+		help="What to do if --max-downtime can't be met")
+	parser.add_argument("--auto-converge", default=False, action='store_true',
+		help="Throttle cpu of tree dirtying memory faster than it is transferred")
+	parser.add_argument("--iter-policy", default=policy.POLICY_DEFAULT,
+		help="Policy deciding when to stop iterating, one of %s or module:class" %
+		", ".join(sorted(policy.get_policy_names())))
+	parser.add_argument("--iter-time-budget", type=float, default=None,
+		help="Seconds pre-dumps may take with time-budget policy")
+	parser.add_argument("--metrics-file",
+		help="Write per-phase migration metrics in JSON to specified file")
+	parser.add_argument("--trace-file",
+		help="Write spans of source and target in Chrome trace-event format to specified file")
+	parser.add_argument("--no-history", default=False, action='store_true',
+		help="Don't use and record history of migrations kept in images path")
+	parser.add_argument("--dry-run", default=False, action='store_true',
+		help="Pre-dump into local images, probe link and predict migration time without migrating")
 
 
 def parse_service_args():
@@ -57,10 +142,40 @@ def parse_service_args():
 
 	parser = argparse.ArgumentParser("Process HAULer service server")
 
-	parser.add_argument("--fdrpc", type=int, required=True, help="File descriptor of rpc socket")
-	parser.add_argument("--fdmem", type=int, required=True, help="File descriptor of memory socket")
+	parser.add_argument("--fdrpc", type=int, help="File descriptor of rpc socket")
+	parser.add_argument("--fdmem", type=int, help="File descriptor of memory socket")
 	parser.add_argument("--fdfs", help="Module specific definition of fs channel")
+	parser.add_argument("--fdmux", help="Comma separated file descriptors of multiplexed connections")
+	parser.add_argument("--fdimg", help="Comma separated file descriptors of extra images sockets")
+	parser.add_argument("--img-streams", type=int, default=0,
+		help="Number of extra multiplexed channels for parallel images transfer")
+	parser.add_argument("--fdlisten", type=int,
+		help="File descriptor of listening socket, serve multiplexed session on every accepted connection")
+	parser.add_argument("--rpc-workers", type=int, default=xem_rpc.rpc_def_workers,
+		help="Number of threads executing RPC calls")
+	parser.add_argument("--metrics-port", type=int,
+		help="Serve Prometheus metrics over HTTP on specified port")
+	parser.add_argument("--metrics-addr", default=exporter.def_metrics_addr,
+		help="Address to serve metrics on, localhost by default")
 
 	parser.add_argument("--log-file", help="Write logging messages to specified file")
+	parser.add_argument("--rpc-slow-threshold", type=float, default=None,
+		help="Log RPC calls taking longer than specified seconds")
+
+	args = parser.parse_args()
+	if args.fdlisten is None:
+		_check_connection_args(parser, args)
+	elif args.fdmux or args.fdrpc is not None or args.fdmem is not None:
+		parser.error("--fdlisten can't be combined with other connections")
+	return args
+
 
-	return parser.parse_args()
+def _check_connection_args(parser, args):
+	"""Either multiplexed or both rpc and memory connections required"""
+	if args.fdmux:
+		if args.fdrpc is not None or args.fdmem is not None or args.fdimg:
+			parser.error("--fdmux can't be combined with --fdrpc/--fdmem/--fdimg")
+	elif args.fdrpc is None or args.fdmem is None:
+		parser.error("--fdrpc and --fdmem (or --fdmux) are required")
+	elif args.img_streams:
+		parser.error("--img-streams requires --fdmux, use --fdimg instead")
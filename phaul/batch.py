@@ -0,0 +1,339 @@
+#
+# Batch migration of many hauls over one multiplexed session
+#
+# Every haul gets its own set of mux channels and its own iterations
+# worker. Scheduler estimates memory size and dirty rate of all trees,
+# starts the most expensive hauls first and runs as many of them at once
+# as the link lets converge. Only one haul does its final dump at a time,
+# traffic of the others is sent with lower priority meanwhile.
+#
+
+import sys
+import time
+import logging
+import resource
+import threading
+import htype
+import iters
+import mux
+import connection
+import util
+
+# Hauls running at once unless set explicitly
+def_max_parallel = 4
+
+# Seconds soft-dirty bits are watched to estimate dirty rates
+dirty_sample_time = 1.0
+
+# Running hauls may dirty at most this share of link bandwidth together,
+# otherwise none of them converges
+max_dirty_share = 0.5
+
+# Bound of convergence slowdown used in cost estimate
+min_converge_factor = 0.1
+
+# Pagemap entries are read by this many at once
+_pagemap_chunk = 0x10000
+_pagemap_entry_size = 8
+
+# Byte of pagemap entry holding soft-dirty bit (55) and its mask
+_soft_dirty_byte = 6 if sys.byteorder == "little" else 1
+_soft_dirty_set = "".join(chr(i) for i in range(0x80, 0x100))
+
+
+def _rss_bytes(pid):
+	with open("/proc/%d/statm" % pid) as f:
+		return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def _clear_soft_dirty(pid):
+	with open("/proc/%d/clear_refs" % pid, "w") as f:
+		f.write("4")
+
+
+def _soft_dirty_pages(pid):
+	"""Count pages of task with soft-dirty bit set"""
+	page_size = resource.getpagesize()
+	zero_chunk = "\0" * (_pagemap_chunk * _pagemap_entry_size)
+	count = 0
+
+	with open("/proc/%d/maps" % pid) as maps:
+		with open("/proc/%d/pagemap" % pid, "rb") as pagemap:
+			for line in maps:
+				if line.rstrip().endswith("[vsyscall]"):
+					continue
+				start, end = [int(addr, 16) for addr in line.split()[0].split("-")]
+				pagemap.seek(start / page_size * _pagemap_entry_size)
+				nr_pages = (end - start) / page_size
+				while nr_pages > 0:
+					nr = min(nr_pages, _pagemap_chunk)
+					data = pagemap.read(nr * _pagemap_entry_size)
+					if not data:
+						break
+					nr_pages -= nr
+
+					# Untouched ranges are all zeroes, skip them fast
+					if data == zero_chunk[:len(data)]:
+						continue
+					flags = data[_soft_dirty_byte::_pagemap_entry_size]
+					count += len(flags) - len(flags.translate(None,
+						_soft_dirty_set))
+	return count
+
+
+class batch_item:
+	"""Single haul of batch, given as type:id[:fdfs]"""
+
+	def __init__(self, spec):
+		fields = spec.split(":", 2)
+		if len(fields) < 2 or fields[0] not in htype.get_haul_names():
+			raise Exception("Bad haul %s, expected type:id[:fdfs]" % spec)
+
+		self.type = fields[0]
+		self.id = fields[1]
+		self.fdfs = fields[2] if len(fields) > 2 else None
+		self.mem_size = 0
+		self.dirty_rate = 0.0
+		self.cost = 0.0
+		self.start_time = None
+		self.end_time = None
+		self.downtime = None
+		self.error = None
+
+	def name(self):
+		return "%s:%s" % (self.type, self.id)
+
+	def root_pids(self):
+		"""Return pids of haul tree, None if they can't be found"""
+		try:
+			pid = htype.get_src((self.type, self.id)).root_task_pid()
+		except Exception as e:
+			logging.warning("Can't find tree of %s: %s", self.name(), e)
+			return None
+		if not isinstance(pid, int) or pid <= 0:
+			return None
+		return util.tree_pids(pid)
+
+
+class batch_scheduler:
+	"""Order hauls by predicted cost and decide when to start each"""
+
+	def __init__(self, items, bandwidth, max_parallel):
+		self.__pending = list(items)
+		self.__bandwidth = float(bandwidth)
+		self.__max_parallel = max_parallel
+
+	def estimate(self):
+		"""Measure memory size and dirty rate of all trees at once"""
+		trees = [(item, item.root_pids()) for item in self.__pending]
+		trees = [(item, pids) for item, pids in trees if pids]
+
+		for item, pids in trees:
+			for pid in pids:
+				self.__try(_clear_soft_dirty, pid)
+		start = time.time()
+		time.sleep(dirty_sample_time)
+
+		page_size = resource.getpagesize()
+		for item, pids in trees:
+			dirty = 0
+			for pid in pids:
+				item.mem_size += self.__try(_rss_bytes, pid)
+				dirty += self.__try(_soft_dirty_pages, pid)
+			item.dirty_rate = dirty * page_size / (time.time() - start)
+
+		for item in self.__pending:
+			item.cost = self.__cost(item)
+		self.__pending.sort(key=lambda item: item.cost, reverse=True)
+
+		logging.info("Batch migration plan:")
+		for item in self.__pending:
+			logging.info("\t%s: memory %.2lf Mb, dirty %.2lf Mb/s, cost %.2lf sec",
+				item.name(), item.mem_size / 1048576.,
+				item.dirty_rate / 1048576., item.cost)
+
+	def __try(self, func, pid):
+		# Tasks come and go while the tree is being sampled
+		try:
+			return func(pid)
+		except (IOError, OSError):
+			return 0
+
+	def __cost(self, item):
+		"""Predict seconds needed to migrate item alone
+
+		Pre-dumps resend what was dirtied during previous ones, so the
+		transfer of memory is stretched by 1 / (1 - dirty rate share).
+		"""
+		dirty_share = item.dirty_rate / self.__bandwidth
+		factor = max(1.0 - dirty_share, min_converge_factor)
+		return item.mem_size / self.__bandwidth / factor
+
+	def has_pending(self):
+		return len(self.__pending) > 0
+
+	def next_item(self, running):
+		"""Return haul to start next while running ones go, None to wait
+
+		Costly hauls go first so that they don't end up alone at the end
+		of the batch, the cheaper ones fill the link meanwhile.
+		"""
+		if len(running) >= self.__max_parallel:
+			return None
+
+		dirty_limit = self.__bandwidth * max_dirty_share
+		dirty = sum(item.dirty_rate for item in running)
+		for item in self.__pending:
+			if not running or dirty + item.dirty_rate <= dirty_limit:
+				self.__pending.remove(item)
+				return item
+		return None
+
+
+class final_dump_lock:
+	"""Let one haul at a time do its final dump, with link for itself"""
+
+	def __init__(self, transport):
+		self.__transport = transport
+		self.__lock = threading.Lock()
+		self.__mutex = threading.Lock()
+		self.__layouts = {}
+		self.__owner = None
+
+	def add(self, worker, layout):
+		with self.__mutex:
+			self.__layouts[worker] = layout
+			if self.__owner:
+				self.__set_bulk(layout, True)
+
+	def remove(self, worker):
+		with self.__mutex:
+			del self.__layouts[worker]
+
+	def acquire(self, worker):
+		self.__lock.acquire()
+		with self.__mutex:
+			self.__owner = worker
+			for other, layout in self.__layouts.items():
+				if other is not worker:
+					self.__set_bulk(layout, True)
+
+	def release(self, worker):
+		with self.__mutex:
+			self.__owner = None
+			for other, layout in self.__layouts.items():
+				if other is not worker:
+					self.__set_bulk(layout, False)
+		self.__lock.release()
+
+	def __set_bulk(self, layout, bulk):
+		# Rpc channels keep their priority, they carry little traffic
+		for chan_id, prio in layout:
+			if prio > mux.PRIO_RPC:
+				self.__transport.set_priority(chan_id,
+					mux.PRIO_BULK if bulk else prio)
+
+
+class batch_migration:
+	def __init__(self, transport, specs, opts):
+		self.__transport = transport
+		self.__opts = opts
+		self.__items = [batch_item(spec) for spec in specs]
+		if len(self.__items) >= connection.MUX_MAX_SESSIONS:
+			raise Exception("At most %d hauls fit one batch" %
+				(connection.MUX_MAX_SESSIONS - 1))
+
+		self.__scheduler = batch_scheduler(self.__items, opts["bandwidth"],
+			opts["max_parallel"] or def_max_parallel)
+		self.__final_lock = final_dump_lock(transport)
+		self.__running = []
+		self.__cond = threading.Condition()
+		self.__next_session = 1
+
+	def start_migration(self):
+		"""Migrate all hauls, return number of failed ones"""
+		start = time.time()
+		bytes_start = self.__transport.bytes_sent()
+		self.__scheduler.estimate()
+
+		threads = []
+		with self.__cond:
+			while self.__scheduler.has_pending():
+				item = self.__scheduler.next_item(self.__running)
+				if not item:
+					self.__cond.wait()
+					continue
+
+				self.__running.append(item)
+				thread = threading.Thread(target=self.__migrate,
+					args=(item, self.__next_session))
+				self.__next_session += 1
+				thread.start()
+				threads.append(thread)
+
+		for thread in threads:
+			thread.join()
+
+		self.__print_overall(time.time() - start,
+			self.__transport.bytes_sent() - bytes_start)
+		return len([item for item in self.__items if item.error])
+
+	def __migrate(self, item, session):
+		logging.info("Start %s migration in session %d", item.name(), session)
+		item.start_time = time.time()
+		img_streams = self.__opts["img_streams"]
+		conn = None
+		worker = None
+		try:
+			conn = connection.open_mux_session(self.__transport, session,
+				item.fdfs, img_streams)
+			worker = iters.phaul_iter_worker((item.type, item.id), None,
+				self.__opts["mode"], conn)
+			self.__final_lock.add(worker, connection.mux_session_layout(
+				session, item.fdfs, img_streams))
+			worker.set_final_lock(self.__final_lock)
+			worker.set_options(self.__item_opts(item))
+			worker.start_migration()
+			item.downtime = worker.downtime
+			logging.info("Migration of %s succeeded", item.name())
+		except Exception as e:
+			logging.exception("Migration of %s failed", item.name())
+			item.error = str(e)
+		finally:
+			if worker:
+				self.__final_lock.remove(worker)
+			if conn:
+				conn.close()
+			item.end_time = time.time()
+			with self.__cond:
+				self.__running.remove(item)
+				self.__cond.notify()
+
+	def __item_opts(self, item):
+		"""Options of haul, metrics and trace of every haul go to files
+		of its own"""
+		opts = dict(self.__opts)
+		for name in ("metrics_file", "trace_file"):
+			if opts[name]:
+				opts[name] = "%s.%s-%s" % (opts[name], item.type, item.id)
+		return opts
+
+	def __print_overall(self, total_time, bytes_sent):
+		failed = len([item for item in self.__items if item.error])
+		logging.info("Batch migration stats:")
+		logging.info("\t%d hauls, %d failed, total time %.2lf sec",
+			len(self.__items), failed, total_time)
+		logging.info("\tSent %.2lf Mb, aggregate throughput %.2lf Mb/s",
+			bytes_sent / 1048576., bytes_sent / 1048576. / total_time)
+
+		for item in self.__items:
+			if item.start_time is None:
+				continue
+			if item.error:
+				status = "failed: %s" % item.error
+			elif item.downtime is None:
+				status = "succeeded"
+			else:
+				status = "succeeded, downtime %.3lf sec" % item.downtime
+			logging.info("\t%s: %.2lf sec, %s", item.name(),
+				item.end_time - item.start_time, status)
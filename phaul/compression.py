@@ -0,0 +1,255 @@
+#
+# Streaming compression for image transfers
+#
+# zlib is always available, lz4 and zstd are used if python modules for
+# them are installed. Compressed stream is a sequence of length prefixed
+# chunks terminated with an empty one, so the receiver never reads past
+# the end of the stream on a socket shared with other traffic.
+#
+
+import os
+import struct
+import logging
+import zlib
+import util
+
+try:
+	import lz4.frame
+except ImportError:
+	lz4 = None
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+
+CODEC_NONE = "none"
+CODEC_AUTO = "auto"
+CODEC_ZLIB = "zlib"
+CODEC_LZ4 = "lz4"
+CODEC_ZSTD = "zstd"
+CODECS = (CODEC_NONE, CODEC_AUTO, CODEC_ZLIB, CODEC_LZ4, CODEC_ZSTD)
+
+# Codec ids used on the wire
+_codec_ids = {CODEC_NONE: 0, CODEC_ZLIB: 1, CODEC_LZ4: 2, CODEC_ZSTD: 3}
+_codec_names = dict((v, k) for k, v in _codec_ids.items())
+
+# Only codec is sent, decompressors don't need the level
+stream_hdr = struct.Struct("!B")
+chunk_hdr = struct.Struct("!I")
+
+# Compressed data is sent once this much is accumulated
+chunk_size = 0x40000
+
+# Approximate single core compression speed in bytes per second of
+# (codec, level) pairs, ordered from the strongest compression to the
+# weakest, used to pick the strongest setting that keeps up with the link
+_speed_table = (
+	(CODEC_ZSTD, 9, 60 << 20),
+	(CODEC_ZLIB, 6, 25 << 20),
+	(CODEC_ZSTD, 3, 250 << 20),
+	(CODEC_ZLIB, 1, 80 << 20),
+	(CODEC_ZSTD, 1, 400 << 20),
+	(CODEC_LZ4, 0, 600 << 20),
+)
+
+# Assumed link bandwidth until one is measured (1Gbit/s)
+def_link_bandwidth = 125 << 20
+
+
+def available_codecs():
+	"""Return codecs usable in this process"""
+	codecs = [CODEC_NONE, CODEC_ZLIB]
+	if lz4:
+		codecs.append(CODEC_LZ4)
+	if zstandard:
+		codecs.append(CODEC_ZSTD)
+	return codecs
+
+
+def choose_codec(codecs, link_bandwidth):
+	"""Pick codec and level for auto mode
+
+	Choose the best compressing setting from codecs whose speed, scaled by
+	number of idle CPUs, is not lower than the link bandwidth. Compression
+	is off if none of them keeps up.
+	"""
+
+	if not link_bandwidth:
+		link_bandwidth = def_link_bandwidth
+
+	idle_cpus = os.sysconf("SC_NPROCESSORS_ONLN") - os.getloadavg()[0]
+	cpu_scale = min(max(idle_cpus, 0.5), 1.0)
+
+	for codec, level, speed in _speed_table:
+		if codec in codecs and speed * cpu_scale >= link_bandwidth:
+			return codec, level
+	return CODEC_NONE, 0
+
+
+def _make_compressor(codec, level):
+	if codec == CODEC_ZLIB:
+		return zlib.compressobj(level or zlib.Z_DEFAULT_COMPRESSION)
+	elif codec == CODEC_LZ4:
+		return _lz4_compressor(level)
+	elif codec == CODEC_ZSTD:
+		return zstandard.ZstdCompressor(level=level or 3).compressobj()
+	raise Exception("Unknown codec %s" % codec)
+
+
+def _make_decompressor(codec):
+	if codec == CODEC_ZLIB:
+		return zlib.decompressobj()
+	elif codec == CODEC_LZ4:
+		return lz4.frame.LZ4FrameDecompressor()
+	elif codec == CODEC_ZSTD:
+		return zstandard.ZstdDecompressor().decompressobj()
+	raise Exception("Unknown codec %s" % codec)
+
+
+class _lz4_compressor:
+	"""Give lz4 frame compressor zlib-like interface"""
+
+	def __init__(self, level):
+		self.__comp = lz4.frame.LZ4FrameCompressor(compression_level=level)
+		self.__header = self.__comp.begin()
+
+	def compress(self, data):
+		header, self.__header = self.__header, ""
+		return header + self.__comp.compress(data)
+
+	def flush(self):
+		return self.__header + self.__comp.flush()
+
+
+class stream_sink:
+	"""Write end of possibly compressed stream over socket"""
+
+	def __init__(self, sk, codec, level=0):
+		self.__sk = sk
+		self.__codec = codec
+		self.__comp = None
+		self.__pending = []
+		self.__pending_size = 0
+		self.bytes_in = 0
+		self.bytes_out = stream_hdr.size
+		if codec != CODEC_NONE:
+			self.__comp = _make_compressor(codec, level)
+		sk.sendall(stream_hdr.pack(_codec_ids[codec]))
+
+	def write(self, data):
+		self.bytes_in += len(data)
+		if not self.__comp:
+			self.__sk.sendall(data)
+			self.bytes_out += len(data)
+			return
+
+		self.__queue(self.__comp.compress(data))
+		if self.__pending_size >= chunk_size:
+			self.__send_chunk()
+
+	def sendfile(self, fd, size):
+		if not self.__comp:
+			util.sendfile(self.__sk, fd, size)
+			self.bytes_in += size
+			self.bytes_out += size
+			return
+
+		while size > 0:
+			data = os.read(fd, min(size, chunk_size))
+			if not data:
+				raise Exception("File truncated while sending")
+			self.write(data)
+			size -= len(data)
+
+	def flush(self):
+		"""Send compressed data accumulated so far"""
+		if self.__comp:
+			self.__send_chunk()
+
+	def finish(self):
+		if not self.__comp:
+			return
+		self.__queue(self.__comp.flush())
+		self.__send_chunk()
+		self.__sk.sendall(chunk_hdr.pack(0))
+		self.bytes_out += chunk_hdr.size
+
+	def __queue(self, data):
+		if data:
+			self.__pending.append(data)
+			self.__pending_size += len(data)
+
+	def __send_chunk(self):
+		if not self.__pending_size:
+			return
+		data = "".join(self.__pending)
+		self.__sk.sendall(chunk_hdr.pack(len(data)) + data)
+		self.bytes_out += chunk_hdr.size + len(data)
+		self.__pending = []
+		self.__pending_size = 0
+
+
+class stream_source:
+	"""Read end of stream written by stream_sink"""
+
+	def __init__(self, sk):
+		self.__sk = sk
+		codec_id, = stream_hdr.unpack(self.__recv_raw(stream_hdr.size))
+		self.codec = _codec_names.get(codec_id)
+		if not self.codec:
+			raise Exception("Unknown stream codec %d" % codec_id)
+		if self.codec not in available_codecs():
+			raise Exception("Codec %s is not available" % self.codec)
+
+		self.__decomp = None
+		self.__buf = ""
+		self.__eof = False
+		if self.codec != CODEC_NONE:
+			self.__decomp = _make_decompressor(self.codec)
+
+	def recv_exact(self, size):
+		if not self.__decomp:
+			return self.__recv_raw(size)
+
+		while len(self.__buf) < size:
+			self.__fill()
+		data, self.__buf = self.__buf[:size], self.__buf[size:]
+		return data
+
+	def recv_into(self, view, size):
+		"""Receive up to size bytes into memoryview, return their number"""
+		if not self.__decomp:
+			return self.__sk.recv_into(view, size)
+
+		if not self.__buf:
+			self.__fill()
+		size = min(size, len(self.__buf))
+		view[:size] = self.__buf[:size]
+		self.__buf = self.__buf[size:]
+		return size
+
+	def finish(self):
+		"""Consume stream terminator"""
+		if not self.__decomp:
+			return
+		while not self.__eof:
+			self.__fill()
+		if self.__buf:
+			logging.warning("Garbage at the end of compressed stream")
+
+	def __fill(self):
+		if self.__eof:
+			raise Exception("Compressed stream truncated")
+		size, = chunk_hdr.unpack(self.__recv_raw(chunk_hdr.size))
+		if size == 0:
+			self.__eof = True
+			return
+		self.__buf += self.__decomp.decompress(self.__recv_raw(size))
+
+	def __recv_raw(self, size):
+		data = util.recv_exact(self.__sk, size)
+		if data is None:
+			raise Exception("Stream truncated")
+		return data
@@ -3,38 +3,63 @@
 # between p.haul and p.haul-service.
 #
 
+import json
 import logging
 import socket
 import util
+import mux
+
+# Logical channels of multiplexed connection
+MUX_CHAN_RPC = 0
+MUX_CHAN_MEM = 1
+MUX_CHAN_FS_BASE = 2
+MUX_CHAN_IMG_BASE = 0x100
+
+# Channels of session N are the ones above shifted by N * stride, session
+# 0 is the one given on command line
+MUX_SESSION_STRIDE = 0x400
+MUX_MAX_SESSIONS = 0x10000 / MUX_SESSION_STRIDE
 
 
 class connection:
 	"""p.haul connection
 
 	Class encapsulate connections reqired for p.haul work, including rpc socket
-	(socket for RPC calls), memory socket (socket for c/r images migration) and
-	module specific definition of fs channel needed for disk migration.
+	(socket for RPC calls), memory socket (socket for c/r images migration),
+	optional extra sockets for parallel images transfer and module specific
+	definition of fs channel needed for disk migration.
 	"""
 
-	def __init__(self, rpc_sk, mem_sk, fdfs):
+	def __init__(self, rpc_sk, mem_sk, fdfs, img_sks=None, mux_transport=None):
 		self.rpc_sk = rpc_sk
 		self.mem_sk = mem_sk
 		self.fdfs = fdfs
+		self.img_sks = img_sks or []
+		self.mux = mux_transport
+
+	def image_sks(self):
+		"""Return sockets images can be sent over in parallel"""
+		return [self.mem_sk] + self.img_sks
 
 	def close(self):
 		self.rpc_sk.close()
 		self.mem_sk.close()
+		for sk in self.img_sks:
+			sk.close()
+		if self.mux:
+			self.mux.close()
 
 
-def establish(fdrpc, fdmem, fdfs):
+def establish(fdrpc, fdmem, fdfs, fdimg=None):
 	"""Construct required socket objects from file descriptors
 
 	Expect that each file descriptor represent socket opened in blocking mode
-	with domain AF_INET and type SOCK_STREAM.
+	with domain AF_INET and type SOCK_STREAM. fdimg is optional comma
+	separated list of extra sockets for parallel images transfer.
 	"""
 
-	logging.info("Use existing connections, fdrpc=%d fdmem=%d fdfs=%s", fdrpc,
-		fdmem, fdfs)
+	logging.info("Use existing connections, fdrpc=%d fdmem=%d fdfs=%s "
+		"fdimg=%s", fdrpc, fdmem, fdfs, fdimg)
 
 	# Create rpc socket
 	rpc_sk = socket.fromfd(fdrpc, socket.AF_INET, socket.SOCK_STREAM)
@@ -43,4 +68,148 @@ def establish(fdrpc, fdmem, fdfs):
 	# Create memory socket
 	mem_sk = socket.fromfd(fdmem, socket.AF_INET, socket.SOCK_STREAM)
 
-	return connection(rpc_sk, mem_sk, fdfs)
+	# Create images sockets
+	img_sks = []
+	if fdimg:
+		for fd in fdimg.split(","):
+			img_sk = socket.fromfd(int(fd), socket.AF_INET, socket.SOCK_STREAM)
+			util.set_cloexec(img_sk)
+			img_sks.append(img_sk)
+
+	return connection(rpc_sk, mem_sk, fdfs, img_sks)
+
+
+def establish_mux(fdmux, fdfs, img_streams=0, on_session=None):
+	"""Construct required channels over multiplexed connections
+
+	fdmux is a comma separated list of socket file descriptors, all of them
+	carry frames of rpc, memory and fs channels. Fs channel fds in fdfs are
+	replaced with logical channel indexes, i.e. "root.hdd/root.hds:0" refers
+	to the first fs channel. img_streams extra channels are opened for
+	parallel images transfer. Both sides must be given same channels layout.
+	"""
+
+	logging.info("Use multiplexed connections, fdmux=%s fdfs=%s", fdmux,
+		fdfs)
+	return mux_connection(_mux_sks(fdmux), fdfs, img_streams, on_session)
+
+
+def establish_mux_transport(fdmux):
+	"""Start multiplexed connections without channels of session 0
+
+	Migrations then go over sessions opened with open_mux_session().
+	"""
+
+	logging.info("Use multiplexed connections for sessions, fdmux=%s", fdmux)
+	sks = _mux_sks(fdmux)
+	for sk in sks:
+		util.set_cloexec(sk)
+	transport = mux.mux(sks)
+	transport.start()
+	return transport
+
+
+def _mux_sks(fdmux):
+	sks = []
+	for fd in fdmux.split(","):
+		sks.append(socket.fromfd(int(fd), socket.AF_INET, socket.SOCK_STREAM))
+	return sks
+
+
+def mux_connection(sks, fdfs, img_streams=0, on_session=None):
+	"""Open rpc, memory and fs channels over connected sockets
+
+	If on_session is given it's called with connection of every session
+	the peer opens over the same sockets later.
+	"""
+
+	for sk in sks:
+		util.set_cloexec(sk)
+
+	transport = mux.mux(sks)
+	conn = _open_session(transport, 0, fdfs, img_streams)
+	if on_session:
+		accept_mux_sessions(transport, on_session)
+	transport.start()
+	conn.mux = transport
+	return conn
+
+
+def mux_session_layout(index, fdfs, img_streams=0):
+	"""Return (channel id, priority) of every channel of session
+
+	Rpc channel goes first, then memory, fs and images ones.
+	"""
+
+	base = index * MUX_SESSION_STRIDE
+	layout = [(base + MUX_CHAN_RPC, mux.PRIO_RPC),
+		(base + MUX_CHAN_MEM, mux.PRIO_MEM)]
+	for path, fs_index in _fs_channels(fdfs):
+		layout.append((base + MUX_CHAN_FS_BASE + fs_index, mux.PRIO_FS))
+	for i in range(img_streams):
+		layout.append((base + MUX_CHAN_IMG_BASE + i, mux.PRIO_MEM))
+	return layout
+
+
+def open_mux_session(transport, index, fdfs, img_streams=0):
+	"""Open channels of session over started transport
+
+	The peer opens the same channels once it gets announce of rpc one,
+	which carries fs and images channels layout, see accept_mux_sessions().
+	"""
+
+	if index <= 0 or index >= MUX_MAX_SESSIONS:
+		raise Exception("Mux session index %d is out of range" % index)
+
+	conn = _open_session(transport, index, fdfs, img_streams)
+	layout = mux_session_layout(index, fdfs, img_streams)
+	for chan_id, prio in layout[1:]:
+		transport.announce(chan_id)
+	transport.announce(layout[0][0],
+		json.dumps({"fdfs": fdfs, "img_streams": img_streams}))
+	return conn
+
+
+def accept_mux_sessions(transport, on_session):
+	"""Call on_session with connection of every session peer opens"""
+
+	def on_open(chan_id, data):
+		index, chan = divmod(chan_id, MUX_SESSION_STRIDE)
+		if chan != MUX_CHAN_RPC or not data:
+			return
+		desc = json.loads(data)
+		logging.info("Mux session %d opened, fdfs=%s", index, desc["fdfs"])
+		on_session(_open_session(transport, index, desc["fdfs"],
+			desc["img_streams"]))
+
+	transport.set_open_handler(on_open)
+
+
+def _fs_channels(fdfs):
+	"""Split fdfs into (path, fs channel index) pairs"""
+	channels = []
+	if fdfs:
+		for fs_channel in fdfs.split(","):
+			path, sep, index = fs_channel.rpartition(":")
+			channels.append((path, int(index)))
+	return channels
+
+
+def _open_session(transport, index, fdfs, img_streams):
+	layout = mux_session_layout(index, fdfs, img_streams)
+	sks = [transport.channel(chan_id, prio) for chan_id, prio in layout]
+
+	rpc_sk, mem_sk = sks[0], sks[1]
+	util.set_cloexec(rpc_sk)
+
+	fs_channels = _fs_channels(fdfs)
+	fs_sks = sks[2:2 + len(fs_channels)]
+	if fdfs:
+		fdfs = ",".join("{0}:{1}".format(path, sk.fileno())
+			for (path, fs_index), sk in zip(fs_channels, fs_sks))
+
+	img_sks = sks[2 + len(fs_channels):]
+	for img_sk in img_sks:
+		util.set_cloexec(img_sk)
+
+	return connection(rpc_sk, mem_sk, fdfs, img_sks)
@@ -0,0 +1,180 @@
+#
+# Convergence engine for live migration iterations
+#
+# After every pre-dump the engine estimates how fast the tree dirties its
+# memory and how fast dirty pages reach the target, predicts how long the
+# tree stays frozen if final dump is taken right now and after one more
+# iteration and stops iterating once another pre-dump doesn't make it
+# shorter. Freeze lasts till restore on target, so images sync and restore
+# are predicted as well.
+#
+
+import math
+import resource
+import logging
+
+# Another iteration must shorten predicted freeze by this fraction
+min_gain = 0.05
+
+# Weight of the newest sample in smoothed rates
+rate_weight = 0.5
+
+
+def _smooth(prev, value):
+	if prev is None:
+		return value
+	return prev * (1 - rate_weight) + value * rate_weight
+
+
+def predict_migration(pages, dirty_rate, xfer_rate, frozen_time, overhead,
+		max_iters, min_pages):
+	"""Model pre-dump iterations of tree not migrated yet
+
+	pages are written by the first pre-dump, rates are in pages per second,
+	frozen_time is what every dump spends frozen and overhead is what every
+	iteration spends besides that and writing pages, both in seconds.
+	Return number of pre-dumps, total time and frozen time of final dump.
+	"""
+
+	total = 0.0
+	nr_iters = 0
+	while True:
+		duration = frozen_time + pages / xfer_rate + overhead
+		total += duration
+		nr_iters += 1
+		next_pages = dirty_rate * duration
+		if nr_iters > max_iters or next_pages <= min_pages:
+			break
+		if next_pages >= pages * (1 - min_gain):
+			break
+		pages = next_pages
+
+	frozen = frozen_time + next_pages / xfer_rate
+	return nr_iters, total + frozen, frozen
+
+
+def project_iters(pages, ratio, min_pages):
+	"""Return number of further pre-dumps until one writes at most
+	min_pages, if every one writes ratio times pages of the previous,
+	None if they don't shrink enough to get there"""
+
+	if pages <= min_pages:
+		return 0
+	if ratio >= 1 - min_gain:
+		return None
+	if ratio <= 0:
+		return 1
+	return int(math.ceil(math.log(float(min_pages) / pages) / math.log(ratio)))
+
+
+class converge_engine:
+	"""Decide whether another pre-dump iteration is worth doing"""
+
+	def __init__(self, max_iters, min_pages):
+		self.__max_iters = max_iters
+		self.__min_pages = min_pages
+		self.__page_size = resource.getpagesize()
+		self.__last = None
+		self.dirty_rate = None
+		self.xfer_rate = None
+		self.frozen_now = None
+		self.frozen_next = None
+
+	def seed(self, dirty_rate, xfer_rate):
+		"""Set rates in pages per second before anything is measured,
+		measured ones are then smoothed with them"""
+		self.dirty_rate = dirty_rate
+		self.xfer_rate = xfer_rate
+
+	def handle_iteration(self, est, img_bytes=0):
+		"""Account mstats.iter_rates of finished pre-dump iteration
+
+		img_bytes is size of its images other than pages, final dump
+		leaves as much to be synced to target.
+		"""
+		self.__last = est
+
+		if est.dirty_rate is not None:
+			self.dirty_rate = _smooth(self.dirty_rate, est.dirty_rate)
+		if est.xfer_rate:
+			self.xfer_rate = _smooth(self.xfer_rate, est.xfer_rate)
+		self.__predict(est, img_bytes)
+
+	def __predict(self, est, img_bytes):
+		self.frozen_now = None
+		self.frozen_next = None
+		if self.dirty_rate is None or not self.xfer_rate:
+			return
+
+		# After final dump images are synced over the same link and tree
+		# is restored, restore is taken as long as freeze of a dump
+		img_sync = img_bytes / (self.xfer_rate * self.__page_size)
+		after_dump = img_sync + est.frozen_time
+
+		# Final dump right now writes what was dirtied since last pre-dump
+		pages_now = self.dirty_rate * est.duration
+		dump_now = est.frozen_time + pages_now / self.xfer_rate
+		self.frozen_now = dump_now + after_dump
+
+		# Another iteration writes these pages and spends the rest of its
+		# time (fs sync, rpc) like this one did, the final dump after it
+		# then writes what was dirtied meanwhile
+		overhead = max(est.duration - est.pages / self.xfer_rate, 0.0)
+		next_duration = pages_now / self.xfer_rate + overhead
+		pages_next = self.dirty_rate * next_duration
+		dump_next = est.frozen_time + pages_next / self.xfer_rate
+		self.frozen_next = dump_next + after_dump
+
+	def is_diverging(self):
+		"""Memory is dirtied faster than it is transferred"""
+		if self.dirty_rate is None or not self.xfer_rate:
+			return False
+		return self.dirty_rate >= self.xfer_rate
+
+	def predicted_frozen_time(self):
+		"""Downtime of final dump taken now in seconds, None if unknown"""
+		return self.frozen_now
+
+	def should_continue(self, index):
+		est = self.__last
+		logging.info("Checking iteration progress:")
+		logging.info("\tpages %d, duration %.2lf sec, frozen %.3lf sec",
+			est.pages, est.duration, est.frozen_time)
+		logging.info("\tdirty rate %s, xfer rate %s",
+			self.__fmt_rate(self.dirty_rate), self.__fmt_rate(self.xfer_rate))
+		logging.info("\tpredicted freeze now %s, after next iteration %s",
+			self.__fmt_time(self.frozen_now), self.__fmt_time(self.frozen_next))
+
+		if est.pages <= self.__min_pages:
+			logging.info("\t> Small dump")
+			return False
+
+		if index >= self.__max_iters:
+			logging.info("\t> Too many iterations")
+			return False
+
+		if self.frozen_now is None:
+			logging.info("\t> No estimate yet, proceed to next iteration")
+			return True
+
+		if self.is_diverging():
+			logging.info("\t> Memory is dirtied faster than transferred")
+			return False
+
+		if self.frozen_next >= self.frozen_now * (1 - min_gain):
+			logging.info("\t> Next iteration won't shorten freeze")
+			return False
+
+		logging.info("\t> Proceed to next iteration")
+		return True
+
+	def __fmt_rate(self, rate):
+		if rate is None:
+			return "unknown"
+		return "%d pages/s (~%.2lf Mb/s)" % (rate,
+			rate * self.__page_size / 1048576.)
+
+	def __fmt_time(self, t):
+		if t is None:
+			return "unknown"
+		return "%.3lf sec" % t
@@ -9,6 +9,7 @@ import re
 import subprocess
 import logging
 import util
+import trace
 import pycriu
 import criu_req
 
@@ -29,7 +30,9 @@ class criu_conn:
 		self._iter = 0
 		self.verb = def_verb
 		self._track_mem = True
+		self._lazy_pages = False
 		self._shell_job = False
+		self.metrics = None
 		css = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
 		util.set_cloexec(css[1])
 		logging.info("Passing (ctl:%d, data:%d) pair to CRIU", css[0].fileno(), mem_sk.fileno())
@@ -63,18 +66,25 @@ class criu_conn:
 		req.opts.log_file = self.get_log_name(req.type)
 		req.opts.track_mem = self._track_mem
 		req.opts.shell_job = self._shell_job
-		self._cs.send(req.SerializeToString())
-		self._iter += 1
-		self._last_req = req.type
+		with trace.span("criu " + criu_req.get_name(req.type), "criu"):
+			self._cs.send(req.SerializeToString())
+			self._iter += 1
+			self._last_req = req.type
 
-		return self._recv_resp()
+			return self._recv_resp()
 
 	def ack_notify(self, success = True):
+		self.send_notify_ack(success)
+		return self._recv_resp()
+
+	def send_notify_ack(self, success = True):
+		"""Ack notify, response is to be got with recv_resp"""
 		req = pycriu.rpc.criu_req()
 		req.type = pycriu.rpc.NOTIFY
 		req.notify_success = True
 		self._cs.send(req.SerializeToString())
 
+	def recv_resp(self):
 		return self._recv_resp()
 
 	def get_log_name(self, req_type):
@@ -83,6 +93,42 @@ class criu_conn:
 	def memory_tracking(self, value):
 		self._track_mem = value
 
+	def set_metrics(self, metrics):
+		"""Record phases of requests to metrics collector"""
+		self.metrics = metrics
+
+	def lazy_pages(self, value):
+		self._lazy_pages = value
+
+	def is_lazy(self):
+		return self._lazy_pages
+
+
+class lazy_pages_daemon:
+	"""CRIU lazy-pages daemon fetching pages of restored tree
+
+	Pages are requested from source criu over memory socket, on fault and
+	in background, daemon exits once all of them are fetched.
+	"""
+
+	def __init__(self, img, mem_sk, verb):
+		logging.info("Starting lazy-pages daemon on data:%d", mem_sk.fileno())
+		self._proc = subprocess.Popen([criu_binary, "lazy-pages",
+			"--page-server", "--ps-socket", "%d" % mem_sk.fileno(),
+			"-D", img.image_dir(), "-W", img.work_dir(),
+			"-o", "criu_lazy-pages.log", "-v%d" % verb])
+
+	def wait(self):
+		if self._proc.wait() != 0:
+			raise Exception("Lazy pages daemon failed (%d)" %
+				self._proc.returncode)
+
+	def kill(self):
+		if self._proc.poll() is None:
+			logging.info("Killing lazy-pages daemon")
+			self._proc.kill()
+			self._proc.wait()
+
 
 def get_criu_version():
 	proc = subprocess.Popen([criu_binary, "-V"],
@@ -2,15 +2,18 @@
 # Generic functionality for p.haul modules
 #
 
+import time
 import logging
+import contextlib
 import pycriu.rpc
 import criu_req
 
 
-def criu_predump(pid, img, criu_connection, fs):
+def criu_predump(pid, img, criu_connection, fs, local=False):
 	logging.info("\tIssuing pre-dump command to service")
-	req = criu_req.make_predump_req(pid, img, criu_connection, fs)
-	resp = criu_connection.send_req(req)
+	req = criu_req.make_predump_req(pid, img, criu_connection, fs, local)
+	with _phase(criu_connection, "criu pre-dump"):
+		resp = criu_connection.send_req(req)
 	if not resp.success:
 		raise Exception("Pre-dump failed")
 
@@ -18,7 +21,31 @@ def criu_predump(pid, img, criu_connection, fs):
 def criu_dump(htype, pid, img, criu_connection, fs):
 	logging.info("\tIssuing dump command to service")
 	req = criu_req.make_dump_req(pid, htype, img, criu_connection, fs)
-	resp = criu_connection.send_req(req)
+	_wait_post_dump(htype, criu_connection, criu_connection.send_req(req))
+
+
+def criu_lazy_dump(htype, pid, img, criu_connection, fs):
+	"""Dump tree without pages, leave them to be served lazily"""
+	logging.info("\tIssuing lazy dump command to service")
+	req = criu_req.make_lazy_dump_req(pid, htype, img, criu_connection, fs)
+	_wait_post_dump(htype, criu_connection, criu_connection.send_req(req))
+
+
+def _phase(criu_connection, name):
+	"""Record phase to metrics collector of connection, if it has one"""
+	if criu_connection.metrics:
+		return criu_connection.metrics.phase(name)
+	return _no_phase()
+
+
+@contextlib.contextmanager
+def _no_phase():
+	yield
+
+
+def _wait_post_dump(htype, criu_connection, resp):
+	# Tasks are frozen and dumped between request and post-dump notify
+	start = time.time()
 	while True:
 		if resp.type != pycriu.rpc.NOTIFY:
 			raise Exception("Dump failed")
@@ -29,12 +56,17 @@ def criu_dump(htype, pid, img, criu_connection, fs):
 			# waits for us to do whatever we want
 			# and keeps the tasks frozen.
 			#
+			if criu_connection.metrics:
+				criu_connection.metrics.add_phase("criu dump", start,
+					time.time())
 			break
 
 		elif resp.notify.script == "network-lock":
-			htype.net_lock()
+			with _phase(criu_connection, "network lock"):
+				htype.net_lock()
 		elif resp.notify.script == "network-unlock":
-			htype.net_unlock()
+			with _phase(criu_connection, "network unlock"):
+				htype.net_unlock()
 
 		logging.info("\t\tNotify (%s)", resp.notify.script)
 		resp = criu_connection.ack_notify()
@@ -43,11 +75,16 @@ def criu_dump(htype, pid, img, criu_connection, fs):
 def criu_restore(htype, img, connection):
 	"""Perform final restore"""
 
-	nroot = htype.mount()
+	with _phase(connection, "mount"):
+		nroot = htype.mount()
 	if nroot:
 		logging.info("Restore root set to %s", nroot)
 
-	req = criu_req.make_restore_req(htype, img, nroot)
+	if connection.is_lazy():
+		req = criu_req.make_lazy_restore_req(htype, img, nroot)
+	else:
+		req = criu_req.make_restore_req(htype, img, nroot)
+	start = time.time()
 	resp = connection.send_req(req)
 	while True:
 		if resp.type == pycriu.rpc.NOTIFY:
@@ -60,9 +97,11 @@ def criu_restore(htype, img, connection):
 				# to configure namespace (external net
 				# devices) and cgroups
 				#
-				htype.prepare_ct(resp.notify.pid)
+				with _phase(connection, "setup namespaces"):
+					htype.prepare_ct(resp.notify.pid)
 			elif resp.notify.script == "network-unlock":
-				htype.net_unlock()
+				with _phase(connection, "network unlock"):
+					htype.net_unlock()
 			elif resp.notify.script == "network-lock":
 				raise Exception("Locking network on restore?")
 
@@ -73,4 +112,7 @@ def criu_restore(htype, img, connection):
 			raise Exception("Restore failed")
 		break
 
+	if connection.metrics:
+		connection.metrics.add_phase("criu restore", start, time.time())
+
 	htype.restored(resp.restore.pid)
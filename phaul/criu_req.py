@@ -66,10 +66,17 @@ def _make_common_dump_req(typ, pid, htype, img, connection, fs):
 	return req
 
 
-def make_predump_req(pid, img, connection, fs):
-	"""Prepare pre-dump criu request (source side)"""
-	return _make_common_dump_req(
+def make_predump_req(pid, img, connection, fs, local=False):
+	"""Prepare pre-dump criu request (source side)
+
+	Local pre-dump keeps pages in images dir instead of sending them to
+	page server.
+	"""
+	req = _make_common_dump_req(
 		pycriu.rpc.PRE_DUMP, pid, None, img, connection, fs)
+	if local:
+		req.opts.ClearField("ps")
+	return req
 
 
 def make_dump_req(pid, htype, img, connection, fs):
@@ -85,6 +92,17 @@ def make_dump_req(pid, htype, img, connection, fs):
 	return req
 
 
+def make_lazy_dump_req(pid, htype, img, connection, fs):
+	"""Prepare dump criu request leaving pages to be served lazily
+
+	After post-dump notify is acked criu serves pages over memory socket
+	until target fetches all of them.
+	"""
+	req = make_dump_req(pid, htype, img, connection, fs)
+	req.opts.lazy_pages = True
+	return req
+
+
 def make_page_server_req(img, connection):
 	"""Prepare page server criu request (destination side)"""
 
@@ -129,6 +147,13 @@ def make_restore_req(htype, img, nroot):
 	return req
 
 
+def make_lazy_restore_req(htype, img, nroot):
+	"""Prepare restore criu request with pages fetched by lazy-pages daemon"""
+	req = make_restore_req(htype, img, nroot)
+	req.opts.lazy_pages = True
+	return req
+
+
 def make_dirty_tracking_req(img):
 	"""Check if dirty memory tracking is supported."""
 	req = _make_req(pycriu.rpc.FEATURE_CHECK)
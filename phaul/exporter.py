@@ -0,0 +1,136 @@
+#
+# Prometheus metrics of p.haul-service
+#
+# Counters are kept in process wide registry and updated by service and
+# receivers as migrations go. If enabled, they are served in Prometheus
+# text format over HTTP, on localhost unless asked otherwise.
+#
+
+import logging
+import threading
+import BaseHTTPServer
+import SocketServer
+
+def_metrics_addr = "127.0.0.1"
+
+content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+# Restore time histogram buckets in seconds
+restore_buckets = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class counter:
+	def __init__(self, name, help_text, typ="counter"):
+		self.name = name
+		self.help = help_text
+		self.type = typ
+		self.__value = 0
+		self.__lock = threading.Lock()
+
+	def inc(self, value=1):
+		with self.__lock:
+			self.__value += value
+
+	def dec(self, value=1):
+		self.inc(-value)
+
+	def samples(self):
+		with self.__lock:
+			return [(self.name, None, self.__value)]
+
+
+class gauge(counter):
+	def __init__(self, name, help_text):
+		counter.__init__(self, name, help_text, "gauge")
+
+
+class histogram:
+	def __init__(self, name, help_text, buckets):
+		self.name = name
+		self.help = help_text
+		self.type = "histogram"
+		self.__buckets = buckets
+		self.__counts = [0] * len(buckets)
+		self.__count = 0
+		self.__sum = 0.0
+		self.__lock = threading.Lock()
+
+	def observe(self, value):
+		with self.__lock:
+			for i, bound in enumerate(self.__buckets):
+				if value <= bound:
+					self.__counts[i] += 1
+			self.__count += 1
+			self.__sum += value
+
+	def samples(self):
+		with self.__lock:
+			samples = [(self.name + "_bucket", 'le="%g"' % bound, count)
+				for bound, count in zip(self.__buckets, self.__counts)]
+			samples.append((self.name + "_bucket", 'le="+Inf"', self.__count))
+			samples.append((self.name + "_count", None, self.__count))
+			samples.append((self.name + "_sum", None, self.__sum))
+			return samples
+
+
+migrations_started = counter("phaul_migrations_started_total",
+	"Migrations which started final iteration on this host")
+migrations_succeeded = counter("phaul_migrations_succeeded_total",
+	"Migrations restored or started on this host")
+migrations_failed = counter("phaul_migrations_failed_total",
+	"Migrations disconnected after final iteration started, before restore")
+restore_time = histogram("phaul_restore_seconds",
+	"Time criu spent restoring trees", restore_buckets)
+image_bytes = counter("phaul_image_bytes_received_total",
+	"Bytes of images received")
+ploop_bytes = counter("phaul_ploop_bytes_received_total",
+	"Bytes of ploop deltas received")
+sessions = gauge("phaul_sessions", "Migration sessions connected now")
+
+_metrics = (migrations_started, migrations_succeeded, migrations_failed,
+	restore_time, image_bytes, ploop_bytes, sessions)
+
+
+def render():
+	"""Return all metrics in Prometheus text format"""
+	lines = []
+	for metric in _metrics:
+		lines.append("# HELP %s %s" % (metric.name, metric.help))
+		lines.append("# TYPE %s %s" % (metric.name, metric.type))
+		for name, labels, value in metric.samples():
+			if labels:
+				name = "%s{%s}" % (name, labels)
+			lines.append("%s %s" % (name, repr(float(value))))
+	return "\n".join(lines) + "\n"
+
+
+class _metrics_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path.split("?")[0] not in ("/", "/metrics"):
+			self.send_error(404)
+			return
+
+		body = render()
+		self.send_response(200)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, fmt, *args):
+		# Scrapes come every few seconds, don't flood the log
+		pass
+
+
+class _metrics_server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+
+def start_http_server(port, addr=def_metrics_addr):
+	"""Serve metrics in background thread"""
+	server = _metrics_server((addr, port), _metrics_handler)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	logging.info("Serving metrics on %s:%d", addr, port)
+	return server
@@ -9,6 +9,7 @@ import threading
 import libploop
 import mstats
 import iters
+import exporter
 
 
 DDXML_FILENAME = "DiskDescriptor.xml"
@@ -34,6 +35,14 @@ def get_delta_abspath(delta_path, ct_priv):
 		return os.path.join(ct_priv, delta_path)
 
 
+def discard_partial_deltas(deltas):
+	"""Remove active deltas received partially by interrupted migration"""
+	for delta_path, delta_fd in deltas:
+		if os.path.isfile(delta_path):
+			logging.info("Removing partial delta %s", delta_path)
+			os.unlink(delta_path)
+
+
 def merge_ploop_snapshot(ddxml, guid):
 	libploop.snapshot(ddxml).delete(guid)
 
@@ -199,5 +208,8 @@ class delta_receiver(threading.Thread):
 	def run(self):
 		try:
 			libploop.ploopcopy_receiver(self.__path, self.__fd)
+			# libploop doesn't report traffic, delta size is its lower
+			# bound as blocks rewritten between iterations count once
+			exporter.ploop_bytes.inc(os.path.getsize(self.__path))
 		except:
 			logging.exception("Exception in %s delta receiver", self.__path)
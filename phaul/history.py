@@ -0,0 +1,148 @@
+#
+# History of migrations of every haul
+#
+# Outcome and iterations of every migration are kept in sqlite database
+# next to images. Next migration of the same haul seeds convergence
+# estimates with rates measured before and skips pre-dumps if they
+# didn't shorten final dump lately.
+#
+
+import os
+import sqlite3
+import logging
+import converge
+import util
+
+history_file = "history.db"
+
+# Seconds to wait for database locked by another migration
+lock_timeout = 30.0
+
+# Rates are averaged over pre-dumps of this many latest migrations
+rates_depth = 3
+
+# Pre-dumps are skipped if they didn't help in this many migrations with
+# pre-dumps among the latest predump_reprobe_runs ones, so they are tried
+# again once migrations without them push older ones out of that window
+predump_useless_runs = 3
+predump_reprobe_runs = 5
+
+_schema = (
+	"CREATE TABLE IF NOT EXISTS migrations ("
+	"id INTEGER PRIMARY KEY, haul TEXT, mode TEXT, status TEXT, "
+	"start REAL, end REAL, nr_pre_dumps INTEGER, first_pages INTEGER, "
+	"final_pages INTEGER, downtime REAL, img_bytes INTEGER, "
+	"fs_bytes INTEGER)",
+	"CREATE TABLE IF NOT EXISTS iterations ("
+	"migration INTEGER, idx INTEGER, final INTEGER, pages_written INTEGER, "
+	"pages_skipped INTEGER, frozen_time REAL, duration REAL, "
+	"dirty_rate REAL, bandwidth REAL, fs_bytes INTEGER)",
+	"CREATE INDEX IF NOT EXISTS migrations_haul ON migrations (haul, mode)",
+)
+
+
+def haul_key(p_type):
+	return "%s:%s" % tuple(p_type)
+
+
+def _pre_dumped(row):
+	"""Migration did pre-dumps and both first and final dump are known"""
+	if not row["nr_pre_dumps"]:
+		return False
+	return None not in (row["first_pages"], row["final_pages"])
+
+
+class history_db:
+	def __init__(self, img_path):
+		util.makedirs(img_path)
+		self.__db = sqlite3.connect(os.path.join(img_path, history_file),
+			timeout=lock_timeout)
+		self.__db.row_factory = sqlite3.Row
+		with self.__db:
+			for statement in _schema:
+				self.__db.execute(statement)
+
+	def close(self):
+		self.__db.close()
+
+	def record(self, key, mode, status, doc, iter_history):
+		"""Remember migration
+
+		doc is metrics document of migration, iter_history is list of
+		policy iter_stats of its pre-dumps.
+		"""
+
+		values = doc["values"]
+		iterations = doc["iterations"]
+		by_index = dict((stats.index, stats) for stats in iter_history)
+		nr_pre_dumps = len(iter_history) if iterations else 0
+		first_pages = None
+		final_pages = None
+		if iterations:
+			first_pages = iterations[0].get("pages_written")
+			final_pages = iterations[-1].get("pages_written")
+		img_bytes = sum(x["bytes_out"] for x in values.get("img_xfer", []))
+		fs_bytes = sum(i.get("fs_bytes_xferred", 0) for i in iterations)
+
+		with self.__db:
+			cur = self.__db.execute("INSERT INTO migrations (haul, mode, "
+				"status, start, end, nr_pre_dumps, first_pages, final_pages, "
+				"downtime, img_bytes, fs_bytes) "
+				"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+				(key, mode, status, doc["start"], doc.get("end"), nr_pre_dumps,
+				first_pages, final_pages, values.get("downtime"), img_bytes,
+				fs_bytes))
+			migration = cur.lastrowid
+
+			for i in iterations:
+				stats = by_index.get(i["index"])
+				frozen_time = i.get("frozen_time")
+				self.__db.execute("INSERT INTO iterations VALUES "
+					"(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+					(migration, i["index"], int(stats is None),
+					i.get("pages_written"), i.get("pages_skipped_parent"),
+					frozen_time / 1000000. if frozen_time else None,
+					stats.duration if stats else None,
+					stats.dirty_rate if stats else None,
+					stats.bandwidth if stats else None,
+					i.get("fs_bytes_xferred")))
+
+	def __recent(self, key, mode, limit):
+		return self.__db.execute("SELECT * FROM migrations WHERE haul = ? "
+			"AND mode = ? AND status = 'succeeded' ORDER BY id DESC LIMIT ?",
+			(key, mode, limit)).fetchall()
+
+	def rates(self, key, mode):
+		"""Return average dirty rate in pages per second and bandwidth in
+		bytes per second of recent pre-dumps, None if not known"""
+
+		ids = [row["id"] for row in self.__recent(key, mode, rates_depth)]
+		if not ids:
+			return None
+
+		row = self.__db.execute("SELECT AVG(dirty_rate), AVG(bandwidth) "
+			"FROM iterations WHERE migration IN (%s) AND final = 0 "
+			"AND dirty_rate IS NOT NULL AND bandwidth IS NOT NULL" %
+			", ".join("?" * len(ids)), ids).fetchone()
+		if row[0] is None or not row[1]:
+			return None
+		return row[0], row[1]
+
+	def pre_dumps_help(self, key, mode):
+		"""Tell whether pre-dumps shortened final dump lately
+
+		They did if final dump wrote noticeably less than the first
+		pre-dump. Unknown history counts as helpful.
+		"""
+
+		rows = self.__recent(key, mode, predump_reprobe_runs)
+		rows = [row for row in rows if _pre_dumped(row)]
+		if len(rows) < predump_useless_runs:
+			return True
+
+		for row in rows[:predump_useless_runs]:
+			if row["final_pages"] < row["first_pages"] * (1 - converge.min_gain):
+				return True
+		logging.info("\t`- Pre-dumps didn't help in %d recent migrations",
+			predump_useless_runs)
+		return False
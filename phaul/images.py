@@ -3,14 +3,21 @@
 #
 
 import os
+import stat
+import errno
+import select
+import struct
 import tempfile
-import tarfile
 import time
 import shutil
 import threading
+import Queue
 import logging
 import util
 import criu_api
+import compression
+import img_store
+import exporter
 
 def_path = "/var/local/p.haul-fs/"
 
@@ -33,37 +40,335 @@ class opendir:
 		return self._dirfd
 
 
-class untar_thread(threading.Thread):
-	def __init__(self, sk, tdir):
+# Image stream consists of batches. Each batch starts with the number of
+# files in it followed by (name length, mode, size) headers with names and
+# then by bodies of all these files. Empty batch terminates the stream.
+# Flags in the mode field tell that image digest follows the name and
+# either the file should be put into target image store, or it has no
+# body and is to be taken from the store.
+img_batch_hdr = struct.Struct("!I")
+img_file_hdr = struct.Struct("!HIQ")
+
+IMG_F_DIGEST = 0x10000
+IMG_F_LINK = 0x20000
+IMG_F_MASK = IMG_F_DIGEST | IMG_F_LINK
+
+# Maximum number of file headers in one batch
+img_batch_max = 256
+
+img_recv_buf = 0x100000
+
+# Transfers smaller than this are too short to estimate link bandwidth
+link_probe_min_bytes = 0x100000
+
+# Threads taking digests of images for dedup
+img_digest_workers = 4
+
+
+def _split_by_size(cdir, imgs, nr_streams):
+	"""Distribute (name, path) images over streams balancing total size"""
+
+	sized = []
+	for img, path in imgs:
+		size = os.path.getsize(path or os.path.join(cdir, img))
+		sized.append((size, img, path))
+	sized.sort(reverse=True)
+
+	streams = [[] for i in range(nr_streams)]
+	loads = [0] * nr_streams
+	for size, img, path in sized:
+		i = loads.index(min(loads))
+		streams[i].append((img, path))
+		loads[i] += size
+	return streams
+
+
+class img_receiver(threading.Thread):
+	"""Receive image stream and write files into directory"""
+
+	def __init__(self, sk, tdir, store=None):
 		threading.Thread.__init__(self)
 		self.__sk = sk
+		self.__source = None
 		self.__dir = tdir
+		self.__store = store
+		self.__buf = bytearray(img_recv_buf)
+		self.bytes_received = 0
+		self.missing = []
+		self.failed = False
 
 	def run(self):
 		try:
-			tf_fileobj = util.tarfile_fileobj_wrap(self.__sk)
-			tf = tarfile.open(mode="r|", fileobj=tf_fileobj)
-			tf.extractall(self.__dir)
-			tf.close()
-			tf_fileobj.discard_unread_input()
-		except:
-			logging.exception("Exception in untar_thread")
-
-
-class img_tar:
-	def __init__(self, sk, dirname):
-		tf_fileobj = util.tarfile_fileobj_wrap(sk)
-		self.__tf = tarfile.open(mode="w|", fileobj=tf_fileobj)
+			self.__source = compression.stream_source(self.__sk)
+			while self.__recv_batch():
+				pass
+			self.__source.finish()
+		except Exception:
+			self.failed = True
+			logging.exception("Exception in img_receiver")
+
+	def __recv_batch(self):
+		count, = img_batch_hdr.unpack(self.__recv_exact(img_batch_hdr.size))
+		if count == 0:
+			return False
+
+		files = []
+		for i in range(count):
+			name_len, mode, size = img_file_hdr.unpack(
+				self.__recv_exact(img_file_hdr.size))
+			name = self.__recv_exact(name_len)
+			if "/" in name or name in (".", ".."):
+				raise Exception("Bad image name %s" % name)
+			flags = mode & IMG_F_MASK
+			digest = None
+			if flags:
+				if not self.__store:
+					raise Exception("Image %s digest without store" % name)
+				digest = self.__recv_exact(img_store.digest_size)
+			files.append((name, mode & ~IMG_F_MASK, size, flags, digest))
+
+		for name, mode, size, flags, digest in files:
+			path = os.path.join(self.__dir, name)
+			self.__unlink(path)
+			if flags & IMG_F_LINK:
+				if not self.__store.materialize(digest, path):
+					self.missing.append(name)
+				continue
+
+			self.__recv_file(path, mode, size)
+			exporter.image_bytes.inc(size)
+			if flags & IMG_F_DIGEST:
+				self.__store.add(digest, path)
+		return True
+
+	def __unlink(self, path):
+		"""Existing file may be a link to image in store, don't write to it"""
+		try:
+			os.unlink(path)
+		except OSError as e:
+			if e.errno != errno.ENOENT:
+				raise
+
+	def __recv_file(self, path, mode, size):
+		view = memoryview(self.__buf)
+		fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+		try:
+			while size > 0:
+				nread = self.__source.recv_into(view, min(size, len(view)))
+				if nread == 0:
+					raise Exception("Image stream truncated")
+				nwritten = 0
+				while nwritten < nread:
+					nwritten += os.write(fd, view[nwritten:nread])
+				size -= nread
+				self.bytes_received += nread
+		finally:
+			os.close(fd)
+
+	def __recv_exact(self, size):
+		return self.__source.recv_exact(size)
+
+
+class img_sender:
+	"""Send image files to img_receiver
+
+	Without compression file bodies go with sendfile. If set of digests
+	known to target is given, digests of images are taken by pool as soon
+	as they are added and images target already has are sent as links.
+	Sending doesn't wait for hashing, image whose digest isn't ready by
+	its batch is sent as is.
+	"""
+
+	def __init__(self, sk, dirname, codec=compression.CODEC_NONE, level=0,
+			known_digests=None, digest_pool=None):
+		self.__sink = compression.stream_sink(sk, codec, level)
 		self.__dir = dirname
+		self.__files = []
+		self.__known = known_digests
+		self.__pool = digest_pool
+		self.files_linked = 0
+		self.bytes_linked = 0
 
 	def add(self, img, path = None):
 		if not path:
 			path = os.path.join(self.__dir, img)
 
-		self.__tf.add(path, img)
+		digest_task = None
+		if self.__known is not None and img_store.is_dedup_candidate(img):
+			digest_task = self.__pool.submit(img_store.image_digest, path)
+
+		self.__files.append((img, path, digest_task))
+
+	def flush(self):
+		"""Send images added so far"""
+		for i in range(0, len(self.__files), img_batch_max):
+			self.__send_batch(self.__files[i:i + img_batch_max])
+		self.__files = []
+		self.__sink.flush()
 
 	def close(self):
-		self.__tf.close()
+		self.flush()
+		self.__sink.write(img_batch_hdr.pack(0))
+		self.__sink.finish()
+
+	def bytes_in(self):
+		return self.__sink.bytes_in
+
+	def bytes_out(self):
+		return self.__sink.bytes_out
+
+	def __send_batch(self, files):
+		fds = []
+		try:
+			hdrs = [img_batch_hdr.pack(len(files))]
+			for img, path, digest_task in files:
+				digest, version = None, None
+				if digest_task and digest_task.done():
+					digest, version = digest_task.wait()
+
+				if digest and digest in self.__known:
+					hdrs.append(img_file_hdr.pack(len(img), IMG_F_LINK, 0))
+					hdrs.append(img + digest)
+					self.files_linked += 1
+					self.bytes_linked += version[0]
+					continue
+
+				fd = os.open(path, os.O_RDONLY)
+				st = os.fstat(fd)
+				fds.append((fd, st.st_size))
+
+				# File changed since digest was taken, send it as is
+				if version != (st.st_size, st.st_mtime):
+					digest = None
+
+				flags = IMG_F_DIGEST if digest else 0
+				hdrs.append(img_file_hdr.pack(len(img),
+					stat.S_IMODE(st.st_mode) | flags, st.st_size))
+				hdrs.append(img + (digest or ""))
+			self.__sink.write("".join(hdrs))
+
+			for fd, size in fds:
+				self.__sink.sendfile(fd, size)
+		finally:
+			for fd, size in fds:
+				os.close(fd)
+
+
+class img_streamer:
+	"""Send images to target while CRIU is still writing them
+
+	Directory is watched with inotify and every image closed by CRIU is
+	queued to the least loaded sender. Images changed after being sent are
+	sent again over the same stream on finish, so the target always ends
+	up with their last version.
+	"""
+
+	__watch_mask = util.inotify_watch.IN_CLOSE_WRITE | \
+		util.inotify_watch.IN_MOVED_TO
+
+	def __init__(self, senders, cdir):
+		self.__senders = senders
+		self.__dir = cdir
+		self.__sent = {}
+		self.__loads = [0] * len(senders)
+		self.__queues = [Queue.Queue() for tf in senders]
+		self.__failed = False
+		self.__watch = util.inotify_watch(cdir, self.__watch_mask)
+		self.__stop_r, self.__stop_w = os.pipe()
+		self.__watcher = threading.Thread(target=self.__watch_loop)
+		self.__workers = []
+		for tf, queue in zip(senders, self.__queues):
+			worker = threading.Thread(target=self.__send_loop, args=(tf, queue))
+			self.__workers.append(worker)
+
+	def start(self):
+		for worker in self.__workers:
+			worker.start()
+		self.__watcher.start()
+
+	def finish(self, extra_imgs):
+		"""Send images not sent yet or changed, then close streams"""
+		self.__stop_watch()
+		self.__scan()
+		for img, path in extra_imgs:
+			self.__dispatch(img, path)
+		self.__stop_senders()
+		if self.__failed:
+			raise Exception("Images streaming failed")
+
+	def cancel(self):
+		self.__stop_watch()
+		self.__stop_senders()
+
+	def sent_count(self):
+		return len(self.__sent)
+
+	def __stop_watch(self):
+		os.write(self.__stop_w, "x")
+		self.__watcher.join()
+		self.__watch.close()
+		os.close(self.__stop_r)
+		os.close(self.__stop_w)
+
+	def __stop_senders(self):
+		for queue in self.__queues:
+			queue.put(None)
+		for worker in self.__workers:
+			worker.join()
+
+	def __watch_loop(self):
+		try:
+			# Catch images created before the watch was set up
+			self.__scan()
+			while True:
+				rd, wr, ex = select.select([self.__watch, self.__stop_r], [], [])
+				if self.__stop_r in rd:
+					break
+				for mask, img in self.__watch.read_events():
+					if img.endswith(".img"):
+						self.__dispatch(img, None)
+		except Exception:
+			self.__failed = True
+			logging.exception("Exception in img_streamer")
+
+	def __scan(self):
+		for img in filter(lambda x: x.endswith(".img"), os.listdir(self.__dir)):
+			self.__dispatch(img, None)
+
+	def __dispatch(self, img, path):
+		try:
+			st = os.stat(path or os.path.join(self.__dir, img))
+		except OSError as e:
+			if e.errno == errno.ENOENT:
+				return
+			raise
+
+		version = (st.st_size, st.st_mtime)
+		sent = self.__sent.get(img)
+		if sent:
+			idx, sent_version = sent
+			if sent_version == version:
+				return
+		else:
+			idx = self.__loads.index(min(self.__loads))
+
+		self.__sent[img] = (idx, version)
+		self.__loads[idx] += st.st_size
+		self.__queues[idx].put((img, path))
+
+	def __send_loop(self, tf, queue):
+		try:
+			while True:
+				item = queue.get()
+				if item is None:
+					break
+				tf.add(*item)
+				if queue.empty():
+					tf.flush()
+			tf.close()
+		except Exception:
+			self.__failed = True
+			logging.exception("Exception in img_streamer sender")
 
 
 class phaul_images:
@@ -72,11 +377,22 @@ class phaul_images:
 
 	def __init__(self, typ):
 		self.current_iter = 0
+		self._chain_start = 1
 		self.sync_time = 0.0
 		self._typ = typ
 		self._keep_on_close = False
 		self._wdir = None
 		self._current_dir = None
+		self._compress = compression.CODEC_NONE
+		self._compress_level = 0
+		self._target_codecs = [compression.CODEC_NONE]
+		self._link_bandwidth = None
+		self._xfer_stats = []
+		self._streamer = None
+		self._dedup = False
+		self._store = None
+		self._known_digests = None
+		self._digest_pool = None
 
 	def save_images(self):
 		logging.info("Keeping images")
@@ -84,6 +400,10 @@ class phaul_images:
 
 	def set_options(self, opts):
 		self._keep_on_close = opts["keep_images"]
+		self._compress = opts["compress"]
+		self._compress_level = opts["compress_level"]
+		self._dedup = opts["img_dedup"]
+		self._store_path = os.path.join(opts["img_path"], "cas")
 
 		suf = time.strftime("-%y.%m.%d-%H.%M", time.localtime())
 		util.makedirs(opts["img_path"])
@@ -93,6 +413,10 @@ class phaul_images:
 		os.mkdir(self._img_path)
 
 	def close(self):
+		if self._digest_pool:
+			self._digest_pool.stop()
+			self._digest_pool = None
+
 		if not self._wdir:
 			return
 
@@ -110,6 +434,152 @@ class phaul_images:
 	def img_sync_time(self):
 		return self.sync_time
 
+	def xfer_stats(self):
+		"""Return list of (codec, raw bytes, wire bytes, seconds) per transfer"""
+		return self._xfer_stats
+
+	def set_target_codecs(self, codecs):
+		self._target_codecs = codecs
+		if self._compress in (compression.CODEC_NONE, compression.CODEC_AUTO):
+			return
+		if self._compress not in compression.available_codecs():
+			raise Exception("Codec %s is not available" % self._compress)
+		if self._compress not in codecs:
+			raise Exception("Codec %s is not available on target" %
+				self._compress)
+
+	def __pick_codec(self):
+		if self._compress != compression.CODEC_AUTO:
+			return self._compress, self._compress_level
+
+		codecs = filter(lambda c: c in self._target_codecs,
+			compression.available_codecs())
+		return compression.choose_codec(codecs, self._link_bandwidth)
+
+	def set_known_digests(self, digests):
+		"""Dedup images against ones target already has in its store"""
+		self._known_digests = set(digests)
+		if not self._digest_pool:
+			self._digest_pool = util.worker_pool(img_digest_workers)
+		logging.info("Target has %d images in store", len(digests))
+
+	def store_digests(self):
+		"""Return digests of images in store, target side"""
+		store = self.__image_store()
+		store.prune()
+		return store.digests()
+
+	def __image_store(self):
+		if not self._store:
+			self._store = img_store.img_store(self._store_path)
+		return self._store
+
+	def __new_sender(self, sk, cdir, codec, level, dedup=True):
+		known = self._known_digests if dedup else None
+		return img_sender(sk, cdir, codec, level, known, self._digest_pool)
+
+	def __log_dedup(self, senders):
+		linked = sum(tf.files_linked for tf in senders)
+		if linked:
+			logging.info("\tTaken %d images (%d bytes) from target store",
+				linked, sum(tf.bytes_linked for tf in senders))
+
+	def __resend_missing(self, target_host, sks, dir_id, cdir, imgs, missing):
+		"""Images may leave target store while being linked, send them"""
+		logging.info("\t%d images are missing in target store", len(missing))
+		imgs = filter(lambda i: i[0] in missing, imgs)
+		self.__send_images(target_host, sks, dir_id, cdir, imgs, False)
+
+	def __send_images(self, target_host, sks, dir_id, cdir, imgs, dedup=True):
+		"""Send list of (name, path) images to target directory
+
+		Images are spread over sockets in sks balanced by size, each socket
+		is served by its own thread.
+		"""
+
+		codec, level = self.__pick_codec()
+		streams = _split_by_size(cdir, imgs, min(len(sks), len(imgs)) or 1)
+		logging.info("\tSending %d images in %d streams, compression %s:%d",
+			len(imgs), len(streams), codec, level)
+
+		start = time.time()
+		target_host.start_accept_images(dir_id, len(streams))
+		senders = []
+		for sk, stream_imgs in zip(sks, streams):
+			tf = self.__new_sender(sk, cdir, codec, level, dedup)
+			for img, path in stream_imgs:
+				tf.add(img, path)
+			senders.append(tf)
+		util.run_parallel(*[tf.close for tf in senders])
+		missing = target_host.stop_accept_images()
+		duration = time.time() - start
+		self.__log_dedup(senders)
+
+		bytes_in = sum(tf.bytes_in() for tf in senders)
+		bytes_out = sum(tf.bytes_out() for tf in senders)
+		self._xfer_stats.append((codec, bytes_in, bytes_out, duration))
+		if bytes_out >= link_probe_min_bytes:
+			self._link_bandwidth = bytes_out / duration
+
+		if missing:
+			self.__resend_missing(target_host, sks, dir_id, cdir, imgs, missing)
+
+	def start_streaming(self, target_host, sks):
+		"""Start sending images of current directory as they appear
+
+		Sockets in sks must not be used by anything else until images are
+		synced to target, so memory socket busy with page server during
+		dump can't be among them.
+		"""
+
+		codec, level = self.__pick_codec()
+		logging.info("\tStreaming images in %d streams, compression %s:%d",
+			len(sks), codec, level)
+
+		self._stream_start = time.time()
+		self._stream_codec = codec
+		target_host.start_accept_images(phaul_images.IMGDIR, len(sks), False)
+		self._stream_senders = [self.__new_sender(sk, self.image_dir(),
+			codec, level) for sk in sks]
+		self._streamer = img_streamer(self._stream_senders, self.image_dir())
+		self._streamer.start()
+
+	def cancel_streaming(self, target_host):
+		if not self._streamer:
+			return
+
+		logging.info("Cancelling images streaming")
+		self._streamer.cancel()
+		self._streamer = None
+		try:
+			target_host.stop_accept_images()
+		except Exception:
+			logging.exception("Failed to stop images receiving on target")
+
+	def __finish_streaming(self, target_host, sks, extra_imgs):
+		streamer, self._streamer = self._streamer, None
+		start = time.time()
+		try:
+			streamer.finish(extra_imgs)
+		finally:
+			missing = target_host.stop_accept_images()
+		logging.info("\tStreamed %d images, %.2f sec after dump",
+			streamer.sent_count(), time.time() - start)
+		self.__log_dedup(self._stream_senders)
+
+		# Streaming time includes dump, so it doesn't tell link bandwidth
+		senders = self._stream_senders
+		self._xfer_stats.append((self._stream_codec,
+			sum(tf.bytes_in() for tf in senders),
+			sum(tf.bytes_out() for tf in senders),
+			time.time() - self._stream_start))
+
+		if missing:
+			cdir = self.image_dir()
+			imgs = [(img, None) for img in os.listdir(cdir)] + extra_imgs
+			self.__resend_missing(target_host, sks, phaul_images.IMGDIR,
+				cdir, imgs, missing)
+
 	def new_image_dir(self):
 		if self._current_dir:
 			self._current_dir.close()
@@ -119,6 +589,27 @@ class phaul_images:
 		os.mkdir(img_dir)
 		self._current_dir = opendir(img_dir)
 
+	def resume(self, wdir, current_iter, chain):
+		"""Continue in images dir left by interrupted migration
+
+		Images of iterations after current_iter are incomplete and removed.
+		Unless chain is set the next pre-dump has no parent, i.e. it dumps
+		all memory again.
+		"""
+
+		logging.info("Resuming in %s after iteration %d", wdir, current_iter)
+		shutil.rmtree(self._wdir.name())
+		self._wdir.close()
+		self._wdir = opendir(wdir)
+		self._img_path = os.path.join(wdir, "img")
+		self.current_iter = current_iter
+		if not chain:
+			self._chain_start = current_iter + 1
+
+		for name in os.listdir(self._img_path):
+			if name.isdigit() and int(name) > current_iter:
+				shutil.rmtree(os.path.join(self._img_path, name))
+
 	def image_dir_fd(self):
 		return self._current_dir.fileno()
 
@@ -128,19 +619,24 @@ class phaul_images:
 	def image_dir(self):
 		return self._current_dir.name()
 
+	def image_dir_size(self):
+		"""Return total size of images in current directory"""
+		cdir = self.image_dir()
+		return sum(os.path.getsize(os.path.join(cdir, img))
+			for img in os.listdir(cdir))
+
 	def work_dir(self):
 		return self._wdir.name()
 
 	def prev_image_dir(self):
-		if self.current_iter == 1:
+		if self.current_iter <= self._chain_start:
 			return None
 		else:
 			return "../%d" % (self.current_iter - 1)
 
 	# Images transfer
-	# Are there better ways for doing this?
 
-	def sync_imgs_to_target(self, target_host, htype, sk):
+	def sync_imgs_to_target(self, target_host, htype, sks):
 		# Pre-dump doesn't generate any images (yet?)
 		# so copy only those from the top dir
 		logging.info("Sending images to target")
@@ -148,39 +644,50 @@ class phaul_images:
 		start = time.time()
 		cdir = self.image_dir()
 
-		target_host.start_accept_images(phaul_images.IMGDIR)
-		tf = img_tar(sk, cdir)
+		logging.info("\tAdd htype images")
+		himgs = [(himg[1], himg[0]) for himg in htype.get_meta_images(cdir)]
 
-		logging.info("\tPack")
-		for img in filter(lambda x: x.endswith(".img"), os.listdir(cdir)):
-			tf.add(img)
+		if self._streamer:
+			self.__finish_streaming(target_host, sks, himgs)
+			self.sync_time = time.time() - start
+			return
 
-		logging.info("\tAdd htype images")
-		for himg in htype.get_meta_images(cdir):
-			tf.add(himg[1], himg[0])
+		logging.info("\tCollect images")
+		imgs = []
+		for img in filter(lambda x: x.endswith(".img"), os.listdir(cdir)):
+			imgs.append((img, None))
 
-		tf.close()
-		target_host.stop_accept_images()
+		self.__send_images(target_host, sks, phaul_images.IMGDIR, cdir,
+			imgs + himgs)
 
 		self.sync_time = time.time() - start
 
 	def send_cpuinfo(self, target_host, sk):
-		target_host.start_accept_images(phaul_images.WDIR)
-		tf = img_tar(sk, self.work_dir())
-		tf.add(criu_api.cpuinfo_img_name)
-		tf.close()
-		target_host.stop_accept_images()
+		self.__send_images(target_host, [sk], phaul_images.WDIR,
+			self.work_dir(), [(criu_api.cpuinfo_img_name, None)])
 
-	def start_accept_images(self, dir_id, sk):
+	def start_accept_images(self, dir_id, sks):
 		if dir_id == phaul_images.WDIR:
 			dirname = self.work_dir()
 		else:
 			dirname = self.image_dir()
 
-		self.__acc_tar = untar_thread(sk, dirname)
-		self.__acc_tar.start()
-		logging.info("Started images server")
+		store = self.__image_store() if self._dedup else None
+		self.__acc_imgs = []
+		for sk in sks:
+			receiver = img_receiver(sk, dirname, store)
+			receiver.start()
+			self.__acc_imgs.append(receiver)
+		logging.info("Started images server (%d streams)", len(sks))
 
 	def stop_accept_images(self):
-		logging.info("Waiting for images to unpack")
-		self.__acc_tar.join()
+		logging.info("Waiting for images to be received")
+		for receiver in self.__acc_imgs:
+			receiver.join()
+		if any(receiver.failed for receiver in self.__acc_imgs):
+			raise Exception("Images receive failed")
+
+		missing = []
+		for receiver in self.__acc_imgs:
+			missing.extend(receiver.missing)
+		return missing
@@ -0,0 +1,101 @@
+#
+# Content addressed store of images received by target
+#
+# Images are kept as hardlinks named by digest of their content and mode,
+# so an image the target has already seen in earlier migrations is
+# recreated locally instead of being sent again.
+#
+
+import os
+import errno
+import shutil
+import hashlib
+import logging
+import util
+
+# Raw digest length as sent on the wire
+digest_size = hashlib.sha1().digest_size
+
+# Number of entries kept in store, older ones are removed
+store_max_files = 0x2000
+
+
+def image_digest(path):
+	"""Return raw digest of image content and mode with (size, mtime)
+
+	The latter tells whether file is still the one digest was taken of.
+	"""
+	h = hashlib.sha1()
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		st = os.fstat(fd)
+		h.update("%o\0" % (st.st_mode & 0o7777))
+		while True:
+			data = os.read(fd, 0x100000)
+			if not data:
+				break
+			h.update(data)
+	finally:
+		os.close(fd)
+	return h.digest(), (st.st_size, st.st_mtime)
+
+
+def is_dedup_candidate(img):
+	"""Page images differ between dumps, don't waste time on hashing them"""
+	return not img.startswith("pages-")
+
+
+class img_store:
+	def __init__(self, path):
+		util.makedirs(path)
+		self.__path = path
+
+	def digests(self):
+		"""Return raw digests of all stored images"""
+		digests = []
+		for name in os.listdir(self.__path):
+			try:
+				digests.append(name.decode("hex"))
+			except TypeError:
+				pass
+		return digests
+
+	def add(self, digest, path):
+		"""Remember image at path under its digest"""
+		try:
+			os.link(path, self.__entry(digest))
+		except OSError as e:
+			if e.errno not in (errno.EEXIST, errno.EXDEV):
+				raise
+
+	def materialize(self, digest, path):
+		"""Create image with given digest at path, False if it's unknown"""
+		entry = self.__entry(digest)
+		try:
+			os.link(entry, path)
+		except OSError as e:
+			if e.errno == errno.ENOENT:
+				return False
+			elif e.errno != errno.EXDEV:
+				raise
+			shutil.copy2(entry, path)
+
+		# Keep recently used entries from being pruned
+		os.utime(entry, None)
+		return True
+
+	def prune(self, max_files=store_max_files):
+		entries = []
+		for name in os.listdir(self.__path):
+			path = os.path.join(self.__path, name)
+			entries.append((os.stat(path).st_mtime, path))
+		if len(entries) <= max_files:
+			return
+
+		entries.sort()
+		logging.info("Pruning %d images from store", len(entries) - max_files)
+		for mtime, path in entries[:len(entries) - max_files]:
+			os.unlink(path)
+
+	def __entry(self, digest):
+		return os.path.join(self.__path, digest.encode("hex"))
@@ -2,8 +2,15 @@
 # The P.HAUL core -- the class that drives migration
 #
 
+import time
 import logging
+import resource
 import images
+import converge
+import policy
+import session
+import trace
+import history
 import mstats
 import xem_rpc_client
 import criu_api
@@ -11,11 +18,14 @@ import criu_cr
 import criu_req
 import htype
 import errno
+import util
 
 
 MIGRATION_MODE_LIVE = "live"
 MIGRATION_MODE_RESTART = "restart"
-MIGRATION_MODES = (MIGRATION_MODE_LIVE, MIGRATION_MODE_RESTART)
+MIGRATION_MODE_LAZY = "lazy"
+MIGRATION_MODES = (MIGRATION_MODE_LIVE, MIGRATION_MODE_RESTART,
+	MIGRATION_MODE_LAZY)
 
 PRE_DUMP_AUTO_DETECT = None
 PRE_DUMP_DISABLE = False
@@ -32,25 +42,34 @@ def is_restart_mode(mode):
 	return mode == MIGRATION_MODE_RESTART
 
 
-class iter_consts:
-	"""Constants for iterations management"""
+def is_lazy_mode(mode):
+	"""Check is migration running in lazy (post-copy) mode"""
+	return mode == MIGRATION_MODE_LAZY
 
-	# Maximum number of iterations
-	MAX_ITERS_COUNT = 8
 
-	# Minimum count of dumped pages needed to continue iteration
-	MIN_ITER_PAGES_COUNT = 64
+def is_dump_mode(mode):
+	"""Check is process tree migrated with criu dump and restore"""
+	return is_live_mode(mode) or is_lazy_mode(mode)
 
-	# Minimum count of transferred fs bytes needed to continue iteration
-	MIN_ITER_FS_XFER_BYTES = 0x100000
 
-	# Maximum acceptable iteration grow rate in percents
-	MAX_ITER_GROW_RATE = 10
+class dry_run_consts:
+	"""Constants for dry run measurements"""
+
+	# Number of local pre-dumps done in dry run
+	DRY_RUN_PRE_DUMPS = 2
+
+	# Number of round trips measured in dry run, the fastest one is used
+	DRY_RUN_RTT_PROBES = 5
+
+	# Amount of data sent to target to measure bandwidth in dry run
+	DRY_RUN_PROBE_SIZE = 0x4000000
 
 
 class phaul_iter_worker:
 	def __init__(self, p_type, dst_id, mode, connection):
 		self.__mode = mode
+		self.__p_type = p_type
+		self.__session = None
 		self.connection = connection
 		self.target_host = xem_rpc_client.rpc_proxy(self.connection.rpc_sk)
 
@@ -62,12 +81,20 @@ class phaul_iter_worker:
 		self.fs = self.htype.get_fs(self.connection.fdfs)
 		if not self.fs:
 			raise Exception("No FS driver found")
+		self.fs = trace.traced_calls(self.fs, "fs",
+			("start_migration", "next_iteration", "stop_migration"))
 
 		self.img = None
 		self.criu_connection = None
-		if is_live_mode(self.__mode):
+		self.downtime = None
+		self.__final_lock = None
+		self.__final_locked = False
+		self.__history = None
+		self.__metrics = mstats.metrics_collector()
+		if is_dump_mode(self.__mode):
 			self.img = images.phaul_images("dmp")
 			self.criu_connection = criu_api.criu_conn(self.connection.mem_sk)
+			self.criu_connection.set_metrics(self.__metrics)
 
 		logging.info("Setting up remote")
 		p_dst_type = (p_type[0], dst_id if dst_id else p_type[1])
@@ -76,18 +103,42 @@ class phaul_iter_worker:
 	def get_target_host(self):
 		return self.target_host
 
+	def set_final_lock(self, lock):
+		"""Call lock.acquire(worker) before final dump and release(worker)
+		once tree runs on target or migration fails
+
+		Used by batch migration to keep final dumps of different hauls
+		from competing for the link.
+		"""
+		self.__final_lock = lock
+
 	def set_options(self, opts):
 		self.__force = opts["force"]
 		self.__skip_cpu_check = opts["skip_cpu_check"]
 		self.__skip_criu_check = opts["skip_criu_check"]
 		self.__pre_dump = opts["pre_dump"]
+		self.__stream_images = opts["stream_images"]
+		self.__max_downtime = opts["max_downtime"]
+		self.__policy = policy.get_policy(opts["iter_policy"], opts)
+		self.__dry_run = opts["dry_run"]
+		self.__resume = opts["resume"]
+		self.__img_path = opts["img_path"]
+		self.__metrics_file = opts["metrics_file"]
+		self.__trace_file = opts["trace_file"]
+		if self.__trace_file:
+			trace.enable("p.haul")
+		self.__no_history = opts["no_history"]
+		self.target_host.set_slow_threshold(opts["rpc_slow_threshold"])
 		self.htype.set_options(opts)
 		self.fs.set_options(opts)
 		if self.img:
 			self.img.set_options(opts)
+			self.img.set_target_codecs(self.target_host.compress_codecs())
 		if self.criu_connection:
 			self.criu_connection.set_options(opts)
-		self.target_host.set_options(opts)
+		self.target_host.call_oneway("set_options", opts)
+		if self.img and opts["img_dedup"]:
+			self.img.set_known_digests(self.target_host.image_digests())
 
 	def __validate_cpu(self):
 		if self.__skip_cpu_check or self.__force:
@@ -140,12 +191,16 @@ class phaul_iter_worker:
 				# Detect is memory tracking supported
 				use_pre_dumps = (self.__check_support_mem_track() and
 					self.htype.can_pre_dump())
-				logging.info("\t`- Auto %s",
-					(use_pre_dumps and "enabled" or "disabled"))
 			except:
 				# Memory tracking auto detection not supported
 				use_pre_dumps = False
 				logging.info("\t`- Auto detection not possible - Disabled")
+			else:
+				# Dry run measures pre-dumps, history can't turn them off
+				if use_pre_dumps and not self.__dry_run:
+					use_pre_dumps = self.__pre_dumps_help()
+				logging.info("\t`- Auto %s",
+					(use_pre_dumps and "enabled" or "disabled"))
 		else:
 			use_pre_dumps = self.__pre_dump
 			logging.info("\t`- Explicitly %s",
@@ -153,14 +208,151 @@ class phaul_iter_worker:
 		self.criu_connection.memory_tracking(use_pre_dumps)
 		return use_pre_dumps
 
+	def __pre_dumps_help(self):
+		if not self.__history:
+			return True
+		try:
+			return self.__history.pre_dumps_help(
+				history.haul_key(self.__p_type), self.__mode)
+		except Exception:
+			logging.exception("Can't read migration history")
+			return True
+
+	def __seed_policy(self):
+		"""Start convergence estimates from rates of earlier migrations"""
+		if not self.__history:
+			return
+		try:
+			rates = self.__history.rates(history.haul_key(self.__p_type),
+				self.__mode)
+		except Exception:
+			logging.exception("Can't read migration history")
+			return
+		if rates:
+			logging.info("Seeding estimates from history: dirty rate %d "
+				"pages/s, bandwidth ~%.2lf Mb/s", rates[0], rates[1] / 1048576.)
+			self.__policy.seed(*rates)
+
+	def __record_history(self, status):
+		if not self.__history:
+			return
+		doc = self.__metrics.document()
+		doc["end"] = time.time()
+		try:
+			self.__history.record(history.haul_key(self.__p_type), self.__mode,
+				status, doc, self.__policy.history)
+		except Exception:
+			logging.exception("Can't record migration history")
+
 	def start_migration(self):
+		if self.__dry_run:
+			logging.info("Start dry run in %s mode", self.__mode)
+			self.__start_dry_run()
+			return
+
+		if not self.__no_history:
+			self.__history = history.history_db(self.__img_path)
+		try:
+			self.__migrate()
+		finally:
+			if self.__history:
+				self.__history.close()
+				self.__history = None
+
+	def __migrate(self):
+		self.__start_session()
 		logging.info("Start migration in %s mode", self.__mode)
-		if is_live_mode(self.__mode):
-			self.__start_live_migration()
-		elif is_restart_mode(self.__mode):
-			self.__start_restart_migration()
-		else:
-			raise Exception("Unknown migration mode")
+
+		# Trace of migration is identified by its session
+		trace_id = self.__session.id if self.__trace_file else None
+		try:
+			with trace.span("migration " + self.__mode, trace_id=trace_id):
+				if is_live_mode(self.__mode):
+					self.__start_live_migration()
+				elif is_restart_mode(self.__mode):
+					self.__start_restart_migration()
+				elif is_lazy_mode(self.__mode):
+					self.__start_lazy_migration()
+				else:
+					raise Exception("Unknown migration mode")
+		except Exception as e:
+			# Don't keep other hauls of batch waiting whatever failed
+			self.__unlock_final()
+			logging.error("Migration failed, it can be resumed with --resume %s",
+				self.__session.id)
+			self.__write_metrics("failed", str(e))
+			self.__write_trace()
+			self.__record_history("failed")
+			raise
+		self.__session.remove()
+		self.__write_metrics("succeeded")
+		self.__write_trace()
+		self.__record_history("succeeded")
+
+	def __write_metrics(self, status, error=None):
+		"""Write metrics of both sides to --metrics-file, if given"""
+		if not self.__metrics_file:
+			return
+
+		try:
+			target = self.target_host.get_metrics()
+		except Exception:
+			# Transport may be what failed the migration
+			logging.exception("Can't get metrics of target host")
+			target = None
+
+		self.__metrics.write(self.__metrics_file, status, error,
+			mode=self.__mode, htype=list(self.__p_type),
+			session=self.__session.id, target=target)
+
+	def __write_trace(self):
+		"""Write spans of both sides to --trace-file, if given"""
+		if not self.__trace_file:
+			return
+
+		events = trace.take_events(self.__session.id)
+		try:
+			start = time.time()
+			remote, remote_now = self.target_host.get_trace(self.__session.id)
+			# Align target clock assuming symmetric link delay
+			offset = (start + time.time()) / 2 - remote_now
+			events += trace.shift_events(remote, offset)
+		except Exception:
+			logging.exception("Can't get trace of target host")
+		trace.write(self.__trace_file, events)
+
+	def __start_session(self):
+		"""Start new migration session or resume interrupted one"""
+
+		if not self.__resume:
+			self.__session = session.session_record(self.__img_path,
+				session.new_session_id())
+			logging.info("Starting migration session %s", self.__session.id)
+			self.target_host.start_session(self.__session.id)
+			self.__save_session(0, True)
+			return
+
+		self.__session = session.session_record(self.__img_path, self.__resume)
+		state = self.__session.load()
+		if state["htype"] != list(self.__p_type) or state["mode"] != self.__mode:
+			raise Exception("Session %s is %s migration of %s" % (
+				self.__session.id, state["mode"], ":".join(state["htype"])))
+
+		logging.info("Resuming migration session %s", self.__session.id)
+		last_iter, chain = self.target_host.resume_session(self.__session.id,
+			state["iter"], state["pending"])
+		if self.img:
+			self.img.resume(state["wdir"], last_iter, chain)
+		if not chain:
+			logging.info("\tLast iteration was interrupted, memory is dumped anew")
+
+		# Pre-dumps chain stays broken until next pre-dump completes
+		self.__save_session(last_iter, chain)
+
+	def __save_session(self, last_iter, chain):
+		self.__session.save(htype=list(self.__p_type), mode=self.__mode,
+			wdir=self.img.work_dir() if self.img else None, iter=last_iter,
+			pending=not chain)
 
 	def __start_live_migration(self):
 		"""
@@ -171,78 +363,87 @@ class phaul_iter_worker:
 		"""
 
 		self.fs.set_work_dir(self.img.work_dir())
-		self.__validate_cpu()
-		self.__validate_criu_version()
+		with self.__metrics.phase("validation"):
+			self.__validate_cpu()
+			self.__validate_criu_version()
 		use_pre_dumps = self.__check_use_pre_dumps()
 		root_pid = self.htype.root_task_pid()
 
-		migration_stats = mstats.live_stats()
+		migration_stats = mstats.live_stats(self.__max_downtime,
+			self.__metrics)
 		migration_stats.handle_start()
 
 		# Handle preliminary FS migration
 		logging.info("Preliminary FS migration")
-		fsstats = self.fs.start_migration()
+		with self.__metrics.phase("fs start"):
+			fsstats = self.fs.start_migration()
 		migration_stats.handle_preliminary(fsstats)
 
-		iter_index = 0
-		prev_dstats = None
-
-		while use_pre_dumps:
-
-			# Handle predump
-			logging.info("* Iteration %d", iter_index)
-			self.target_host.start_iter(True)
-			self.img.new_image_dir()
-			criu_cr.criu_predump(root_pid, self.img, self.criu_connection, self.fs)
-			self.target_host.end_iter()
-
-			# Handle FS migration iteration
-			fsstats = self.fs.next_iteration()
-
-			dstats = criu_api.criu_get_dstats(self.img)
-			migration_stats.handle_iteration(dstats, fsstats)
-
-			# Decide whether we continue iteration or stop and do final dump
-			if not self.__check_live_iter_progress(iter_index, dstats, prev_dstats):
-				break
-
-			iter_index += 1
-			prev_dstats = dstats
+		if use_pre_dumps:
+			self.__seed_policy()
+			try:
+				self.__run_pre_dumps(root_pid, migration_stats)
+			finally:
+				# Criu dumps cgroup limits too, final dump and restored
+				# tree have to run with original quota
+				self.__unthrottle()
 
 		# Dump htype on source and leave its tasks in frozen state
 		logging.info("Final dump and restore")
-		self.target_host.start_iter(self.htype.dump_need_page_server())
-		self.img.new_image_dir()
-		self.htype.final_dump(root_pid, self.img, self.criu_connection, self.fs)
-		self.target_host.end_iter()
+		self.__lock_final()
+		timer = mstats.phase_timer(self.__metrics)
+		try:
+			self.__session.save(pending=True)
+			self.target_host.start_iter(self.htype.dump_need_page_server())
+			self.target_host.call_oneway("prepare_restore")
+			self.img.new_image_dir()
+			if self.__stream_images:
+				self.img.start_streaming(self.target_host,
+					self.connection.img_sks)
+			timer.timed("final dump", lambda: self.htype.final_dump(root_pid,
+				self.img, self.criu_connection, self.fs))()
+			# Rates of final dump don't include sync and restore
+			dump_end = time.time()
+		except:
+			self.img.cancel_streaming(self.target_host)
+			self.__unlock_final()
+			raise
+		self.target_host.call_oneway("end_iter")
 
 		try:
-			# Handle final FS and images sync on frozen htype
+			# Handle final FS and images sync on frozen htype, both go
+			# over their own connections so run them at the same time
 			logging.info("Final FS and images sync")
-			fsstats = self.fs.stop_migration()
-
-			self.img.sync_imgs_to_target(self.target_host, self.htype,
-				self.connection.mem_sk)
+			fsstats, _ = util.run_parallel(
+				timer.timed("fs stop", self.fs.stop_migration),
+				timer.timed("image sync", lambda: self.img.sync_imgs_to_target(
+					self.target_host, self.htype, self.connection.image_sks())))
 
 			# Restore htype on target
 			logging.info("Asking target host to restore")
-			self.target_host.restore_from_images()
+			timer.timed("restore", self.target_host.restore_from_images)()
 			logging.info("Restored on target host")
 		except:
 			self.htype.migration_fail(self.fs)
+			self.__unlock_final()
 			raise
 
+		self.downtime = timer.total()
+		self.__unlock_final()
+
 		# Ack previous dump request to terminate all frozen tasks
 		resp = self.criu_connection.ack_notify()
 		if not resp.success:
 			logging.warning("Bad notification from target host")
 
 		dstats = criu_api.criu_get_dstats(self.img)
-		migration_stats.handle_iteration(dstats, fsstats)
+		migration_stats.handle_iteration(dstats, fsstats, timer, dump_end)
 
 		logging.info("Migration succeeded")
+		self.__unthrottle()
 		self.htype.migration_complete(self.fs, self.target_host)
 		migration_stats.handle_stop(self)
+		self.target_host.log_call_stats()
 		self.img.close()
 		self.criu_connection.close()
 
@@ -254,44 +455,54 @@ class phaul_iter_worker:
 		tree on source host and start it on target host.
 		"""
 
-		migration_stats = mstats.restart_stats()
+		migration_stats = mstats.restart_stats(self.__metrics)
 		migration_stats.handle_start()
 
 		# Handle preliminary FS migration
 		logging.info("Preliminary FS migration")
-		fsstats = self.fs.start_migration()
+		with self.__metrics.phase("fs start"):
+			fsstats = self.fs.start_migration()
 		migration_stats.handle_preliminary(fsstats)
 
 		iter_index = 0
-		prev_fsstats = None
-
-		while True:
-
-			# Handle FS migration iteration
-			logging.info("* Iteration %d", iter_index)
-			fsstats = self.fs.next_iteration()
-			migration_stats.handle_iteration(fsstats)
-
-			# Decide whether we continue iteration or stop and do final sync
-			if not self.__check_restart_iter_progress(iter_index, fsstats, prev_fsstats):
-				break
 
-			iter_index += 1
-			prev_fsstats = fsstats
+		try:
+			while True:
+
+				# Handle FS migration iteration
+				logging.info("* Iteration %d", iter_index)
+				iter_start = time.time()
+				with self.__metrics.phase("fs iteration", iter_index):
+					fsstats = self.fs.next_iteration()
+				migration_stats.handle_iteration(fsstats)
+
+				# Decide whether we continue iteration or stop and do
+				# final sync
+				stats = policy.iter_stats(iter_index, iter_start,
+					time.time(), fsstats=fsstats)
+				if not self.__keep_iterating(stats):
+					break
+
+				iter_index += 1
+		finally:
+			self.__unthrottle()
 
 		# Stop htype on source and leave it mounted
 		logging.info("Final stop and start")
-		self.htype.stop(False)
+		with self.__metrics.phase("stop"):
+			self.htype.stop(False)
 
 		try:
 			# Handle final FS sync on mounted htype
 			logging.info("Final FS sync")
-			fsstats = self.fs.stop_migration()
+			with self.__metrics.phase("fs stop"):
+				fsstats = self.fs.stop_migration()
 			migration_stats.handle_iteration(fsstats)
 
 			# Start htype on target
 			logging.info("Asking target host to start")
-			self.target_host.start_htype()
+			with self.__metrics.phase("start"):
+				self.target_host.start_htype()
 			logging.info("Started on target host")
 
 		except:
@@ -300,53 +511,265 @@ class phaul_iter_worker:
 			raise
 
 		logging.info("Migration succeeded")
+		self.__unthrottle()
 		self.htype.migration_complete(self.fs, self.target_host)
 		migration_stats.handle_stop()
+		self.target_host.log_call_stats()
 
-	def __check_live_iter_progress(self, index, dstats, prev_dstats):
+	def __start_lazy_migration(self):
+		"""
+		Start migration in lazy mode
 
-		logging.info("Checking iteration progress:")
+		Migrate fs, checkpoint process tree on source host without memory
+		and restore it on target host right away. Target fetches memory
+		pages from source on demand and in background afterwards.
+		"""
 
-		if dstats.pages_written <= iter_consts.MIN_ITER_PAGES_COUNT:
-			logging.info("\t> Small dump")
-			return False
+		if not self.htype.can_lazy_migrate():
+			raise Exception("Lazy migration is not supported by htype")
 
-		if prev_dstats:
-			grow_rate = self.__calc_grow_rate(dstats.pages_written,
-				prev_dstats.pages_written)
-			if grow_rate > iter_consts.MAX_ITER_GROW_RATE:
-				logging.info("\t> Iteration grows")
-				return False
+		self.fs.set_work_dir(self.img.work_dir())
+		with self.__metrics.phase("validation"):
+			self.__validate_cpu()
+			self.__validate_criu_version()
+		self.criu_connection.memory_tracking(False)
+		root_pid = self.htype.root_task_pid()
 
-		if index >= iter_consts.MAX_ITERS_COUNT:
-			logging.info("\t> Too many iterations")
-			return False
+		migration_stats = mstats.lazy_stats(self.__metrics)
+		migration_stats.handle_start()
 
-		logging.info("\t> Proceed to next iteration")
-		return True
+		# Handle preliminary FS migration
+		logging.info("Preliminary FS migration")
+		with self.__metrics.phase("fs start"):
+			fsstats = self.fs.start_migration()
+		migration_stats.handle_preliminary(fsstats)
 
-	def __check_restart_iter_progress(self, index, fsstats, prev_fsstats):
+		# Dump htype without pages and leave its tasks in frozen state
+		logging.info("Lazy dump and restore")
+		self.__lock_final()
+		freeze_start = time.time()
+		try:
+			self.__session.save(pending=True)
+			self.target_host.start_iter(False)
+			self.target_host.call_oneway("prepare_restore")
+			self.img.new_image_dir()
+			migration_stats.handle_freeze()
+			with self.__metrics.phase("lazy dump"):
+				criu_cr.criu_lazy_dump(self.htype, root_pid, self.img,
+					self.criu_connection, self.fs)
+		except:
+			self.__unlock_final()
+			raise
+		self.target_host.call_oneway("end_iter")
 
-		logging.info("Checking iteration progress:")
+		try:
+			# Criu doesn't touch memory socket until post-dump notify is
+			# acked, so images can still go over it
+			logging.info("Final FS and images sync")
+			timer = mstats.phase_timer(self.__metrics)
+			fsstats, _ = util.run_parallel(
+				timer.timed("fs stop", self.fs.stop_migration),
+				timer.timed("image sync", lambda: self.img.sync_imgs_to_target(
+					self.target_host, self.htype, self.connection.image_sks())))
+
+			logging.info("Starting lazy pages on target host")
+			self.target_host.start_lazy_pages()
+		except:
+			self.htype.migration_fail(self.fs)
+			self.__unlock_final()
+			raise
 
-		if fsstats.bytes_xferred <= iter_consts.MIN_ITER_FS_XFER_BYTES:
-			logging.info("\t> Small fs transfer")
+		# Source tasks are gone after ack, their memory lives only in
+		# criu serving pages to target from now on
+		self.criu_connection.send_notify_ack()
+
+		logging.info("Asking target host to restore")
+		try:
+			with self.__metrics.phase("restore"):
+				self.target_host.restore_from_images()
+		finally:
+			self.__unlock_final()
+		self.downtime = time.time() - freeze_start
+		migration_stats.handle_resumed()
+		logging.info("Restored on target host, fetching pages")
+
+		with self.__metrics.phase("page fetch"):
+			resp = self.criu_connection.recv_resp()
+			if not resp.success:
+				raise Exception("Lazy pages transfer failed")
+			self.target_host.wait_lazy_pages()
+		migration_stats.handle_fetched()
+
+		dstats = criu_api.criu_get_dstats(self.img)
+		migration_stats.handle_iteration(dstats, fsstats)
+
+		logging.info("Migration succeeded")
+		self.__unthrottle()
+		self.htype.migration_complete(self.fs, self.target_host)
+		migration_stats.handle_stop(self)
+		self.target_host.log_call_stats()
+		self.img.close()
+		self.criu_connection.close()
+
+	def __start_dry_run(self):
+		"""
+		Estimate live migration without doing it
+
+		Validate source and target, pre-dump tree into local images instead
+		of target ones, probe the link and predict how long migration would
+		take and how long the tree would be frozen.
+		"""
+
+		if not is_live_mode(self.__mode):
+			raise Exception("Dry run is supported in live mode only")
+
+		self.__validate_cpu()
+		self.__validate_criu_version()
+		if not self.__check_use_pre_dumps():
+			raise Exception("Dry run needs pre-dumps")
+		root_pid = self.htype.root_task_pid()
+
+		migration_stats = mstats.dry_run_stats()
+		migration_stats.handle_start()
+
+		logging.info("Probing link to target")
+		rtt, bandwidth = self.__probe_link()
+		migration_stats.handle_probe(rtt, bandwidth)
+
+		engine = converge.converge_engine(policy.iter_consts.MAX_ITERS_COUNT,
+			policy.iter_consts.MIN_ITER_PAGES_COUNT)
+		iter_dstats = []
+		for iter_index in range(dry_run_consts.DRY_RUN_PRE_DUMPS):
+			logging.info("* Local pre-dump %d", iter_index)
+			iter_start = time.time()
+			self.img.new_image_dir()
+			criu_cr.criu_predump(root_pid, self.img, self.criu_connection,
+				self.fs, local=True)
+			dstats = criu_api.criu_get_dstats(self.img)
+			engine.handle_iteration(migration_stats.handle_iteration(dstats,
+				self.img.image_dir_size(), iter_start))
+			iter_dstats.append(dstats)
+
+		# Every iteration waits for start_iter and end_iter calls
+		overhead = 2 * rtt
+		page_size = resource.getpagesize()
+		dirty_rate = engine.dirty_rate or 0.0
+		nr_iters, total_time, frozen_time = converge.predict_migration(
+			iter_dstats[0].pages_written, dirty_rate, bandwidth / page_size,
+			iter_dstats[-1].frozen_time / 1000000., overhead,
+			policy.iter_consts.MAX_ITERS_COUNT, policy.iter_consts.MIN_ITER_PAGES_COUNT)
+		migration_stats.handle_stop(dirty_rate * page_size, nr_iters,
+			total_time, frozen_time)
+
+		self.target_host.log_call_stats()
+		self.img.close()
+		self.criu_connection.close()
+
+	def __probe_link(self):
+		"""Return rtt in seconds and bandwidth in bytes per second"""
+
+		rtts = []
+		for i in range(dry_run_consts.DRY_RUN_RTT_PROBES):
+			start = time.time()
+			self.target_host.probe_rtt()
+			rtts.append(time.time() - start)
+		rtt = min(rtts)
+
+		size = dry_run_consts.DRY_RUN_PROBE_SIZE
+		chunk = "\0" * 0x100000
+		start = time.time()
+		fut = self.target_host.call_async("probe_link", size)
+		for i in range(size / len(chunk)):
+			self.connection.mem_sk.sendall(chunk)
+		fut.result()
+
+		# Reply took half of round trip to come back
+		elapsed = max(time.time() - start - rtt / 2, rtt)
+		return rtt, size / elapsed
+
+	def __lock_final(self):
+		if self.__final_lock:
+			self.__final_lock.acquire(self)
+			self.__final_locked = True
+
+	def __unlock_final(self):
+		if self.__final_locked:
+			self.__final_locked = False
+			self.__final_lock.release(self)
+
+	def __run_pre_dumps(self, root_pid, migration_stats):
+		"""Pre-dump memory and sync fs iteratively while it converges"""
+
+		iter_index = 0
+
+		while True:
+
+			# Handle predump and FS migration iteration, memory and fs go
+			# over their own connections so run them at the same time
+			logging.info("* Iteration %d", iter_index)
+			iter_start = time.time()
+			timer = mstats.phase_timer(self.__metrics, iter_index)
+			self.target_host.start_iter(True)
+			self.img.new_image_dir()
+			self.__session.save(pending=True)
+			_, fsstats = util.run_parallel(
+				timer.timed("pre-dump", lambda: criu_cr.criu_predump(root_pid,
+					self.img, self.criu_connection, self.fs)),
+				timer.timed("fs iteration", self.fs.next_iteration))
+			self.target_host.call_oneway("end_iter")
+			self.__session.save(iter=self.img.current_iter, pending=False)
+
+			dstats = criu_api.criu_get_dstats(self.img)
+			migration_stats.handle_iteration(dstats, fsstats, timer)
+
+			# Decide whether we continue iteration or stop and do final dump
+			stats = policy.iter_stats(iter_index, iter_start, time.time(),
+				dstats, fsstats, migration_stats.last_rates(),
+				self.img.image_dir_size())
+			if not self.__keep_iterating(stats):
+				break
+
+			iter_index += 1
+
+	def __keep_iterating(self, stats):
+		"""Ask policy what to do after iteration, True to keep iterating"""
+
+		action = self.__policy.handle_iteration(stats)
+		if action not in policy.ITER_ACTIONS:
+			raise Exception("Unknown iteration action %s" % action)
+		if action == policy.ITER_THROTTLE:
+			return self.__throttle()
+		return action == policy.ITER_CONTINUE
+
+	def __throttle(self):
+		"""Tighten htype cpu limit, True if it was"""
+
+		throttle = getattr(self.htype, "cpu_throttle", None)
+		if not throttle:
+			logging.info("\t> Throttling is not supported")
 			return False
 
-		if prev_fsstats:
-			grow_rate = self.__calc_grow_rate(fsstats.bytes_xferred,
-				prev_fsstats.bytes_xferred)
-			if grow_rate > iter_consts.MAX_ITER_GROW_RATE:
-				logging.info("\t> Iteration grows")
+		try:
+			if not throttle.tighten():
+				logging.info("\t> Can't throttle any further")
 				return False
-
-		if index >= iter_consts.MAX_ITERS_COUNT:
-			logging.info("\t> Too many iterations")
+		except:
+			logging.exception("Failed to throttle")
 			return False
 
-		logging.info("\t> Proceed to next iteration")
+		logging.info("\t> Throttled, proceed to next iteration")
 		return True
 
-	def __calc_grow_rate(self, value, prev_value):
-		delta = value - prev_value
-		return delta * 100 / prev_value
+	def __unthrottle(self):
+		"""Put original cpu limit of tree back
+
+		Done once iterations are over, before tree is dumped, and again
+		when migration ends, where it has nothing left to release.
+		"""
+		throttle = getattr(self.htype, "cpu_throttle", None)
+		if not throttle:
+			return
+		try:
+			throttle.release()
+		except:
+			logging.exception("Failed to release cpu throttle")
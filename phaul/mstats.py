@@ -1,5 +1,21 @@
+import json
 import time
 import logging
+import threading
+import resource
+import contextlib
+import trace
+import converge
+import policy
+
+# Fields of criu dump stats exported to metrics
+_dstats_fields = ("freezing_time", "frozen_time", "memdump_time",
+	"memwrite_time", "pages_scanned", "pages_skipped_parent", "pages_written")
+
+
+# Fields of iter_rates exported to metrics
+_rates_fields = ("duration", "throughput", "dirty_rate", "skip_ratio",
+	"projected_iters")
 
 
 class fs_iter_stats:
@@ -7,13 +23,173 @@ class fs_iter_stats:
 		self.bytes_xferred = bytes_xferred
 
 
-class live_stats:
+class metrics_collector:
+	"""Machine readable record of migration
+
+	Keeps start and end time of every phase, stats of every iteration and
+	overall values, all of which end up in JSON document for dashboards.
+	Phases may run in parallel threads.
+	"""
+
 	def __init__(self):
+		self.__lock = threading.Lock()
+		self.__start_time = time.time()
+		self.__phases = []
+		self.__iterations = []
+		self.__values = {}
+
+	def add_phase(self, name, start, end, iteration=None):
+		with self.__lock:
+			self.__phases.append({"name": name, "iteration": iteration,
+				"start": start, "end": end, "duration": end - start})
+
+	@contextlib.contextmanager
+	def phase(self, name, iteration=None):
+		"""Record duration of with block as phase, and span if tracing"""
+		start = time.time()
+		try:
+			with trace.span(name):
+				yield
+		finally:
+			self.add_phase(name, start, time.time(), iteration)
+
+	def add_iteration(self, index, dstats, fsstats, rates=None):
+		record = {"index": index, "time": time.time()}
+		if dstats:
+			for field in _dstats_fields:
+				record[field] = getattr(dstats, field, None)
+		if rates:
+			for field in _rates_fields:
+				record[field] = getattr(rates, field)
+		if fsstats:
+			record["fs_bytes_xferred"] = fsstats.bytes_xferred
+		with self.__lock:
+			self.__iterations.append(record)
+
+	def set_value(self, name, value):
+		with self.__lock:
+			self.__values[name] = value
+
+	def document(self):
+		with self.__lock:
+			return {
+				"start": self.__start_time,
+				"phases": sorted(self.__phases, key=lambda p: p["start"]),
+				"iterations": list(self.__iterations),
+				"values": dict(self.__values),
+			}
+
+	def write(self, path, status, error=None, **parts):
+		"""Write document with migration status and extra parts to path"""
+		doc = self.document()
+		doc["end"] = time.time()
+		doc["status"] = status
+		doc["error"] = error
+		doc.update(parts)
+		with open(path, "w") as f:
+			json.dump(doc, f, indent=1, sort_keys=True)
+		logging.info("Metrics written to %s", path)
+
+
+class iter_rates:
+	"""Figures of single dump iteration derived from its stats and timing
+
+	Rates are in pages per second. Pages are written to page server after
+	tree is unfrozen, so transfer rate is taken over criu memory write
+	time, or whole iteration if criu doesn't report it. Dump writes pages
+	dirtied since the previous one was started, dirty rate is None for
+	the first one.
+	"""
+
+	def __init__(self, index, dstats, start, end, prev_start):
+		self.index = index
+		self.start = start
+		self.end = end
+		self.duration = end - start
+		self.pages = dstats.pages_written
+		self.pages_skipped = dstats.pages_skipped_parent
+		self.frozen_time = _usec2sec(dstats.frozen_time)
+
+		pages_seen = self.pages + self.pages_skipped
+		self.skip_ratio = float(self.pages_skipped) / pages_seen \
+			if pages_seen else 0.0
+
+		write_time = _usec2sec(dstats.memwrite_time) or self.duration
+		self.xfer_rate = self.pages / write_time if write_time else None
+		self.throughput = None
+		if self.xfer_rate is not None:
+			self.throughput = self.xfer_rate * resource.getpagesize()
+
+		self.dirty_rate = None
+		if prev_start is not None and start > prev_start:
+			self.dirty_rate = self.pages / (start - prev_start)
+
+		# Further pre-dumps needed for dump to get small if rates hold
+		self.converge_ratio = None
+		self.projected_iters = None
+		if self.dirty_rate is not None and self.xfer_rate:
+			self.converge_ratio = self.dirty_rate / self.xfer_rate
+			self.projected_iters = converge.project_iters(self.pages,
+				self.converge_ratio, policy.iter_consts.MIN_ITER_PAGES_COUNT)
+
+
+def _add_rates(rates, dstats, start, end):
+	"""Derive rates of iteration and append them to list of earlier ones"""
+	prev_start = rates[-1].start if rates else None
+	rates.append(iter_rates(len(rates), dstats, start, end, prev_start))
+	return rates[-1]
+
+
+class phase_timer:
+	"""Wall clock durations of phases of single iteration
+
+	Phases are also recorded to metrics collector if one is given.
+	"""
+
+	def __init__(self, metrics=None, iteration=None):
+		self.__start = time.time()
+		self.__phases = []
+		self.__metrics = metrics
+		self.__iteration = iteration
+
+	def start_time(self):
+		return self.__start
+
+	def timed(self, name, func):
+		"""Wrap func to record its duration under name"""
+		def run():
+			start = time.time()
+			try:
+				with trace.span(name):
+					return func()
+			finally:
+				end = time.time()
+				self.__phases.append((name, end - start))
+				if self.__metrics:
+					self.__metrics.add_phase(name, start, end,
+						self.__iteration)
+		return run
+
+	def phases(self):
+		"""Return list of (name, seconds) in order phases finished"""
+		return self.__phases
+
+	def total(self):
+		return time.time() - self.__start
+
+
+class live_stats:
+	def __init__(self, max_downtime=None, metrics=None):
+		self.__max_downtime = max_downtime
+		self.__metrics = metrics
 		self.__start_time = 0.0
 		self.__end_time = 0.0
 		self.__restore_time = 0
 		self.__img_sync_time = 0.0
+		self.__downtime = None
 		self.__iter_frozen_times = []
+		self.__iter_phases = []
+		self.__iter_rates = []
 
 	def handle_start(self):
 		self.__start_time = time.time()
@@ -21,27 +197,57 @@ class live_stats:
 	def handle_preliminary(self, fsstats):
 		_print_fsstats(fsstats)
 
-	def handle_iteration(self, dstats, fsstats):
+	def handle_iteration(self, dstats, fsstats, timer=None, end=None):
+		"""Account iteration timed by timer created at its start
+
+		Rates are measured till end, or till now if it's not given.
+		"""
+		rates = None
+		if timer:
+			rates = _add_rates(self.__iter_rates, dstats, timer.start_time(),
+				end or time.time())
+		if self.__metrics:
+			self.__metrics.add_iteration(len(self.__iter_frozen_times),
+				dstats, fsstats, rates)
 		self.__iter_frozen_times.append(dstats.frozen_time)
 		_print_dstats(dstats)
+		_print_rates(rates)
 		_print_fsstats(fsstats)
+		if timer:
+			self.__iter_phases.append(timer.phases())
+			_print_phases(timer)
+
+	def iter_phases(self):
+		"""Return phases durations of every iteration"""
+		return self.__iter_phases
+
+	def iter_rates(self):
+		"""Return iter_rates of every timed iteration"""
+		return self.__iter_rates
+
+	def last_rates(self):
+		return self.__iter_rates[-1] if self.__iter_rates else None
 
 	def handle_stop(self, iters):
 		self.__end_time = time.time()
 		self.__restore_time = iters.get_target_host().restore_time()
 		self.__img_sync_time = iters.img.img_sync_time()
+		self.__downtime = iters.downtime
 		self.__print_overall()
+		_print_xfer_stats(iters.img.xfer_stats())
+		_export_stop(self.__metrics, iters, self.__end_time - self.__start_time,
+			self.__restore_time, self.__img_sync_time)
 
 	def __print_overall(self):
 
 		total_time = self.__end_time - self.__start_time
-		restore_time = self.__usec2sec(self.__restore_time)
+		restore_time = _usec2sec(self.__restore_time)
 
 		frozen_time = 0.0
 		frozen_times = []
 		for iter_time in self.__iter_frozen_times:
-			frozen_time += self.__usec2sec(iter_time)
-			frozen_times.append("%.2lf" % self.__usec2sec(iter_time))
+			frozen_time += _usec2sec(iter_time)
+			frozen_times.append("%.2lf" % _usec2sec(iter_time))
 
 		logging.info("\t   total time is ~%.2lf sec", total_time)
 		logging.info("\t  frozen time is ~%.2lf sec (%s)", frozen_time,
@@ -49,14 +255,110 @@ class live_stats:
 		logging.info("\t restore time is ~%.2lf sec", restore_time)
 		logging.info("\timg sync time is ~%.2lf sec", self.__img_sync_time)
 
-	def __usec2sec(self, usec):
-		return usec / 1000000.
+		# Tree is frozen from final dump till restore, not only in criu
+		if self.__max_downtime is not None and self.__downtime is not None:
+			logging.info("\t     downtime is ~%.2lf sec, budget %.2lf sec (%s)",
+				self.__downtime, self.__max_downtime,
+				"met" if self.__downtime <= self.__max_downtime else "exceeded")
 
 
-class restart_stats:
+class lazy_stats:
+	def __init__(self, metrics=None):
+		self.__metrics = metrics
+		self.__start_time = 0.0
+		self.__freeze_time = 0.0
+		self.__resume_time = 0.0
+		self.__fetch_end_time = 0.0
+		self.__end_time = 0.0
+		self.__restore_time = 0
+		self.__img_sync_time = 0.0
+
+	def handle_start(self):
+		self.__start_time = time.time()
+
+	def handle_preliminary(self, fsstats):
+		_print_fsstats(fsstats)
+
+	def handle_freeze(self):
+		self.__freeze_time = time.time()
+
+	def handle_resumed(self):
+		self.__resume_time = time.time()
+
+	def handle_fetched(self):
+		self.__fetch_end_time = time.time()
+
+	def handle_iteration(self, dstats, fsstats):
+		if self.__metrics:
+			self.__metrics.add_iteration(0, dstats, fsstats)
+		_print_dstats(dstats)
+		_print_fsstats(fsstats)
+
+	def handle_stop(self, iters):
+		self.__end_time = time.time()
+		self.__restore_time = iters.get_target_host().restore_time()
+		self.__img_sync_time = iters.img.img_sync_time()
+		self.__print_overall()
+		_print_xfer_stats(iters.img.xfer_stats())
+		_export_stop(self.__metrics, iters, self.__end_time - self.__start_time,
+			self.__restore_time, self.__img_sync_time)
+
+	def __print_overall(self):
+		logging.info("\t   total time is ~%.2lf sec",
+			self.__end_time - self.__start_time)
+		logging.info("\t  resume time is ~%.2lf sec",
+			self.__resume_time - self.__freeze_time)
+		logging.info("\t   fetch time is ~%.2lf sec",
+			self.__fetch_end_time - self.__resume_time)
+		logging.info("\t restore time is ~%.2lf sec",
+			self.__restore_time / 1000000.)
+		logging.info("\timg sync time is ~%.2lf sec", self.__img_sync_time)
+
+
+class dry_run_stats:
+	"""Measurements and prediction of migration which isn't done"""
+
 	def __init__(self):
+		self.__start_time = 0.0
+		self.__image_sizes = []
+		self.__iter_rates = []
+
+	def handle_start(self):
+		self.__start_time = time.time()
+
+	def handle_probe(self, rtt, bandwidth):
+		logging.info("\tLink rtt %.3lf msec, bandwidth ~%.2lf Mb/s",
+			rtt * 1000., bandwidth / 1048576.)
+
+	def handle_iteration(self, dstats, image_size, start):
+		"""Account local pre-dump started at start, return its rates"""
+		rates = _add_rates(self.__iter_rates, dstats, start, time.time())
+		self.__image_sizes.append(image_size)
+		_print_dstats(dstats)
+		_print_rates(rates)
+		logging.info("\tImages take %d bytes (~%dMb)", image_size,
+			image_size >> 20)
+		return rates
+
+	def handle_stop(self, dirty_rate, nr_iters, total_time, frozen_time):
+		logging.info("\t dry run time is ~%.2lf sec",
+			time.time() - self.__start_time)
+		logging.info("\t   dirty rate is ~%.2lf Mb/s", dirty_rate / 1048576.)
+		if self.__image_sizes:
+			logging.info("\t   image size is ~%.2lf Mb",
+				self.__image_sizes[0] / 1048576.)
+		logging.info("Predicted migration (memory only, no fs and restore):")
+		logging.info("\t    pre-dumps %d", nr_iters)
+		logging.info("\t   total time is ~%.2lf sec", total_time)
+		logging.info("\t  frozen time is ~%.2lf sec", frozen_time)
+
+
+class restart_stats:
+	def __init__(self, metrics=None):
+		self.__metrics = metrics
 		self.__start_time = 0.0
 		self.__end_time = 0.0
+		self.__nr_iters = 0
 
 	def handle_start(self):
 		self.__start_time = time.time()
@@ -65,23 +367,73 @@ class restart_stats:
 		_print_fsstats(fsstats)
 
 	def handle_iteration(self, fsstats):
+		if self.__metrics:
+			self.__metrics.add_iteration(self.__nr_iters, None, fsstats)
+		self.__nr_iters += 1
 		_print_fsstats(fsstats)
 
 	def handle_stop(self):
 		self.__end_time = time.time()
 		self.__print_overall()
+		if self.__metrics:
+			self.__metrics.set_value("total_time",
+				self.__end_time - self.__start_time)
 
 	def __print_overall(self):
 		logging.info("\t   total time is ~%.2lf sec",
 			self.__end_time - self.__start_time)
 
 
+def _export_stop(metrics, iters, total_time, restore_time, img_sync_time):
+	if not metrics:
+		return
+	metrics.set_value("total_time", total_time)
+	metrics.set_value("restore_time", restore_time / 1000000.)
+	metrics.set_value("img_sync_time", img_sync_time)
+	metrics.set_value("downtime", iters.downtime)
+	metrics.set_value("img_xfer", [{"codec": codec, "bytes_in": bytes_in,
+		"bytes_out": bytes_out, "duration": duration}
+		for codec, bytes_in, bytes_out, duration in iters.img.xfer_stats()])
+
+
 def _print_dstats(dstats):
 	if dstats:
 		logging.info("\tDumped %d pages, %d skipped",
 			dstats.pages_written, dstats.pages_skipped_parent)
 
 
+def _print_rates(rates):
+	if not rates:
+		return
+
+	dirty = "unknown"
+	if rates.dirty_rate is not None:
+		dirty = "%d pages/s" % rates.dirty_rate
+	throughput = 0.0
+	if rates.throughput is not None:
+		throughput = rates.throughput / 1048576.
+	logging.info("\tThroughput ~%.2lf Mb/s, dirty rate %s, %.0lf%% skipped",
+		throughput, dirty, rates.skip_ratio * 100)
+
+	if rates.converge_ratio is None:
+		return
+	if rates.projected_iters is None:
+		logging.info("\tDirty to transfer ratio %.2lf, not converging",
+			rates.converge_ratio)
+	else:
+		logging.info("\tDirty to transfer ratio %.2lf, converges in ~%d "
+			"iterations", rates.converge_ratio, rates.projected_iters)
+
+
+def _usec2sec(usec):
+	return usec / 1000000.
+
+
+def _print_phases(timer):
+	phases = ", ".join("%s %.2lf sec" % p for p in timer.phases())
+	logging.info("\tPhases: %s (iteration %.2lf sec)", phases, timer.total())
+
+
 def _print_fsstats(fsstats):
 	if fsstats:
 		mbytes_xferred_str = ""
@@ -90,3 +442,11 @@ def _print_fsstats(fsstats):
 			mbytes_xferred_str = " (~{0}Mb)".format(mbytes_xferred)
 		logging.info("\tFs driver transfer %d bytes%s",
 			fsstats.bytes_xferred, mbytes_xferred_str)
+
+
+def _print_xfer_stats(xfer_stats):
+	for codec, bytes_in, bytes_out, duration in xfer_stats:
+		ratio = float(bytes_in) / bytes_out if bytes_out else 0.0
+		throughput = bytes_in / 1048576.0 / duration if duration else 0.0
+		logging.info("\tImages transfer %d -> %d bytes (%s, ratio %.2lf, "
+			"~%.2lf Mb/s)", bytes_in, bytes_out, codec, ratio, throughput)
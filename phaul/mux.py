@@ -0,0 +1,348 @@
+#
+# Multiplexed transport
+#
+# All logical channels of a migration (rpc, memory, fs) share one or more
+# TCP connections. Each channel is exposed to its user as one end of a
+# local socketpair, so that fds can still be handed to CRIU and libploop.
+# Frames of every channel are kept in order, link picks the channel to send
+# next by strict priorities. Every channel is flow controlled with its own
+# credit window, thus a slow reader of one channel never blocks the others.
+#
+
+import socket
+import struct
+import threading
+import itertools
+import collections
+import logging
+import util
+
+MUX_DATA = 0
+MUX_CREDIT = 1
+MUX_EOF = 2
+MUX_OPEN = 3
+
+# Lower value is sent first
+PRIO_CTL = 0
+PRIO_RPC = 1
+PRIO_MEM = 2
+PRIO_FS = 3
+PRIO_BULK = 4
+
+# Frame header is (channel id, frame type, payload length)
+mux_frame_hdr = struct.Struct("!HBI")
+mux_credit = struct.Struct("!I")
+mux_open = struct.Struct("!B")
+
+# Maximum payload of single data frame, bounds the time a high priority
+# frame waits behind a bulk one already being sent
+mux_max_frame = 0x10000
+
+# Amount of data peer may send on channel without acknowledge
+mux_window = 0x400000
+
+
+class _mux_link:
+	"""Single TCP connection carrying frames of some channels"""
+
+	def __init__(self, mux, sk):
+		self.__mux = mux
+		self.__sk = sk
+		self.__ctl_queue = collections.deque()
+		# Channel id -> [priority, deque of (seq, frame)]
+		self.__chan_queues = {}
+		self.__nr_queued = 0
+		self.__seq = itertools.count()
+		self.__cond = threading.Condition()
+		self.__closing = False
+		self.bytes_sent = 0
+		self.__sender = threading.Thread(target=self.__send_loop)
+		self.__receiver = threading.Thread(target=self.__recv_loop)
+		self.__sender.daemon = True
+		self.__receiver.daemon = True
+		self.__sk.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+	def start(self):
+		self.__sender.start()
+		self.__receiver.start()
+
+	def add_channel(self, chan_id, prio):
+		with self.__cond:
+			self.__chan_queues[chan_id] = [prio, collections.deque()]
+
+	def set_priority(self, chan_id, prio):
+		"""Change priority of channel, its queued frames keep their order"""
+		with self.__cond:
+			self.__chan_queues[chan_id][0] = prio
+
+	def send_ctl(self, chan_id, typ, payload=""):
+		"""Queue control frame, it goes ahead of all data"""
+		frame = mux_frame_hdr.pack(chan_id, typ, len(payload)) + payload
+		with self.__cond:
+			self.__ctl_queue.append(frame)
+			self.__nr_queued += 1
+			self.__cond.notify()
+
+	def send_frame(self, chan_id, typ, payload=""):
+		"""Queue frame behind the ones channel has already queued"""
+		frame = mux_frame_hdr.pack(chan_id, typ, len(payload)) + payload
+		with self.__cond:
+			self.__chan_queues[chan_id][1].append((next(self.__seq), frame))
+			self.__nr_queued += 1
+			self.__cond.notify()
+
+	def __pop_frame(self):
+		self.__nr_queued -= 1
+		if self.__ctl_queue:
+			return self.__ctl_queue.popleft()
+
+		# Head of the most urgent channel, the oldest one among equals
+		best = None
+		for prio, frames in self.__chan_queues.values():
+			if frames and (not best or (prio, frames[0][0]) < best[0]):
+				best = ((prio, frames[0][0]), frames)
+		return best[1].popleft()[1]
+
+	def close(self):
+		"""Flush queued frames and stop sending"""
+		with self.__cond:
+			self.__closing = True
+			self.__cond.notify()
+		self.__sender.join(1.0)
+
+	def __send_loop(self):
+		try:
+			while True:
+				with self.__cond:
+					while not self.__nr_queued and not self.__closing:
+						self.__cond.wait()
+					if not self.__nr_queued:
+						break
+					frame = self.__pop_frame()
+				self.__sk.sendall(frame)
+				self.bytes_sent += len(frame)
+			self.__sk.shutdown(socket.SHUT_WR)
+		except (socket.error, OSError):
+			logging.exception("Exception in mux sender")
+
+	def __recv_loop(self):
+		try:
+			while True:
+				hdr = util.recv_exact(self.__sk, mux_frame_hdr.size)
+				if hdr is None:
+					break
+				chan_id, typ, size = mux_frame_hdr.unpack(hdr)
+				payload = util.recv_exact(self.__sk, size) if size else ""
+				if payload is None:
+					raise Exception("Mux link closed mid-frame")
+				self.__mux.on_frame(chan_id, typ, payload)
+		except (socket.error, OSError):
+			logging.exception("Exception in mux receiver")
+		except Exception:
+			# Broken frame, peer is not speaking mux protocol
+			logging.exception("Bad frame on mux link")
+		self.__mux.on_link_down(self)
+
+
+class _mux_channel:
+	"""Logical channel bridging local socketpair end and mux link"""
+
+	def __init__(self, chan_id, prio, link):
+		self.__id = chan_id
+		self.__prio = prio
+		self.__link = link
+		self.user_sk, self.__sk = socket.socketpair(
+			socket.AF_UNIX, socket.SOCK_STREAM)
+		util.set_cloexec(self.__sk)
+		self.__credit = mux_window
+		self.__credit_cond = threading.Condition()
+		self.__rqueue = collections.deque()
+		self.__eof = False
+		self.__rcond = threading.Condition()
+		self.__reader = threading.Thread(target=self.__read_loop)
+		self.__writer = threading.Thread(target=self.__write_loop)
+		self.__reader.daemon = True
+		self.__writer.daemon = True
+		self.__link.add_channel(chan_id, prio)
+
+	def start(self):
+		self.__reader.start()
+		self.__writer.start()
+
+	def set_priority(self, prio):
+		self.__prio = prio
+		self.__link.set_priority(self.__id, prio)
+
+	def announce(self, data):
+		"""Make peer open this channel too"""
+		self.__link.send_ctl(self.__id, MUX_OPEN,
+			mux_open.pack(self.__prio) + data)
+
+	def on_data(self, data):
+		with self.__rcond:
+			self.__rqueue.append(data)
+			self.__rcond.notify()
+
+	def on_credit(self, size):
+		with self.__credit_cond:
+			self.__credit += size
+			self.__credit_cond.notify()
+
+	def on_eof(self):
+		with self.__rcond:
+			self.__eof = True
+			self.__rcond.notify()
+
+	def abort(self):
+		"""Transport is lost, make user see connection reset"""
+		try:
+			self.__sk.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+		self.on_credit(mux_window)
+		self.on_eof()
+
+	def __read_loop(self):
+		"""Forward data written by user to the peer"""
+		try:
+			while True:
+				with self.__credit_cond:
+					while self.__credit <= 0:
+						self.__credit_cond.wait()
+					size = min(self.__credit, mux_max_frame)
+				data = self.__sk.recv(size)
+				if not data:
+					# Eof must not overtake data still queued on link
+					self.__link.send_frame(self.__id, MUX_EOF)
+					break
+				with self.__credit_cond:
+					self.__credit -= len(data)
+				self.__link.send_frame(self.__id, MUX_DATA, data)
+		except socket.error:
+			pass
+
+	def __write_loop(self):
+		"""Deliver data received from the peer to user"""
+		try:
+			while True:
+				with self.__rcond:
+					while not self.__rqueue and not self.__eof:
+						self.__rcond.wait()
+					if not self.__rqueue:
+						break
+					data = self.__rqueue.popleft()
+				self.__sk.sendall(data)
+				self.__link.send_ctl(self.__id, MUX_CREDIT,
+					mux_credit.pack(len(data)))
+			self.__sk.shutdown(socket.SHUT_WR)
+		except socket.error:
+			pass
+
+
+class mux:
+	"""Set of TCP links carrying logical channels
+
+	Both sides must open the same channels, with the same ids, before
+	calling start(). Channels opened later have to be announced to the
+	peer, which opens them on its side and reports them to open handler.
+	When there is more than one link the first one is reserved for rpc
+	traffic, so that rpc frames never wait behind bulk data already queued
+	in the kernel.
+	"""
+
+	def __init__(self, sks):
+		self.__links = [_mux_link(self, sk) for sk in sks]
+		self.__channels = {}
+		self.__lock = threading.Lock()
+		self.__started = False
+		self.__open_handler = None
+		self.__bulk_links = itertools.cycle(
+			self.__links[1:] if len(self.__links) > 1 else self.__links)
+
+	def open_channel(self, chan_id, prio):
+		"""Create channel, return socket object of its user end"""
+		with self.__lock:
+			if chan_id in self.__channels:
+				raise Exception("Mux channel %d already open" % chan_id)
+			return self.__open(chan_id, prio).user_sk
+
+	def channel(self, chan_id, prio):
+		"""Return user end of channel, create it if peer hasn't announced it"""
+		with self.__lock:
+			chan = self.__channels.get(chan_id)
+			if not chan:
+				chan = self.__open(chan_id, prio)
+			return chan.user_sk
+
+	def announce(self, chan_id, data=""):
+		"""Make peer open channel and pass data to its open handler"""
+		self.__channels[chan_id].announce(data)
+
+	def set_open_handler(self, handler):
+		"""Call handler(chan_id, data) for every channel peer announces"""
+		self.__open_handler = handler
+
+	def __open(self, chan_id, prio):
+		if prio <= PRIO_RPC:
+			link = self.__links[0]
+		else:
+			link = next(self.__bulk_links)
+
+		chan = _mux_channel(chan_id, prio, link)
+		self.__channels[chan_id] = chan
+		if self.__started:
+			chan.start()
+		return chan
+
+	def set_priority(self, chan_id, prio):
+		self.__channels[chan_id].set_priority(prio)
+
+	def bytes_sent(self):
+		"""Return number of bytes sent over all links"""
+		return sum(link.bytes_sent for link in self.__links)
+
+	def start(self):
+		with self.__lock:
+			self.__started = True
+			for chan in self.__channels.values():
+				chan.start()
+		for link in self.__links:
+			link.start()
+
+	def close(self):
+		for link in self.__links:
+			link.close()
+
+	def on_frame(self, chan_id, typ, payload):
+		if typ == MUX_OPEN:
+			self.__on_open(chan_id, payload)
+			return
+
+		chan = self.__channels.get(chan_id)
+		if not chan:
+			raise Exception("Frame for unknown mux channel %d" % chan_id)
+
+		if typ == MUX_DATA:
+			chan.on_data(payload)
+		elif typ == MUX_CREDIT:
+			chan.on_credit(mux_credit.unpack(payload)[0])
+		elif typ == MUX_EOF:
+			chan.on_eof()
+		else:
+			raise Exception("Unknown mux frame type %d" % typ)
+
+	def __on_open(self, chan_id, payload):
+		prio, = mux_open.unpack(payload[:mux_open.size])
+		with self.__lock:
+			if chan_id in self.__channels:
+				return
+			self.__open(chan_id, prio)
+		if self.__open_handler:
+			self.__open_handler(chan_id, payload[mux_open.size:])
+
+	def on_link_down(self, link):
+		logging.info("Mux link is down")
+		with self.__lock:
+			channels = self.__channels.values()
+		for chan in channels:
+			chan.abort()
@@ -173,3 +173,6 @@ class p_haul_type:
 
 	def dump_need_page_server(self):
 		return False
+
+	def can_lazy_migrate(self):
+		return False
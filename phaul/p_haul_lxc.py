@@ -26,6 +26,7 @@ class p_haul_type:
 		#
 		self._veths = []
 		self._cfg = {}
+		self.cpu_throttle = util.tree_throttle(self.root_task_pid)
 
 	def __load_ct_config(self):
 		logging.info("Loading config file from %s", self.__ct_config())
@@ -135,6 +136,9 @@ class p_haul_type:
 
 	def mount(self):
 		nroot = self.__ct_root()
+		if self._fs_mounted:
+			return nroot
+
 		logging.info("Mounting CT root to %s", nroot)
 		if not os.access(nroot, os.F_OK):
 			os.makedirs(nroot)
@@ -145,6 +149,17 @@ class p_haul_type:
 	def umount(self):
 		pass
 
+	def prepare_restore(self):
+		"""Mount CT root while source is still dumping"""
+		self.mount()
+
+	def cancel_restore(self):
+		"""Roll back prepare_restore"""
+		if self._fs_mounted:
+			logging.info("Umounting CT root")
+			os.system("umount %s" % self.__ct_root())
+			self._fs_mounted = False
+
 	def start(self):
 		pass
 
@@ -183,3 +198,6 @@ class p_haul_type:
 
 	def dump_need_page_server(self):
 		return True
+
+	def can_lazy_migrate(self):
+		return True
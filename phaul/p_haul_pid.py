@@ -4,6 +4,7 @@
 
 import logging
 import criu_cr
+import util
 import fs_haul_shared
 
 
@@ -11,6 +12,8 @@ class p_haul_type:
 	def __init__(self, id):
 		self.pid = int(id)
 		self._pidfile = None
+		# Single task often shares cgroup with others, e.g. with p.haul
+		self.cpu_throttle = util.tree_throttle(self.root_task_pid, True)
 
 	#
 	# Initialize itself for source node or destination one
@@ -117,3 +120,6 @@ class p_haul_type:
 
 	def dump_need_page_server(self):
 		return True
+
+	def can_lazy_migrate(self):
+		return True
@@ -46,6 +46,7 @@ class p_haul_type:
 		# v_bridge is the bridge to which thie veth is attached
 		#
 		self._veths = []
+		self.cpu_throttle = util.tree_throttle(self.root_task_pid)
 		self.__verbose = criu_api.def_verb
 
 	def __load_ct_config(self, path):
@@ -256,6 +257,12 @@ class p_haul_type:
 		deltas = self.__parse_fdfs_arg(fdfs)
 		return fs_haul_ploop.p_haul_fs_receiver(deltas)
 
+	def discard_partial_fs(self, fdfs=None):
+		"""Remove deltas left by interrupted migration, they are copied
+		anew since libploop can't continue partial copy"""
+		deltas = self.__parse_fdfs_arg(fdfs)
+		fs_haul_ploop.discard_partial_deltas(deltas)
+
 	def __parse_fdfs_arg(self, fdfs):
 		"""
 		Parse string containing list of ploop deltas with socket fds
@@ -300,10 +307,18 @@ class p_haul_type:
 	def dump_need_page_server(self):
 		return True
 
+	def can_lazy_migrate(self):
+		# vzctl restore has no way to restore with lazy pages
+		return False
+
 
 def add_hauler_args(parser):
 	"""Add Virtuozzo specific command line arguments"""
-	parser.add_argument("--vz-shared-disks", help="List of shared storage disks")
+	group = parser.add_argument_group("Virtuozzo",
+		"CT root is mounted on target by vzctl restore once ploop is "
+		"synced after final dump, so unlike lxc it isn't mounted in advance "
+		"while source dumps and adds to downtime.")
+	group.add_argument("--vz-shared-disks", help="List of shared storage disks")
 
 
 def _parse_vz_config(body):
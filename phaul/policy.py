@@ -0,0 +1,313 @@
+#
+# Iteration policies
+#
+# Policy decides after every pre-dump (or fs iteration in restart mode)
+# whether migration keeps iterating, keeps iterating with the tree
+# throttled or stops and does the final dump. Built-in policies are picked
+# with --iter-policy by name, custom ones are given as module:class.
+#
+
+import logging
+import resource
+import importlib
+import converge
+
+ITER_CONTINUE = "continue"
+ITER_STOP = "stop"
+ITER_THROTTLE = "throttle"
+ITER_ACTIONS = (ITER_CONTINUE, ITER_STOP, ITER_THROTTLE)
+
+DOWNTIME_ACTION_ABORT = "abort"
+DOWNTIME_ACTION_THROTTLE = "throttle"
+DOWNTIME_ACTION_PROCEED = "proceed"
+DOWNTIME_ACTIONS = (DOWNTIME_ACTION_ABORT, DOWNTIME_ACTION_THROTTLE,
+	DOWNTIME_ACTION_PROCEED)
+
+
+class iter_consts:
+	"""Constants for iterations management"""
+
+	# Maximum number of iterations
+	MAX_ITERS_COUNT = 8
+
+	# Minimum count of dumped pages needed to continue iteration
+	MIN_ITER_PAGES_COUNT = 64
+
+	# Minimum count of transferred fs bytes needed to continue iteration
+	MIN_ITER_FS_XFER_BYTES = 0x100000
+
+	# Maximum acceptable iteration grow rate in percents
+	MAX_ITER_GROW_RATE = 10
+
+	# Pre-dumps time budget of time-budget policy in seconds
+	DEF_TIME_BUDGET = 60.0
+
+
+class iter_stats:
+	"""What is known about finished iteration
+
+	Memory fields are None in restart mode. rates are mstats.iter_rates
+	measured on this iteration alone, smoothed rates are filled in by
+	policy from convergence engine estimates and stay None until measured.
+	img_bytes is size of images left to sync after a dump like this one.
+	"""
+
+	def __init__(self, index, start, end, dstats=None, fsstats=None,
+			rates=None, img_bytes=0):
+		self.index = index
+		self.start = start
+		self.end = end
+		self.duration = end - start
+		self.dstats = dstats
+		self.rates = rates
+		self.img_bytes = img_bytes
+		self.pages_written = None
+		self.pages_skipped = None
+		self.frozen_time = None
+		if dstats:
+			self.pages_written = dstats.pages_written
+			self.pages_skipped = dstats.pages_skipped_parent
+			self.frozen_time = dstats.frozen_time / 1000000.
+		self.fs_bytes = fsstats.bytes_xferred if fsstats else 0
+
+		# Pages per second dirtied by tree and bytes per second sent
+		self.dirty_rate = None
+		self.bandwidth = None
+
+		# Predicted downtime of final dump now and after one more
+		# iteration, from freeze till restore on target, in seconds
+		self.frozen_now = None
+		self.frozen_next = None
+
+
+class iter_policy:
+	"""Base of iteration policies
+
+	Worker calls handle_iteration() after every iteration, subclasses
+	implement decide() returning one of ITER_* actions. Throttle means
+	keep iterating with tree slowed down, worker stops iterating if htype
+	can't be throttled (any further).
+	"""
+
+	def __init__(self, opts):
+		self.opts = opts
+		self.engine = converge.converge_engine(iter_consts.MAX_ITERS_COUNT,
+			iter_consts.MIN_ITER_PAGES_COUNT)
+		self.history = []
+		self.__page_size = resource.getpagesize()
+
+	def seed(self, dirty_rate, bandwidth):
+		"""Start estimates from dirty rate in pages per second and
+		bandwidth in bytes per second known in advance"""
+		self.engine.seed(dirty_rate, bandwidth / self.__page_size)
+
+	def handle_iteration(self, stats):
+		"""Account finished iteration and return action to take"""
+		if stats.rates:
+			self.engine.handle_iteration(stats.rates, stats.img_bytes)
+			stats.dirty_rate = self.engine.dirty_rate
+			if self.engine.xfer_rate:
+				stats.bandwidth = self.engine.xfer_rate * self.__page_size
+			stats.frozen_now = self.engine.frozen_now
+			stats.frozen_next = self.engine.frozen_next
+
+		action = self.decide(stats)
+		self.history.append(stats)
+		return action
+
+	def decide(self, stats):
+		raise NotImplementedError()
+
+	def check_restart_progress(self, stats):
+		"""Keep syncing fs while transfers don't grow"""
+
+		logging.info("Checking iteration progress:")
+
+		if stats.fs_bytes <= iter_consts.MIN_ITER_FS_XFER_BYTES:
+			logging.info("\t> Small fs transfer")
+			return ITER_STOP
+
+		if self.history:
+			grow_rate = _calc_grow_rate(stats.fs_bytes,
+				self.history[-1].fs_bytes)
+			if grow_rate > iter_consts.MAX_ITER_GROW_RATE:
+				logging.info("\t> Iteration grows")
+				return ITER_STOP
+
+		if stats.index >= iter_consts.MAX_ITERS_COUNT:
+			logging.info("\t> Too many iterations")
+			return ITER_STOP
+
+		logging.info("\t> Proceed to next iteration")
+		return ITER_CONTINUE
+
+
+class default_policy(iter_policy):
+	"""Iterate while another pre-dump makes final freeze shorter
+
+	With --auto-converge tree dirtying memory faster than it is sent is
+	throttled, with --max-downtime predicted final freeze over the budget
+	is handled as --downtime-action says.
+	"""
+
+	def decide(self, stats):
+		if stats.dstats is None:
+			return self.check_restart_progress(stats)
+
+		if self.engine.should_continue(stats.index):
+			return ITER_CONTINUE
+		if self.__check_auto_converge(stats):
+			return ITER_THROTTLE
+		return self.__check_downtime_budget(stats)
+
+	def __check_auto_converge(self, stats):
+		if not self.opts["auto_converge"] or not self.engine.is_diverging():
+			return False
+		return stats.index < iter_consts.MAX_ITERS_COUNT
+
+	def __check_downtime_budget(self, stats):
+		max_downtime = self.opts["max_downtime"]
+		if max_downtime is None or stats.frozen_now is None:
+			return ITER_STOP
+		if stats.frozen_now <= max_downtime:
+			return ITER_STOP
+
+		logging.info("\t> Predicted downtime %.3lf sec exceeds budget %.3lf sec",
+			stats.frozen_now, max_downtime)
+
+		action = self.opts["downtime_action"]
+		if action == DOWNTIME_ACTION_ABORT:
+			raise Exception("Downtime budget can't be met")
+
+		if action == DOWNTIME_ACTION_THROTTLE:
+			if stats.index < iter_consts.MAX_ITERS_COUNT:
+				return ITER_THROTTLE
+			logging.info("\t> No iterations left to throttle")
+
+		logging.warning("Proceeding with final dump over downtime budget")
+		return ITER_STOP
+
+
+class time_budget_policy(iter_policy):
+	"""Finish pre-dumps within --iter-time-budget seconds
+
+	Iterate while another pre-dump makes final freeze shorter and, if it
+	takes as long as the last one, still ends within the budget counted
+	from the first pre-dump start.
+	"""
+
+	def decide(self, stats):
+		if self.__budget_exhausted(stats):
+			return ITER_STOP
+
+		if stats.dstats is None:
+			return self.check_restart_progress(stats)
+
+		logging.info("Checking iteration progress:")
+
+		if stats.pages_written <= iter_consts.MIN_ITER_PAGES_COUNT:
+			logging.info("\t> Small dump")
+			return ITER_STOP
+
+		if stats.frozen_now is not None:
+			min_frozen = stats.frozen_now * (1 - converge.min_gain)
+			if stats.frozen_next >= min_frozen:
+				logging.info("\t> Next iteration won't shorten freeze")
+				return ITER_STOP
+
+		logging.info("\t> Proceed to next iteration")
+		return ITER_CONTINUE
+
+	def __budget_exhausted(self, stats):
+		budget = self.opts["iter_time_budget"] or iter_consts.DEF_TIME_BUDGET
+		first = self.history[0] if self.history else stats
+		elapsed = stats.end - first.start
+
+		logging.info("Checking time budget:")
+		logging.info("\tspent %.2lf of %.2lf sec, last iteration %.2lf sec",
+			elapsed, budget, stats.duration)
+		if elapsed + stats.duration > budget:
+			logging.info("\t> Time budget is exhausted")
+			return True
+		return False
+
+
+class bandwidth_model_policy(iter_policy):
+	"""Iterate while dirty rate to bandwidth ratio shrinks final dump
+
+	Every pre-dump leaves ratio times pages of the previous one for the
+	next, so iterate until final dump fits --max-downtime, if given, or
+	pages stop shrinking. With --auto-converge tree dirtying memory faster
+	than it is sent is throttled.
+	"""
+
+	def decide(self, stats):
+		if stats.dstats is None:
+			return self.check_restart_progress(stats)
+
+		logging.info("Checking iteration progress:")
+
+		if stats.pages_written <= iter_consts.MIN_ITER_PAGES_COUNT:
+			logging.info("\t> Small dump")
+			return ITER_STOP
+
+		if stats.index >= iter_consts.MAX_ITERS_COUNT:
+			logging.info("\t> Too many iterations")
+			return ITER_STOP
+
+		if stats.dirty_rate is None or not stats.bandwidth:
+			logging.info("\t> No estimate yet, proceed to next iteration")
+			return ITER_CONTINUE
+
+		ratio = stats.dirty_rate / self.engine.xfer_rate
+		logging.info("\tdirty to transfer ratio %.2lf, predicted freeze "
+			"%.3lf sec", ratio, stats.frozen_now)
+
+		if ratio >= 1.0:
+			logging.info("\t> Memory is dirtied faster than transferred")
+			if self.opts["auto_converge"]:
+				return ITER_THROTTLE
+			return ITER_STOP
+
+		max_downtime = self.opts["max_downtime"]
+		if max_downtime is not None and stats.frozen_now <= max_downtime:
+			logging.info("\t> Final dump fits downtime budget")
+			return ITER_STOP
+
+		if ratio > 1 - converge.min_gain:
+			logging.info("\t> Next iteration won't shrink dump")
+			return ITER_STOP
+
+		logging.info("\t> Proceed to next iteration")
+		return ITER_CONTINUE
+
+
+POLICY_DEFAULT = "default"
+
+_policies = {
+	POLICY_DEFAULT: default_policy,
+	"time-budget": time_budget_policy,
+	"bandwidth-model": bandwidth_model_policy,
+}
+
+
+def get_policy_names():
+	"""Return names of built-in policies"""
+	return _policies.keys()
+
+
+def get_policy(name, opts):
+	"""Create built-in policy by name or custom one given as module:class"""
+	policy_class = _policies.get(name)
+	if not policy_class:
+		module_name, sep, class_name = name.partition(":")
+		if not sep:
+			raise Exception("Unknown iteration policy %s" % name)
+		policy_class = getattr(importlib.import_module(module_name), class_name)
+	logging.info("Using %s iteration policy", name)
+	return policy_class(opts)
+
+
+def _calc_grow_rate(value, prev_value):
+	delta = value - prev_value
+	return delta * 100 / prev_value
@@ -2,13 +2,25 @@
 # P.HAUL code, that helps on the target node (rpyc service)
 #
 
+import time
 import logging
+import threading
 import distutils.version
 import images
 import criu_api
 import criu_req
 import htype
 import iters
+import xem_rpc
+import compression
+import util
+import session
+import mstats
+import trace
+import exporter
+
+# Link probe data is received by this many bytes at once
+probe_chunk = 0x100000
 
 
 class phaul_service:
@@ -18,20 +30,39 @@ class phaul_service:
 		self.__fs_receiver = None
 		self.criu_connection = None
 		self.img = None
+		self.__lazy_pages = None
+		self.__prepare_task = None
+		self.__session = None
+		self.__img_path = images.def_path
+		self.metrics = mstats.metrics_collector()
 		self.__mode = iters.MIGRATION_MODE_LIVE
 		self.dump_iter_index = 0
+		self.__dry_run = False
+		self.__final_started = False
 		self.restored = False
 
 	def on_connect(self):
 		logging.info("Connected")
+		exporter.sessions.inc()
 
 	def on_disconnect(self):
 		logging.info("Disconnected")
+		exporter.sessions.dec()
+		if self.restored:
+			exporter.migrations_succeeded.inc()
+		elif self.__final_started and not self.__dry_run:
+			# Failures before final iteration leave tree running on
+			# source, and their session may yet be resumed
+			exporter.migrations_failed.inc()
+		if self.__lazy_pages:
+			self.__lazy_pages.kill()
+
 		if self.criu_connection:
 			self.criu_connection.close()
 
 		if self.htype and not self.restored:
-			if iters.is_live_mode(self.__mode):
+			self.__cancel_prepared_restore()
+			if iters.is_dump_mode(self.__mode):
 				self.htype.umount()
 			elif iters.is_restart_mode(self.__mode):
 				self.htype.stop(True)
@@ -39,9 +70,13 @@ class phaul_service:
 		if self.__fs_receiver:
 			self.__fs_receiver.stop_receive()
 
+		if self.__session and self.restored:
+			self.__session.remove()
+
 		if self.img:
 			logging.info("Closing images")
-			if not self.restored:
+			# Dry run only made work dir, there is nothing to keep
+			if not self.restored and not self.__dry_run:
 				self.img.save_images()
 			self.img.close()
 
@@ -52,15 +87,15 @@ class phaul_service:
 
 		self.htype = htype.get_dst(htype_id)
 
-		self.__fs_receiver = self.htype.get_fs_receiver(self.connection.fdfs)
-		if self.__fs_receiver:
-			self.__fs_receiver.start_receive()
-
-		if iters.is_live_mode(self.__mode):
+		if iters.is_dump_mode(self.__mode):
 			self.img = images.phaul_images("rst")
 			self.criu_connection = criu_api.criu_conn(self.connection.mem_sk)
+			self.criu_connection.lazy_pages(iters.is_lazy_mode(self.__mode))
+			self.criu_connection.set_metrics(self.metrics)
 
 	def rpc_set_options(self, opts):
+		self.__img_path = opts["img_path"]
+		self.__dry_run = opts["dry_run"]
 		self.htype.set_options(opts)
 		if self.criu_connection:
 			self.criu_connection.set_options(opts)
@@ -82,16 +117,83 @@ class phaul_service:
 		self.dump_iter_index += 1
 		self.img.new_image_dir()
 		if need_page_server:
-			self.start_page_server()
+			with self.metrics.phase("page server start", self.dump_iter_index):
+				self.start_page_server()
 
 	def rpc_end_iter(self):
+		if self.__session:
+			self.__save_session()
+
+	def rpc_start_session(self, session_id):
+		self.__session = session.session_record(self.__img_path, session_id)
+		self.__save_session()
+		self.__start_fs_receiver()
+
+	def __start_fs_receiver(self):
+		# Receiver is started once migration session is known, resumed
+		# session has to drop partially received disks first
+		self.__fs_receiver = self.htype.get_fs_receiver(self.connection.fdfs)
+		if self.__fs_receiver:
+			self.__fs_receiver.start_receive()
+
+	def rpc_resume_session(self, session_id, src_iter, src_pending):
+		"""Continue session interrupted by transport failure
+
+		Return iteration migration continues after and whether next
+		pre-dump may use images of the previous one as parent.
+		"""
+
+		logging.info("Resuming migration session %s", session_id)
+		self.__session = session.session_record(self.__img_path, session_id)
+		state = self.__session.load()
+		chain = not src_pending and state["iter"] == src_iter
+		last_iter = max(state["iter"], src_iter)
+		if self.img:
+			self.img.resume(state["wdir"], last_iter, chain)
+		self.dump_iter_index = last_iter
+		self.__save_session()
+
+		discard = getattr(self.htype, "discard_partial_fs", None)
+		if discard:
+			discard(self.connection.fdfs)
+		self.__start_fs_receiver()
+		return last_iter, chain
+
+	def __save_session(self):
+		if self.img:
+			self.__session.save(wdir=self.img.work_dir(),
+				iter=self.img.current_iter)
+		else:
+			self.__session.save(wdir=None, iter=0)
+
+	def rpc_probe_rtt(self):
 		pass
 
-	def rpc_start_accept_images(self, dir_id):
-		self.img.start_accept_images(dir_id, self.connection.mem_sk)
+	def rpc_probe_link(self, size):
+		"""Receive and drop size bytes sent over memory socket"""
+		while size > 0:
+			data = self.connection.mem_sk.recv(min(size, probe_chunk))
+			if not data:
+				raise Exception("Memory socket closed while probing link")
+			size -= len(data)
+
+	def rpc_compress_codecs(self):
+		return compression.available_codecs()
+
+	def rpc_start_accept_images(self, dir_id, nr_streams, use_mem=True):
+		if use_mem:
+			sks = self.connection.image_sks()
+		else:
+			sks = self.connection.img_sks
+		if nr_streams > len(sks):
+			raise Exception("Only %d images streams available" % len(sks))
+		self.img.start_accept_images(dir_id, sks[:nr_streams])
 
 	def rpc_stop_accept_images(self):
-		self.img.stop_accept_images()
+		return self.img.stop_accept_images()
+
+	def rpc_image_digests(self):
+		return self.img.store_digests()
 
 	def rpc_check_cpuinfo(self):
 		logging.info("Checking cpuinfo")
@@ -100,6 +202,7 @@ class phaul_service:
 		logging.info("\t`- %s", resp.success)
 		return resp.success
 
+	@xem_rpc.unordered
 	def rpc_check_criu_version(self, source_version):
 		logging.info("Checking criu version")
 		target_version = criu_api.get_criu_version()
@@ -112,20 +215,102 @@ class phaul_service:
 		logging.info("\t`- %s", result)
 		return result
 
+	def rpc_prepare_restore(self):
+		"""Stage restore in background while source does final dump
+
+		Criu service is already running since setup, so this leaves to
+		htype only things that don't depend on images, like mounting root.
+		"""
+
+		self.__start_final()
+		prepare = getattr(self.htype, "prepare_restore", None)
+		if not prepare:
+			return
+
+		logging.info("Preparing restore")
+		self.__prepare_task = util.pool_task(self.__timed("prepare restore",
+			prepare), ())
+		thread = threading.Thread(target=self.__prepare_task.run)
+		thread.daemon = True
+		thread.start()
+
+	def __start_final(self):
+		# Migration is counted from its final iteration, like failures,
+		# so that dry runs and resumed sessions are counted once at most
+		if self.__final_started or self.__dry_run:
+			return
+		self.__final_started = True
+		exporter.migrations_started.inc()
+
+	def __wait_prepared_restore(self):
+		if not self.__prepare_task:
+			return
+		try:
+			self.__prepare_task.wait()
+			logging.info("Restore prepared in advance")
+		except Exception:
+			logging.exception("Restore preparation failed, rolling back")
+			self.__cancel_prepared_restore()
+
+	def __timed(self, name, func):
+		def run():
+			with self.metrics.phase(name):
+				return func()
+		return run
+
+	def __cancel_prepared_restore(self):
+		task, self.__prepare_task = self.__prepare_task, None
+		if not task:
+			return
+		try:
+			task.wait()
+		except Exception:
+			logging.exception("Restore preparation failed")
+		self.htype.cancel_restore()
+
 	def rpc_restore_from_images(self):
 		logging.info("Restoring from images")
-		self.htype.put_meta_images(self.img.image_dir())
-		self.htype.final_restore(self.img, self.criu_connection)
+		self.__wait_prepared_restore()
+		try:
+			self.htype.put_meta_images(self.img.image_dir())
+			with self.metrics.phase("restore"):
+				self.htype.final_restore(self.img, self.criu_connection)
+		except Exception:
+			self.__cancel_prepared_restore()
+			raise
 		logging.info("Restore succeeded")
 		self.restored = True
 
+	def rpc_start_lazy_pages(self):
+		self.__lazy_pages = criu_api.lazy_pages_daemon(self.img,
+			self.connection.mem_sk, self.criu_connection.verb)
+
+	def rpc_wait_lazy_pages(self):
+		logging.info("Waiting for lazy pages to be fetched")
+		with self.metrics.phase("lazy pages"):
+			self.__lazy_pages.wait()
+		self.__lazy_pages = None
+		logging.info("All pages fetched")
+
+	@xem_rpc.unordered
 	def rpc_restore_time(self):
 		stats = criu_api.criu_get_rstats(self.img)
+		exporter.restore_time.observe(stats.restore_time / 1000000.)
 		return stats.restore_time
 
+	def rpc_get_metrics(self):
+		"""Return target side metrics document"""
+		return self.metrics.document()
+
+	def rpc_get_trace(self, trace_id):
+		"""Return target spans of trace with local time to align them"""
+		return trace.take_events(trace_id), time.time()
+
 	def rpc_start_htype(self):
 		logging.info("Starting")
-		self.htype.start()
+		self.__start_final()
+		with self.metrics.phase("start"):
+			self.htype.start()
 		logging.info("Start succeeded")
 		self.restored = True
 
@@ -0,0 +1,64 @@
+#
+# Migration sessions
+#
+# Every migration gets an id and both sides keep record of its progress
+# on disk, so that migration interrupted by transport failure can be
+# resumed with --resume from the last completed iteration, reusing images
+# both sides already have, instead of starting over.
+#
+
+import os
+import re
+import json
+import uuid
+import errno
+import logging
+import util
+
+# Records are kept in this subdirectory of images path
+session_dir = "sessions"
+
+_session_id_re = re.compile("^[0-9a-f]{32}$")
+
+
+def new_session_id():
+	return uuid.uuid4().hex
+
+
+class session_record:
+	"""On-disk state of migration session on one side"""
+
+	def __init__(self, img_path, session_id):
+		if not _session_id_re.match(session_id):
+			raise Exception("Bad migration session id %s" % session_id)
+		self.id = session_id
+		self.state = {}
+		self.__dir = os.path.join(img_path, session_dir)
+		self.__path = os.path.join(self.__dir, session_id + ".json")
+
+	def load(self):
+		try:
+			with open(self.__path) as f:
+				self.state = json.load(f)
+		except IOError as e:
+			if e.errno != errno.ENOENT:
+				raise
+			raise Exception("Unknown migration session %s" % self.id)
+		return self.state
+
+	def save(self, **state):
+		"""Update state with given values and write it atomically"""
+		self.state.update(state)
+		util.makedirs(self.__dir)
+		tmp_path = self.__path + ".tmp"
+		with open(tmp_path, "w") as f:
+			json.dump(self.state, f)
+		os.rename(tmp_path, self.__path)
+
+	def remove(self):
+		logging.info("Removing migration session %s", self.id)
+		try:
+			os.unlink(self.__path)
+		except OSError as e:
+			if e.errno != errno.ENOENT:
+				raise
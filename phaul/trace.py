@@ -0,0 +1,176 @@
+#
+# Span tracing across source and target
+#
+# Spans are kept in memory in Chrome trace-event format. Every span
+# belongs to a trace and nests under the span that was current in its
+# thread when it started. Trace context of an RPC call is sent along with
+# it, so that work done on target nests under the call on source. Source
+# collects target spans at the end and writes one trace which can be
+# opened in chrome://tracing or Perfetto.
+#
+
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+import contextlib
+
+_enabled = False
+_process_name = None
+_events = []
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def enable(process_name):
+	"""Start recording spans of this process"""
+	global _enabled, _process_name
+	_process_name = process_name
+	_enabled = True
+
+
+def is_enabled():
+	return _enabled
+
+
+def new_trace_id():
+	return uuid.uuid4().hex
+
+
+def _new_span_id():
+	return uuid.uuid4().hex[:16]
+
+
+def _stack():
+	stack = getattr(_local, "stack", None)
+	if stack is None:
+		stack = _local.stack = []
+	return stack
+
+
+def current():
+	"""Return (trace id, span id) of current span, None if there's none"""
+	if not _enabled:
+		return None
+	stack = _stack()
+	return stack[-1] if stack else None
+
+
+def child_context():
+	"""Return (trace id, parent span id, span id) for span started
+	elsewhere, e.g. remote call, None if there is no current span"""
+	ctx = current()
+	if not ctx:
+		return None
+	return ctx[0], ctx[1], _new_span_id()
+
+
+@contextlib.contextmanager
+def span(name, cat="phaul", trace_id=None, parent=None, span_id=None):
+	"""Record with block as span
+
+	Span nests under current span of the thread, unless trace_id is given
+	to start new trace or continue remote one under parent. Nothing is
+	recorded outside of any trace.
+	"""
+	if not _enabled:
+		yield
+		return
+
+	stack = _stack()
+	if trace_id is None:
+		if not stack:
+			yield
+			return
+		trace_id, parent = stack[-1]
+
+	span_id = span_id or _new_span_id()
+	stack.append((trace_id, span_id))
+	start = time.time()
+	try:
+		yield
+	finally:
+		stack.pop()
+		record(name, cat, start, time.time(), (trace_id, parent, span_id))
+
+
+def attach(ctx, func):
+	"""Wrap func to run under span context ctx in another thread"""
+	if not ctx:
+		return func
+
+	def run():
+		stack = _stack()
+		stack.append(ctx)
+		try:
+			return func()
+		finally:
+			stack.pop()
+	return run
+
+
+def record(name, cat, start, end, ctx):
+	"""Record span of (trace id, parent span id, span id) context
+
+	Span with end set to None is recorded as instant event.
+	"""
+	trace_id, parent, span_id = ctx
+	event = {"name": name, "cat": cat, "ts": start * 1000000.,
+		"pid": os.getpid(), "tid": threading.current_thread().ident,
+		"args": {"trace_id": trace_id, "span_id": span_id, "parent": parent}}
+	if end is None:
+		event["ph"] = "i"
+		event["s"] = "t"
+	else:
+		event["ph"] = "X"
+		event["dur"] = (end - start) * 1000000.
+	with _lock:
+		_events.append(event)
+
+
+def take_events(trace_id):
+	"""Remove spans of trace from memory and return them"""
+	global _events
+	with _lock:
+		taken = [e for e in _events if e["args"]["trace_id"] == trace_id]
+		_events = [e for e in _events if e["args"]["trace_id"] != trace_id]
+
+	if taken:
+		taken.insert(0, {"name": "process_name", "ph": "M",
+			"pid": os.getpid(), "args": {"name": _process_name}})
+	return taken
+
+
+def shift_events(events, offset):
+	"""Move events by offset seconds, to align clock of another host"""
+	for event in events:
+		if "ts" in event:
+			event["ts"] += offset * 1000000.
+	return events
+
+
+def write(path, events):
+	with open(path, "w") as f:
+		json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+	logging.info("Trace written to %s", path)
+
+
+class traced_calls:
+	"""Proxy recording calls of given methods of object as spans"""
+
+	def __init__(self, obj, cat, methods):
+		self.__obj = obj
+		self.__cat = cat
+		self.__methods = methods
+
+	def __getattr__(self, attr):
+		value = getattr(self.__obj, attr)
+		if attr not in self.__methods:
+			return value
+
+		def call(*args, **kwargs):
+			with span("%s.%s" % (self.__cat, attr), self.__cat):
+				return value(*args, **kwargs)
+		return call
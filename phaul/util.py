@@ -1,46 +1,93 @@
 import os
 import fcntl
 import errno
+import ctypes
+import struct
 import logging
-import socket
-import tarfile
+import threading
+import Queue
+import trace
 
 
-class tarfile_fileobj_wrap:
-	"""Helper class provides read/write interface for socket object
+class pool_task:
+	"""Function submitted to worker_pool and its outcome"""
 
-	Current helper class wrap recv/send socket methods in read/write interface.
-	This functionality needed to workaround some problems of socket.makefile
-	method for sockets constructed from numerical file descriptors passed
-	through command line arguments.
-	"""
+	def __init__(self, func, args):
+		self.__func = func
+		self.__args = args
+		self.__done = threading.Event()
+		self.__result = None
+		self.__exc = None
 
-	def __init__(self, sk):
-		self.__sk = sk
-		self.__nread = 0
+	def run(self):
+		try:
+			self.__result = self.__func(*self.__args)
+		except Exception as e:
+			self.__exc = e
+		finally:
+			self.__done.set()
 
-	def read(self, size=0x10000):
-		data = self.__sk.recv(size)
-		self.__nread += len(data)
-		return data
+	def done(self):
+		return self.__done.is_set()
 
-	def write(self, data):
-		self.__sk.sendall(data)
-		return len(data)
+	def wait(self):
+		"""Wait for task to finish, return its result or raise its error"""
+		self.__done.wait()
+		if self.__exc:
+			raise self.__exc
+		return self.__result
 
-	def discard_unread_input(self):
-		"""
-		Cleanup socket after tarfile
 
-		tarfile module always align data on source side according to RECORDSIZE
-		constant, but it don't read aligning bytes on target side in some cases
-		depending on received buffer size. Read aligning manually and discard.
-		"""
+class worker_pool:
+	"""Fixed set of daemon threads running submitted functions"""
+
+	def __init__(self, nr_workers):
+		self.__queue = Queue.Queue()
+		self.__threads = []
+		for i in range(nr_workers):
+			thread = threading.Thread(target=self.__work)
+			thread.daemon = True
+			thread.start()
+			self.__threads.append(thread)
+
+	def submit(self, func, *args):
+		task = pool_task(func, args)
+		self.__queue.put(task)
+		return task
 
-		remainder = self.__nread % tarfile.RECORDSIZE
-		if remainder > 0:
-			self.__sk.recv(tarfile.RECORDSIZE - remainder, socket.MSG_WAITALL)
-			self.__nread += tarfile.RECORDSIZE - remainder
+	def stop(self):
+		for thread in self.__threads:
+			self.__queue.put(None)
+		for thread in self.__threads:
+			thread.join()
+
+	def __work(self):
+		while True:
+			task = self.__queue.get()
+			if task is None:
+				break
+			task.run()
+
+
+def run_parallel(*funcs):
+	"""Run callables in separate threads, return their results
+
+	Wait for all of them to finish, re-raise the first exception if any.
+	"""
+
+	tasks = []
+	threads = []
+	trace_ctx = trace.current()
+	for func in funcs:
+		task = pool_task(trace.attach(trace_ctx, func), ())
+		thread = threading.Thread(target=task.run)
+		thread.start()
+		tasks.append(task)
+		threads.append(thread)
+
+	for thread in threads:
+		thread.join()
+	return [task.wait() for task in tasks]
 
 
 class net_dev:
@@ -65,6 +112,268 @@ def bridge_add(ifname, brname):
 	os.system("brctl addif %s %s" % (brname, ifname))
 
 
+def _libc_sendfile():
+	"""Return sendfile(2) from libc if os module doesn't provide it"""
+	try:
+		libc = ctypes.CDLL(None, use_errno=True)
+		func = libc.sendfile
+	except (OSError, AttributeError):
+		return None
+	func.argtypes = [ctypes.c_int, ctypes.c_int,
+		ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+	func.restype = ctypes.c_ssize_t
+	return func
+
+
+_sendfile = None if hasattr(os, "sendfile") else _libc_sendfile()
+
+
+def sendfile(sk, fd, size):
+	"""Send size bytes of file from its start to socket in kernel"""
+	offset = 0
+	if hasattr(os, "sendfile"):
+		while offset < size:
+			sent = os.sendfile(sk.fileno(), fd, offset, size - offset)
+			if sent == 0:
+				raise Exception("File truncated while sending")
+			offset += sent
+	elif _sendfile:
+		off = ctypes.c_int64(0)
+		while off.value < size:
+			sent = _sendfile(sk.fileno(), fd, ctypes.byref(off),
+				size - off.value)
+			if sent < 0:
+				err = ctypes.get_errno()
+				if err == errno.EINTR:
+					continue
+				raise OSError(err, os.strerror(err))
+			if sent == 0:
+				raise Exception("File truncated while sending")
+	else:
+		while offset < size:
+			data = os.read(fd, min(size - offset, 0x100000))
+			if not data:
+				raise Exception("File truncated while sending")
+			sk.sendall(data)
+			offset += len(data)
+
+
+class inotify_watch:
+	"""Minimal inotify(7) watch of single directory"""
+
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_TO = 0x00000080
+
+	__IN_NONBLOCK = 0o4000
+	__IN_CLOEXEC = 0o2000000
+	__event_hdr = struct.Struct("iIII")
+
+	def __init__(self, path, mask):
+		libc = ctypes.CDLL(None, use_errno=True)
+		self.__fd = libc.inotify_init1(self.__IN_NONBLOCK | self.__IN_CLOEXEC)
+		if self.__fd < 0:
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err))
+
+		if libc.inotify_add_watch(self.__fd, path, mask) < 0:
+			err = ctypes.get_errno()
+			os.close(self.__fd)
+			raise OSError(err, os.strerror(err))
+
+	def fileno(self):
+		return self.__fd
+
+	def read_events(self):
+		"""Return list of pending (mask, name) events"""
+		try:
+			data = os.read(self.__fd, 0x10000)
+		except OSError as e:
+			if e.errno == errno.EAGAIN:
+				return []
+			raise
+
+		events = []
+		off = 0
+		while off < len(data):
+			wd, mask, cookie, name_len = self.__event_hdr.unpack_from(data, off)
+			off += self.__event_hdr.size
+			name = data[off:off + name_len].rstrip("\0")
+			off += name_len
+			events.append((mask, name))
+		return events
+
+	def close(self):
+		os.close(self.__fd)
+
+
+def tree_pids(pid):
+	"""Return pids of task and all its descendants"""
+	pids = []
+	queue = [pid]
+	while queue:
+		pid = queue.pop()
+		pids.append(pid)
+		try:
+			task_dir = "/proc/%d/task" % pid
+			for tid in os.listdir(task_dir):
+				with open(os.path.join(task_dir, tid, "children")) as f:
+					queue.extend(int(child) for child in f.read().split())
+		except (IOError, OSError):
+			# Task has just exited
+			pass
+	return pids
+
+
+def _cpu_cgroup_dir(pid):
+	"""Return (directory, is cgroup2) of cpu cgroup task belongs to"""
+
+	cgroup_v1 = None
+	cgroup_v2 = None
+	with open("/proc/%d/cgroup" % pid) as f:
+		for line in f:
+			hier, controllers, path = line.rstrip("\n").split(":", 2)
+			if "cpu" in controllers.split(","):
+				cgroup_v1 = path
+			elif hier == "0" and not controllers:
+				cgroup_v2 = path
+
+	if (cgroup_v1 or cgroup_v2) == "/":
+		raise Exception("Task %d is in root cpu cgroup" % pid)
+
+	with open("/proc/self/mounts") as f:
+		for line in f:
+			dev, mnt, fstype, opts = line.split()[:4]
+			if cgroup_v1 and fstype == "cgroup" and "cpu" in opts.split(","):
+				return mnt + cgroup_v1, False
+			if cgroup_v2 and fstype == "cgroup2" and not cgroup_v1:
+				return mnt + cgroup_v2, True
+
+	raise Exception("No cpu cgroup found for task %d" % pid)
+
+
+class cpu_throttle:
+	"""Progressively limit CPU time of cgroup task belongs to
+
+	Every tighten() lowers CFS quota to the next fraction of what cgroup
+	was allowed before, release() puts original limit back.
+	"""
+
+	steps = (0.7, 0.5, 0.3, 0.1)
+
+	def __init__(self, pid):
+		self.__dir, self.__v2 = _cpu_cgroup_dir(pid)
+		self.__orig = self.__read()
+		self.__step = 0
+
+	def tighten(self):
+		"""Lower quota by one step, False if it is at the lowest already"""
+		if self.__step >= len(self.steps):
+			return False
+
+		quota, period = self.__orig
+		if quota < 0:
+			quota = period * os.sysconf("SC_NPROCESSORS_ONLN")
+		fraction = self.steps[self.__step]
+		self.__write(max(int(quota * fraction), 1000), period)
+		self.__step += 1
+		logging.info("\tThrottled %s to %d%% of cpu", self.__dir,
+			fraction * 100)
+		return True
+
+	def release(self):
+		if self.__step:
+			self.__write(*self.__orig)
+			self.__step = 0
+			logging.info("\tReleased cpu throttle of %s", self.__dir)
+
+	def __read(self):
+		if self.__v2:
+			with open(os.path.join(self.__dir, "cpu.max")) as f:
+				quota, period = f.read().split()
+			return (-1 if quota == "max" else int(quota)), int(period)
+
+		with open(os.path.join(self.__dir, "cpu.cfs_quota_us")) as f:
+			quota = int(f.read())
+		with open(os.path.join(self.__dir, "cpu.cfs_period_us")) as f:
+			period = int(f.read())
+		return quota, period
+
+	def __write(self, quota, period):
+		if self.__v2:
+			with open(os.path.join(self.__dir, "cpu.max"), "w") as f:
+				f.write("%s %d" % ("max" if quota < 0 else quota, period))
+			return
+
+		with open(os.path.join(self.__dir, "cpu.cfs_quota_us"), "w") as f:
+			f.write(str(quota))
+
+
+class tree_throttle:
+	"""Cpu throttle of migrated tree, shared by htypes supporting it
+
+	Cgroup is looked up on first tighten(). With dedicated_only set, the
+	tree is throttled only if no other task is in its cgroup, so that
+	e.g. session scope shared with p.haul and criu isn't slowed down.
+	"""
+
+	def __init__(self, get_pid, dedicated_only=False):
+		self.__get_pid = get_pid
+		self.__dedicated_only = dedicated_only
+		self.__throttle = None
+		self.__refused = False
+
+	def tighten(self):
+		"""Lower quota by one step, False if it can't be lowered"""
+		if self.__refused:
+			return False
+
+		if not self.__throttle:
+			pid = self.__get_pid()
+			if self.__dedicated_only and not _owns_cpu_cgroup(pid):
+				logging.info("\tCpu cgroup of task %d is shared with other "
+					"tasks, not throttling", pid)
+				self.__refused = True
+				return False
+			self.__throttle = cpu_throttle(pid)
+		return self.__throttle.tighten()
+
+	def release(self):
+		"""Put original limit back while the tree still lives
+
+		Best effort, cgroup of container may be gone already.
+		"""
+		if not self.__throttle:
+			return
+		try:
+			self.__throttle.release()
+		except (IOError, OSError) as e:
+			if e.errno != errno.ENOENT:
+				raise
+			logging.info("\tCpu cgroup is gone, nothing to release")
+
+
+def _owns_cpu_cgroup(pid):
+	"""Tell whether only tasks of tree rooted at pid are in its cgroup"""
+	cgroup_dir, _ = _cpu_cgroup_dir(pid)
+	with open(os.path.join(cgroup_dir, "cgroup.procs")) as f:
+		members = set(int(member) for member in f.read().split())
+	return members.issubset(tree_pids(pid))
+
+
+def recv_exact(sk, size):
+	"""Read exactly size bytes from socket, None on clean disconnect"""
+	chunks = []
+	while size > 0:
+		data = sk.recv(size)
+		if not data:
+			if chunks:
+				raise Exception("Connection closed mid-message")
+			return None
+		chunks.append(data)
+		size -= len(data)
+	return "".join(chunks)
+
+
 def set_cloexec(sk):
 	flags = fcntl.fcntl(sk, fcntl.F_GETFD)
 	fcntl.fcntl(sk, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
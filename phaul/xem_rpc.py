@@ -2,13 +2,18 @@
 # RPC server implementation
 #
 
+import time
+import errno
 import socket
 import select
+import struct
+import marshal
 import threading
+import collections
 import traceback
 import logging
-
-rpc_sk_buf = 16384
+import util
+import trace
 
 RPC_CMD = 1
 RPC_CALL = 2
@@ -16,25 +21,277 @@ RPC_CALL = 2
 RPC_RESP = 1
 RPC_EXC = 2
 
+# Every message is a marshalled tuple prefixed with its length. Calls are
+# (type, name, args, seq[, (trace id, span id)]) and replies are (status,
+# value, seq, exec_time); calls with seq set to None are one-way and get
+# no reply.
+rpc_msg_hdr = struct.Struct("!I")
+
+rpc_recv_chunk = 0x10000
+
+# Number of threads executing calls of all sessions
+rpc_def_workers = 8
+
+
+class rpc_call_stats:
+	"""Per-method call counters and latency histograms
+
+	Histogram buckets are upper bounds in seconds, the last bucket counts
+	everything above the largest bound. Calls taking longer than the slow
+	threshold (if set) are logged as they happen.
+	"""
+
+	BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+		0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+	def __init__(self, title, slow_threshold=None):
+		self.__title = title
+		self.__slow_threshold = slow_threshold
+		self.__methods = {}
+		self.__lock = threading.Lock()
+
+	def set_slow_threshold(self, slow_threshold):
+		self.__slow_threshold = slow_threshold
+
+	def record(self, name, duration):
+		with self.__lock:
+			st = self.__methods.get(name)
+			if not st:
+				st = {"count": 0, "total": 0.0, "max": 0.0,
+					"hist": [0] * (len(self.BUCKETS) + 1)}
+				self.__methods[name] = st
+
+			st["count"] += 1
+			st["total"] += duration
+			st["max"] = max(st["max"], duration)
+			st["hist"][self.__bucket(duration)] += 1
+
+		if self.__slow_threshold and duration > self.__slow_threshold:
+			logging.warning("Slow RPC %s: %s took %.3lf sec", self.__title,
+				name, duration)
+
+	def get(self):
+		return self.__methods
+
+	def log_summary(self):
+		if not self.__methods:
+			return
+
+		logging.info("RPC %s summary:", self.__title)
+		for name in sorted(self.__methods):
+			st = self.__methods[name]
+			logging.info("\t%-24s %5d calls, avg %.4lf max %.4lf sec", name,
+				st["count"], st["total"] / st["count"], st["max"])
+			logging.info("\t%-24s %s", "", self.__format_hist(st["hist"]))
+
+	def __bucket(self, duration):
+		for i, bound in enumerate(self.BUCKETS):
+			if duration <= bound:
+				return i
+		return len(self.BUCKETS)
+
+	def __format_hist(self, hist):
+		cells = []
+		for i, cnt in enumerate(hist):
+			if not cnt:
+				continue
+			if i < len(self.BUCKETS):
+				cells.append("<=%gs:%d" % (self.BUCKETS[i], cnt))
+			else:
+				cells.append(">%gs:%d" % (self.BUCKETS[-1], cnt))
+		return " ".join(cells)
+
+
+def pack_msg(msg):
+	"""Serialize RPC message into frame"""
+	body = marshal.dumps(msg)
+	return rpc_msg_hdr.pack(len(body)) + body
+
+
+def split_msgs(buf):
+	"""Extract all complete messages from buffer, return them and the rest"""
+	msgs = []
+	off = 0
+	while len(buf) - off >= rpc_msg_hdr.size:
+		size, = rpc_msg_hdr.unpack_from(buf, off)
+		end = off + rpc_msg_hdr.size + size
+		if end > len(buf):
+			break
+		msgs.append(marshal.loads(buf[off + rpc_msg_hdr.size:end]))
+		off = end
+	return msgs, buf[off:]
+
+
+def send_msg(sk, msg):
+	"""Send single framed RPC message"""
+	sk.sendall(pack_msg(msg))
+
+
+def recv_msg(sk):
+	"""Receive single framed RPC message, None on disconnect"""
+	hdr = util.recv_exact(sk, rpc_msg_hdr.size)
+	if hdr is None:
+		return None
+	size, = rpc_msg_hdr.unpack(hdr)
+	body = util.recv_exact(sk, size)
+	if body is None:
+		raise Exception("RPC connection closed mid-message")
+	return marshal.loads(body)
+
+
+def unordered(func):
+	"""Mark RPC handler as safe to run concurrently with other calls
+
+	Such handler is dispatched to worker as soon as it arrives instead of
+	waiting for earlier calls of the same session, so it must only read
+	state of the master.
+	"""
+	func.rpc_unordered = True
+	return func
+
 
 class _rpc_server_sk:
-	def __init__(self, sk):
-		self._sk = sk
+	"""Server side of single RPC session
+
+	Calls are read from non-blocking socket and executed by manager's
+	workers strictly in the order they arrived, replies are buffered and
+	written by the manager when socket is ready.
+	"""
+
+	def __init__(self, connection, slow_threshold=None, own_connection=False):
+		self._connection = connection
+		self._own_connection = own_connection
+		self._sk = connection.rpc_sk
+		self._sk.setblocking(False)
 		self._master = None
+		self._rbuf = ""
+		self._wbuf = ""
+		self._wlock = threading.Lock()
+		self._queue = collections.deque()
+		self._qlock = threading.Lock()
+		self._busy = False
+		self._oneway_error = None
+		self._oneway_lock = threading.Lock()
+		self._stats = rpc_call_stats("server", slow_threshold)
+		self._trace_ids = set()
 
 	def fileno(self):
 		return self._sk.fileno()
 
-	def work(self, mgr):
-		raw_data = self._sk.recv(rpc_sk_buf)
-		if not raw_data:
-			mgr.remove_poll_item(self)
-			if self._master:
-				self._master.on_disconnect()
-			return
+	def on_readable(self, mgr):
+		while True:
+			try:
+				raw_data = self._sk.recv(rpc_recv_chunk)
+			except socket.error as e:
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					break
+				if e.errno != errno.ECONNRESET:
+					raise
+				raw_data = ""
+
+			if not raw_data:
+				# Calls which came along with EOF go before disconnect
+				self.__handle_calls(mgr)
+				mgr.remove_poll_item(self)
+				# Disconnect is handled after all calls already queued
+				self.__enqueue(mgr, None)
+				return
+
+			self._rbuf += raw_data
+
+		self.__handle_calls(mgr)
+
+	def __handle_calls(self, mgr):
+		calls, self._rbuf = split_msgs(self._rbuf)
+		for call in calls:
+			if self.__is_unordered(call):
+				mgr.dispatch(self.__run_call, mgr, call)
+			else:
+				self.__enqueue(mgr, call)
 
-		data = eval(raw_data)
+	def on_writable(self, mgr):
+		with self._wlock:
+			try:
+				sent = self._sk.send(self._wbuf)
+			except socket.error as e:
+				if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+					logging.warning("Can't send RPC reply: %s", e)
+					self._wbuf = ""
+				sent = 0
+			self._wbuf = self._wbuf[sent:]
+			return len(self._wbuf) > 0
+
+	def __is_unordered(self, call):
+		if call[0] != RPC_CALL or not self._master:
+			return False
+		handler = getattr(self._master, "rpc_" + call[1], None)
+		return getattr(handler, "rpc_unordered", False)
+
+	def __enqueue(self, mgr, call):
+		with self._qlock:
+			self._queue.append(call)
+			if self._busy:
+				return
+			self._busy = True
+		mgr.dispatch(self.__run_queue, mgr)
+
+	def __run_queue(self, mgr):
+		while True:
+			with self._qlock:
+				if not self._queue:
+					self._busy = False
+					return
+				call = self._queue.popleft()
+
+			if call is None:
+				self.__disconnect()
+			else:
+				self.__run_call(mgr, call)
+
+	def __run_call(self, mgr, call):
+		res = self._exec_call(mgr, call)
+		if res is not None:
+			with self._wlock:
+				self._wbuf += pack_msg(res)
+			mgr.want_write(self)
+
+	def __disconnect(self):
+		if self._master:
+			self._master.on_disconnect()
+		self._stats.log_summary()
+		for trace_id in self._trace_ids:
+			# Drop spans source didn't collect
+			trace.take_events(trace_id)
+		if self._own_connection:
+			self._connection.close()
+
+	def _exec_call(self, mgr, data):
+		if len(data) < 5:
+			return self.__exec_call(mgr, data)
+
+		trace_id, parent = data[4]
+		if not trace.is_enabled():
+			trace.enable("p.haul-service")
+		self._trace_ids.add(trace_id)
+		with trace.span("exec " + data[1], "rpc", trace_id, parent):
+			return self.__exec_call(mgr, data)
+
+	def __exec_call(self, mgr, data):
+		seq = data[3]
+		start = time.time()
 		try:
+			# Failure of an earlier one-way call is reported to the first
+			# caller waiting for reply, nothing runs after it till then
+			with self._oneway_lock:
+				err = self._oneway_error
+				if err and seq is not None:
+					self._oneway_error = None
+			if err:
+				if seq is None:
+					logging.info("Skipping one-way %s after %s", data[1], err)
+					return None
+				raise Exception(err)
+
 			if data[0] == RPC_CALL:
 				if not self._master:
 					raise Exception("Proto seq error")
@@ -46,15 +303,27 @@ class _rpc_server_sk:
 				raise Exception(("Proto typ error", data[0]))
 		except Exception as e:
 			traceback.print_exc()
-			res = (RPC_EXC, e)
-		else:
-			res = (RPC_RESP, res)
+			exec_time = self.__record(data[1], start)
+			if seq is None:
+				with self._oneway_lock:
+					if not self._oneway_error:
+						self._oneway_error = "One-way %s failed: %s" % (
+							data[1], e)
+				return None
+			return (RPC_EXC, str(e), seq, exec_time)
+
+		exec_time = self.__record(data[1], start)
+		if seq is None:
+			return None
+		return (RPC_RESP, res, seq, exec_time)
 
-		raw_data = repr(res)
-		self._sk.send(raw_data)
+	def __record(self, name, start):
+		exec_time = time.time() - start
+		self._stats.record(name, exec_time)
+		return exec_time
 
 	def init_rpc(self, mgr, args):
-		self._master = mgr.make_master()
+		self._master = mgr.make_master(self._connection)
 		self._master.on_connect(*args)
 
 
@@ -65,27 +334,123 @@ class _rpc_stop_fd:
 	def fileno(self):
 		return self._fd.fileno()
 
-	def work(self, mgr):
+	def on_readable(self, mgr):
 		mgr.stop()
 
 
+class _rpc_wakeup_fd:
+	"""Wakes up the loop when workers have replies to send"""
+
+	def __init__(self):
+		self._rsk, self._wsk = socket.socketpair()
+		self._rsk.setblocking(False)
+		self._wsk.setblocking(False)
+		util.set_cloexec(self._rsk)
+		util.set_cloexec(self._wsk)
+
+	def fileno(self):
+		return self._rsk.fileno()
+
+	def wake(self):
+		try:
+			self._wsk.send("w")
+		except socket.error as e:
+			# Pipe is full, loop is going to wake up anyway
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+				raise
+
+	def on_readable(self, mgr):
+		try:
+			while self._rsk.recv(rpc_recv_chunk):
+				pass
+		except socket.error as e:
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+				raise
+		mgr.flush_replies()
+
+
+class _rpc_listen_sk:
+	"""Accepts connections, each of them starts new RPC session"""
+
+	def __init__(self, sk, make_connection, slow_threshold):
+		self._sk = sk
+		self._make_connection = make_connection
+		self._slow_threshold = slow_threshold
+
+	def fileno(self):
+		return self._sk.fileno()
+
+	def on_readable(self, mgr):
+		sk, addr = self._sk.accept()
+		logging.info("Accepted RPC session from %s", addr)
+		connection = self._make_connection(sk)
+		mgr.add_poll_item(_rpc_server_sk(connection, self._slow_threshold,
+			own_connection=True))
+
+
 class _rpc_server_manager:
-	def __init__(self, srv_class, connection):
+	def __init__(self, srv_class, connection, slow_threshold=None,
+			nr_workers=rpc_def_workers):
 		self._srv_class = srv_class
-		self._connection = connection
-		self._poll_list = []
+		self._slow_threshold = slow_threshold
+		self._poll = select.epoll()
+		self._poll_items = {}
 		self._alive = True
+		self._pool = util.worker_pool(nr_workers)
+		self._wakeup = _rpc_wakeup_fd()
+		self._want_write = set()
+		self._want_write_lock = threading.Lock()
 
-		self.add_poll_item(_rpc_server_sk(connection.rpc_sk))
+		self.add_poll_item(self._wakeup)
+		if connection:
+			self.add_poll_item(_rpc_server_sk(connection, slow_threshold))
 
 	def add_poll_item(self, item):
-		self._poll_list.append(item)
+		self._poll_items[item.fileno()] = item
+		self._poll.register(item.fileno(), select.EPOLLIN)
 
 	def remove_poll_item(self, item):
-		self._poll_list.remove(item)
+		self._poll.unregister(item.fileno())
+		del self._poll_items[item.fileno()]
 
-	def make_master(self):
-		return self._srv_class(self._connection)
+	def add_listener(self, sk, make_connection):
+		self.add_poll_item(_rpc_listen_sk(sk, make_connection,
+			self._slow_threshold))
+
+	def add_connection(self, connection, own_connection):
+		self.add_poll_item(_rpc_server_sk(connection, self._slow_threshold,
+			own_connection))
+
+	def make_master(self, connection):
+		return self._srv_class(connection)
+
+	def dispatch(self, func, *args):
+		"""Run func in worker, nobody waits for it so log its failure"""
+		def run():
+			try:
+				func(*args)
+			except Exception:
+				logging.exception("Exception in RPC worker")
+		self._pool.submit(run)
+
+	def want_write(self, item):
+		with self._want_write_lock:
+			self._want_write.add(item)
+		self._wakeup.wake()
+
+	def flush_replies(self):
+		with self._want_write_lock:
+			items, self._want_write = self._want_write, set()
+		for item in items:
+			self.__flush(item)
+
+	def __flush(self, item):
+		if item.fileno() not in self._poll_items:
+			return
+		events = select.EPOLLIN
+		if item.on_writable(self):
+			events |= select.EPOLLOUT
+		self._poll.modify(item.fileno(), events)
 
 	def stop(self):
 		self._alive = False
@@ -95,19 +460,41 @@ class _rpc_server_manager:
 			self.add_poll_item(_rpc_stop_fd(stop_fd))
 
 		while self._alive:
-			r, w, x = select.select(self._poll_list, [], [])
-			for sk in r:
-				sk.work(self)
+			try:
+				events = self._poll.poll()
+			except IOError as e:
+				if e.errno == errno.EINTR:
+					continue
+				raise
+
+			for fd, ev in events:
+				item = self._poll_items.get(fd)
+				if not item:
+					continue
+				if ev & select.EPOLLOUT:
+					self.__flush(item)
+				if ev & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+					item.on_readable(self)
 
 		logging.info("RPC Service stops")
 
 
 class rpc_threaded_srv(threading.Thread):
-	def __init__(self, srv_class, connection):
+	def __init__(self, srv_class, connection, slow_threshold=None,
+			nr_workers=rpc_def_workers):
 		threading.Thread.__init__(self)
-		self._mgr = _rpc_server_manager(srv_class, connection)
+		self._mgr = _rpc_server_manager(srv_class, connection, slow_threshold,
+			nr_workers)
 		self._stop_fd = None
 
+	def add_listener(self, sk, make_connection):
+		"""Serve RPC session on every connection accepted on sk"""
+		self._mgr.add_listener(sk, make_connection)
+
+	def add_connection(self, connection, own_connection=True):
+		"""Serve RPC session on connection, close it on disconnect if owned"""
+		self._mgr.add_connection(connection, own_connection)
+
 	def run(self):
 		try:
 			self._mgr.loop(self._stop_fd)
@@ -2,37 +2,165 @@
 # RPC client implementation
 #
 
+import time
 import logging
 import xem_rpc
+import trace
 
 
-class _rpc_proxy_caller:
-	def __init__(self, sk, typ, fname):
-		self._rpc_sk = sk
-		self._fn_typ = typ
+class rpc_future:
+	"""Result of asynchronous remote call
+
+	Replies arrive in the order calls were sent, so waiting for a result
+	consumes and dispatches replies of all earlier pending calls too.
+	"""
+
+	def __init__(self, proxy, fname, trace_ctx=None):
+		self._proxy = proxy
 		self._fn_name = fname
+		self._done = False
+		self._resp = None
+		self._start = time.time()
+		self._trace_ctx = trace_ctx
 
-	def __call__(self, *args):
-		call = (self._fn_typ, self._fn_name, args)
-		raw_data = repr(call)
-		self._rpc_sk.send(raw_data)
-		raw_data = self._rpc_sk.recv(xem_rpc.rpc_sk_buf)
-		resp = eval(raw_data)
-
-		if resp[0] == xem_rpc.RPC_RESP:
-			return resp[1]
-		elif resp[0] == xem_rpc.RPC_EXC:
+	def done(self):
+		return self._done
+
+	def set_resp(self, resp):
+		self._resp = resp
+		self._done = True
+		end = time.time()
+		self._proxy.record_call(self._fn_name, end - self._start, resp[3])
+		if self._trace_ctx:
+			trace.record("rpc " + self._fn_name, "rpc", self._start, end,
+				self._trace_ctx)
+
+	def result(self):
+		while not self._done:
+			self._proxy.recv_reply()
+
+		if self._resp[0] == xem_rpc.RPC_RESP:
+			return self._resp[1]
+		elif self._resp[0] == xem_rpc.RPC_EXC:
 			logging.info("Remote exception")
-			raise Exception(resp[1])
+			raise Exception(self._resp[1])
 		else:
 			raise Exception("Proto resp error")
 
 
+class _rpc_proxy_caller:
+	def __init__(self, proxy, typ, fname):
+		self._proxy = proxy
+		self._fn_typ = typ
+		self._fn_name = fname
+
+	def __call__(self, *args):
+		return self._proxy.submit(self._fn_typ, self._fn_name, args).result()
+
+
+class _rpc_batch:
+	"""Collect calls and send them to the remote side in a single write"""
+
+	def __init__(self, proxy):
+		self._proxy = proxy
+
+	def __enter__(self):
+		self._proxy.start_batch()
+		return self._proxy
+
+	def __exit__(self, typ, value, tb):
+		self._proxy.flush_batch()
+		return False
+
+
 class rpc_proxy:
 	def __init__(self, sk, *args):
 		self._rpc_sk = sk
-		c = _rpc_proxy_caller(self._rpc_sk, xem_rpc.RPC_CMD, "init_rpc")
+		self._next_seq = 0
+		self._pending = {}
+		self._batch = None
+		self._call_stats = xem_rpc.rpc_call_stats("client")
+		self._exec_stats = xem_rpc.rpc_call_stats("server execution")
+		c = _rpc_proxy_caller(self, xem_rpc.RPC_CMD, "init_rpc")
 		c(args)
 
 	def __getattr__(self, attr):
-		return _rpc_proxy_caller(self._rpc_sk, xem_rpc.RPC_CALL, attr)
+		return _rpc_proxy_caller(self, xem_rpc.RPC_CALL, attr)
+
+	def submit(self, typ, fname, args, oneway=False):
+		"""Send call without waiting for reply, return future or None"""
+		fut = None
+		seq = None
+		trace_ctx = trace.child_context()
+		if not oneway:
+			seq = self._next_seq
+			self._next_seq += 1
+			fut = rpc_future(self, fname, trace_ctx)
+			self._pending[seq] = fut
+		elif trace_ctx:
+			trace.record("rpc " + fname, "rpc", time.time(), None, trace_ctx)
+
+		msg = (typ, fname, args, seq)
+		if trace_ctx:
+			# Remote side nests its span under the one of this call
+			msg += ((trace_ctx[0], trace_ctx[2]),)
+		frame = xem_rpc.pack_msg(msg)
+		if self._batch is not None:
+			self._batch.append(frame)
+		else:
+			self._rpc_sk.sendall(frame)
+		return fut
+
+	def recv_reply(self):
+		if self._batch:
+			raise Exception("Waiting for reply inside unflushed batch")
+
+		resp = xem_rpc.recv_msg(self._rpc_sk)
+		if resp is None:
+			raise Exception("RPC connection closed")
+
+		fut = self._pending.pop(resp[2], None)
+		if not fut:
+			raise Exception("Proto resp seq error")
+		fut.set_resp(resp)
+
+	def call_async(self, fname, *args):
+		"""Call remote method, return rpc_future for its result"""
+		return self.submit(xem_rpc.RPC_CALL, fname, args)
+
+	def call_oneway(self, fname, *args):
+		"""Call remote method without reply
+
+		Failure of such call is reported by the next call expecting reply.
+		"""
+		self.submit(xem_rpc.RPC_CALL, fname, args, oneway=True)
+
+	def batch(self):
+		"""Context manager sending all calls made inside it at once"""
+		return _rpc_batch(self)
+
+	def start_batch(self):
+		self._batch = []
+
+	def flush_batch(self):
+		frames, self._batch = self._batch, None
+		if frames:
+			self._rpc_sk.sendall("".join(frames))
+
+	def set_slow_threshold(self, slow_threshold):
+		"""Log calls taking longer than slow_threshold seconds"""
+		self._call_stats.set_slow_threshold(slow_threshold)
+
+	def record_call(self, fname, latency, exec_time):
+		self._call_stats.record(fname, latency)
+		self._exec_stats.record(fname, exec_time)
+
+	def log_call_stats(self):
+		"""Log latencies seen by client and execution times on server"""
+		self._call_stats.log_summary()
+		self._exec_stats.log_summary()
+
+	def sync(self):
+		"""Wait for replies to all outstanding asynchronous calls"""
+		while self._pending:
+			self.recv_reply()